@@ -5,14 +5,17 @@ import asyncio
 import logging
 
 from datetime import date
-from typing import Tuple
+from typing import Dict, Optional, Tuple
 
 import aiohttp
 from bs4 import BeautifulSoup, Tag
 from dateutil.relativedelta import relativedelta
+from redis import Redis
 
 from ipasnhistory.default import AbstractManager, safe_create_dir, get_config
+from ipasnhistory.download import download_file
 from ipasnhistory.helpers import get_data_dir
+from ipasnhistory.manifest import Manifest
 
 logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s:%(message)s',
                     level=logging.INFO)
@@ -26,17 +29,30 @@ class CaidaDownloader(AbstractManager):
         self.ipv6_url = 'http://publicdata.caida.org/datasets/routing/routeviews6-prefix2as/{}'
         self.ipv4_url = 'http://publicdata.caida.org/datasets/routing/routeviews-prefix2as/{}'
         self.storage_root = get_data_dir()
+        self.max_concurrent_downloads = get_config('generic', 'max_concurrent_downloads')
+        self.manifest = Manifest(Redis(get_config('generic', 'storage_db_hostname'), get_config('generic', 'storage_db_port'),
+                                       decode_responses=True), 'caida')
+        # Validators (ETag, Last-Modified) and content of the pages already fetched: url -> (etag, last_modified, text)
+        self.fetched: Dict[str, Tuple[Optional[str], Optional[str], str]] = {}
+
+    def _session(self) -> aiohttp.ClientSession:
+        # All the requests of a run share the connections of one session.
+        # No total timeout (the files are big), but a stalled connection doesn't block forever.
+        return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_concurrent_downloads),
+                                     timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=300))
 
     async def fetch_existing_routes(self, cutoff_date: date):
-        v4 = asyncio.create_task(self.find_routes('v4', first_date=cutoff_date), name='Fetch old ipv4 routes')
-        v6 = asyncio.create_task(self.find_routes('v6', first_date=cutoff_date), name='Fetch old ipv6 routes')
+        async with self._session() as session:
+            v4 = asyncio.create_task(self.find_routes(session, 'v4', first_date=cutoff_date), name='Fetch old ipv4 routes')
+            v6 = asyncio.create_task(self.find_routes(session, 'v6', first_date=cutoff_date), name='Fetch old ipv6 routes')
 
-        await asyncio.gather(v4, v6, return_exceptions=True)
+            await asyncio.gather(v4, v6, return_exceptions=True)
 
     async def _to_run_forever_async(self):
         try:
-            for address_family in ['v4', 'v6']:
-                await self.download_latest(address_family)
+            async with self._session() as session:
+                for address_family in ['v4', 'v6']:
+                    await self.download_latest(session, address_family)
         except aiohttp.client_exceptions.ClientConnectorError as e:
             self.logger.critical(f'Error while fetching a routeview file: {e}')
 
@@ -45,18 +61,35 @@ class CaidaDownloader(AbstractManager):
             return self.ipv4_url
         return self.ipv6_url
 
-    async def _has_new(self, address_family: str) -> Tuple[bool, str]:
+    async def _get_text(self, session: aiohttp.ClientSession, url: str) -> str:
+        '''Conditional GET: if the page didn't change since the last time, the content we already have is returned.'''
+        headers = {}
+        if url in self.fetched:
+            etag, last_modified, _ = self.fetched[url]
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        async with session.get(url, headers=headers) as r:
+            if r.status == 304:
+                self.logger.debug(f'Not modified: {url}')
+                return self.fetched[url][2]
+            r.raise_for_status()
+            text = await r.text()
+            if r.headers.get('ETag') or r.headers.get('Last-Modified'):
+                self.fetched[url] = (r.headers.get('ETag'), r.headers.get('Last-Modified'), text)
+            return text
+
+    async def _has_new(self, session: aiohttp.ClientSession, address_family: str) -> Tuple[bool, str]:
         root_url = self._get_root_url(address_family)
-        async with aiohttp.ClientSession() as session:
-            async with session.get(root_url.format('pfx2as-creation.log')) as r:
-                text = await r.text()
-                last_entry = text.split('\n')[-2]
-                path = last_entry.split('\t')[-1]
-                if (self.storage_root / 'caida' / address_family / path).exists():
-                    self.logger.debug(f'Same file already loaded: {path}')
-                    return False, path
-                self.logger.info(f'New route found: {path}')
-                return True, path
+        text = await self._get_text(session, root_url.format('pfx2as-creation.log'))
+        last_entry = text.split('\n')[-2]
+        path = last_entry.split('\t')[-1]
+        if (self.storage_root / 'caida' / address_family / path).exists():
+            self.logger.debug(f'Same file already loaded: {path}')
+            return False, path
+        self.logger.info(f'New route found: {path}')
+        return True, path
 
     async def download_routes(self, session: aiohttp.ClientSession, address_family: str, path: str) -> None:
         store_path = self.storage_root / 'caida' / address_family / path
@@ -65,50 +98,39 @@ class CaidaDownloader(AbstractManager):
             return
         self.logger.info(f'New file to download: {path}')
         safe_create_dir(store_path.parent)
-        root_url = self._get_root_url(address_family)
-        async with session.get(root_url.format(path)) as r:
-            self.logger.debug(root_url.format(path))
-            content = await r.read()
-            if not content.startswith(b'\x1f\x8b'):
-                # Not a gzip file, skip.
-                print(content[:2])
-                return
-            with open(store_path, 'wb') as f:
-                f.write(content)
+        if await download_file(session, self._get_root_url(address_family).format(path), store_path, self.logger):
+            self.manifest.add(store_path)
             self.logger.info(f'File downloaded: {path}')
 
-    async def find_routes(self, address_family: str, first_date: date, last_date: date=date.today()) -> None:
+    async def find_routes(self, session: aiohttp.ClientSession, address_family: str, first_date: date, last_date: date=date.today()) -> None:
         root_url = self._get_root_url(address_family)
         cur_date = last_date
         sem = asyncio.Semaphore(2)
         while cur_date >= first_date:
             list_url = f'{cur_date:%Y/%m}'  # Makes a string like that: YYYY/MM
-            async with aiohttp.ClientSession() as session:
-                self.logger.debug(root_url.format(list_url))
-                async with session.get(root_url.format(list_url)) as r:
-                    soup = BeautifulSoup(await r.text(), 'html.parser')
-                    for a in soup.find_all('a'):
-                        if not isinstance(a, Tag):
-                            continue  # type: ignore[unreachable]
-                        href = a.get('href')
-                        if not isinstance(href, str):
-                            continue
-                        if href.startswith('routeviews'):
-                            dl_path = f'{cur_date:%Y/%m}/{href}'
-                            self.logger.debug(dl_path)
-                            async with sem:
-                                await self.download_routes(session, address_family, dl_path)
+            self.logger.debug(root_url.format(list_url))
+            soup = BeautifulSoup(await self._get_text(session, root_url.format(list_url)), 'html.parser')
+            for a in soup.find_all('a'):
+                if not isinstance(a, Tag):
+                    continue  # type: ignore[unreachable]
+                href = a.get('href')
+                if not isinstance(href, str):
+                    continue
+                if href.startswith('routeviews'):
+                    dl_path = f'{cur_date:%Y/%m}/{href}'
+                    self.logger.debug(dl_path)
+                    async with sem:
+                        await self.download_routes(session, address_family, dl_path)
             cur_date = cur_date - relativedelta(months=1)
 
-    async def download_latest(self, address_family: str) -> None:
+    async def download_latest(self, session: aiohttp.ClientSession, address_family: str) -> None:
         self.logger.debug(f'Search for new routes ({address_family}).')
-        has_new, path = await self._has_new(address_family)
+        has_new, path = await self._has_new(session, address_family)
         if not has_new:
             self.logger.debug(f'None found ({address_family}).')
             return
-        async with aiohttp.ClientSession() as session:
-            self.logger.debug(f'Has new ({address_family}).')
-            await self.download_routes(session, address_family, path)
+        self.logger.debug(f'Has new ({address_family}).')
+        await self.download_routes(session, address_family, path)
 
 
 def main():
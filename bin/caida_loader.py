@@ -4,33 +4,63 @@ import gzip
 import logging
 import re
 
-from dateutil.parser import parse
 from collections import defaultdict
-from ipaddress import ip_network
-from typing import Dict, Any
+from concurrent.futures import ProcessPoolExecutor
+from dateutil.parser import parse
+from pathlib import Path
+from socket import AF_INET, AF_INET6, inet_pton
+from typing import Dict, List, Tuple
 
 from redis import Redis, exceptions
 
 from ipasnhistory.default import get_socket_path, AbstractManager, get_config
-from ipasnhistory.helpers import get_data_dir
+from ipasnhistory.helpers import dates_stream_key
+from ipasnhistory.ingest import AnnouncesWriter, run_chains
+from ipasnhistory.manifest import LOADED, SKIPPED, Manifest
+from ipasnhistory.storage import storage_layout
 
 logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s:%(message)s',
                     level=logging.INFO)
 
 
+def load_pfx2as(path: Path, key_prefix: str, address_family: str, date: str) -> int:
+    '''Import a pfx2as file in the storage, runs in a worker process. Returns the number of prefixes imported.'''
+    storagedb = Redis(get_config('generic', 'storage_db_hostname'), get_config('generic', 'storage_db_port'), decode_responses=True)
+    writer = AnnouncesWriter(storagedb, key_prefix, address_family, date)
+    family, max_length = (AF_INET, 32) if address_family == 'v4' else (AF_INET6, 128)
+    try:
+        with gzip.open(path, 'rt') as f:
+            for line in f:
+                prefix, length, asns = line.rstrip('\n').split('\t')
+                # The meaning of AS set and multi-origin AS in unclear. Taking the first ASN in the list only.
+                asn = asns.split('_', 1)[0].split(',', 1)[0]
+                prefix_length = int(length)
+                host_bits = max_length - prefix_length
+                network = int.from_bytes(inet_pton(family, prefix), 'big') >> host_bits << host_bits
+                writer.add(asn, network, prefix_length)
+        return writer.finish()
+    except Exception:
+        # Don't leave a partial date in the storage
+        writer.discard()
+        raise
+
+
 class CaidaLoader(AbstractManager):
 
     def __init__(self, loglevel: int=logging.INFO):
         super().__init__(loglevel)
         self.script_name = "caida_loader"
         self.key_prefix = 'caida'
-        self.storage_root = get_data_dir() / 'caida'
         self.storagedb = Redis(get_config('generic', 'storage_db_hostname'), get_config('generic', 'storage_db_port'), decode_responses=True)
         self.storagedb.sadd('prefixes', self.key_prefix)
         self.cache = Redis(unix_socket_path=get_socket_path('cache'), decode_responses=True)
+        self.loader_processes = get_config('generic', 'loader_processes')
+        self.manifest = Manifest(self.storagedb, 'caida')
+        self.manifest.bootstrap()
 
     def _to_run_forever(self):
-        self.load_all()
+        # Returns as soon as the downloader notifies a new file.
+        self.load_all(self.manifest.wait(timeout=10))
 
     def already_loaded(self, address_family: str, date: str) -> bool:
         try:
@@ -42,51 +72,59 @@ class CaidaLoader(AbstractManager):
         cur_last = self.storagedb.get(f'{self.key_prefix}|{address_family}|last')
         if not cur_last or date > cur_last:
             self.storagedb.set(f'{self.key_prefix}|{address_family}|last', date)
-
-    def load_all(self):
-        for path in sorted(self.storage_root.glob('**/*.gz'), reverse=True):
+        # Tell the lookup processes
+        self.cache.xadd(dates_stream_key(self.key_prefix), {'address_family': address_family, 'date': date},
+                        maxlen=1000, approximate=True)
+
+    def load_all(self, paths: List[Path]):
+        if not paths:
+            return
+        to_load: Dict[str, List[Tuple[Path, str, str, str]]] = defaultdict(list)
+        oldest_to_load = self.cache.hget('META:expected_interval', 'first')
+        for path in sorted(paths, reverse=True):
             address_family, year, month, date_str = re.findall('.*/(.*)/(.*)/(.*)/routeviews-rv[2,6]-(.*).pfx2as.gz', str(path))[0]
             date = parse(date_str).isoformat()
 
-            oldest_to_load = self.cache.hget('META:expected_interval', 'first')
             if oldest_to_load and oldest_to_load > date:
                 # The CAIDA dump we're trying to load is older than the oldest date we want to cache, skipping.
+                self.manifest.set_state(path, SKIPPED)
                 continue
 
             if self.already_loaded(address_family, date):
                 self.logger.debug(f'Already loaded {path}')
+                self.manifest.set_state(path, LOADED)
                 continue
             self.logger.info(f'Loading {path}')
-            to_import: Dict[str, Any] = defaultdict(lambda: {address_family: set(), 'ipcount': 0})
-            with gzip.open(path) as f:
-                for line in f:
-                    prefix, length, asns = line.decode().strip().split('\t')
-                    # The meaning of AS set and multi-origin AS in unclear. Taking the first ASN in the list only.
-                    asn = re.split('[,_]', asns)[0]
-                    network = ip_network(f'{prefix}/{length}')
-                    to_import[asn][address_family].add(str(network))
-                    to_import[asn]['ipcount'] += network.num_addresses
-
-            self.logger.debug('Content loaded')
-            if not to_import.keys():
-                self.logger.warning(f'Nothing to import for {self.key_prefix}|{address_family}|{date}: {to_import}')
-                path.unlink()
-                continue
-            p = self.storagedb.pipeline()
-            p.sadd(f'{self.key_prefix}|{address_family}|dates', date)
-            p.sadd(f'{self.key_prefix}|{address_family}|{date}|asns', *to_import.keys())  # Store all ASNs
-            for asn, data in to_import.items():
-                p.sadd(f'{self.key_prefix}|{address_family}|{date}|{asn}', *data[address_family])  # Store all prefixes
-                p.set(f'{self.key_prefix}|{address_family}|{date}|{asn}|ipcount', data['ipcount'])  # Total IPs for the AS
-            self.logger.debug('All keys ready')
-            p.execute()
-            self.update_last(address_family, date)
-            self.logger.debug('Done.')
+            to_load[address_family].append((path, self.key_prefix, address_family, date))
+
+        if storage_layout() == 'delta':
+            # Each date is the diff with the previous one: oldest first, one at a time per address family.
+            chains = [sorted(files) for files in to_load.values()]
+        else:
+            # Newest first, all in parallel.
+            chains = [[f] for f in sorted((f for files in to_load.values() for f in files), reverse=True)]
+        with ProcessPoolExecutor(self.loader_processes) as executor:
+            for (path, _, address_family, date), future in run_chains(executor, load_pfx2as, chains):
+                try:
+                    imported = future.result()
+                except Exception:
+                    # Stays in the manifest as downloaded, loaded again when the loader restarts.
+                    self.logger.exception(f'Unable to load {path}.')
+                    continue
+                if not imported:
+                    self.logger.warning(f'Nothing to import for {self.key_prefix}|{address_family}|{date}')
+                    path.unlink()
+                    self.manifest.remove(path)
+                    continue
+                self.update_last(address_family, date)
+                self.manifest.set_state(path, LOADED)
+                self.logger.info(f'Done with {path}: {imported} prefixes.')
 
 
 def main():
     m = CaidaLoader()
-    m.run(sleep_in_sec=30)
+    # No need to sleep, the loader waits for the notifications of the downloader.
+    m.run(sleep_in_sec=0)
 
 
 if __name__ == '__main__':
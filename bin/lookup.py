@@ -1,131 +1,356 @@
 #!/usr/bin/env python3
 import argparse
+import json
 import logging
+import os
+import socketserver
+import threading
+import time
 
-from typing import Dict, List
+from typing import Dict, List, Set, Tuple
 
 from redis import Redis
-import pytricia  # type: ignore
+from redis.exceptions import ResponseError
 
 from ipasnhistory.default import AbstractManager, get_socket_path, get_config
+from ipasnhistory.helpers import dates_stream_key, get_rss, ondemand_stream_key, queue_key, ranges_cache_key, range_member
+from ipasnhistory.prefix_index import DatedIndex, new_index
+from ipasnhistory.rpc import recv_message, rpc_socket_path, send_message
+
+
+class RPCHandler(socketserver.BaseRequestHandler):
+    '''Answers the batches of lookups sent on a connection, until it is closed.'''
+
+    def handle(self):
+        lookup: 'Lookup' = self.server.lookup  # type: ignore[attr-defined]
+        while True:
+            try:
+                request = recv_message(self.request)
+            except ConnectionError:
+                return
+            send_message(self.request, lookup.rpc_lookup(request['address_family'], request['date'], request['ips']))
 
 
 class Lookup(AbstractManager):
 
-    def __init__(self, source: str, first: str, last: str, loglevel: int=logging.DEBUG):
+    def __init__(self, source: str, worker: str, loglevel: int=logging.DEBUG):
         super().__init__(loglevel)
         self.script_name = "lookup"
 
         self.storagedb = Redis(get_config('generic', 'storage_db_hostname'), get_config('generic', 'storage_db_port'), decode_responses=True)
         self.cache = Redis(unix_socket_path=get_socket_path('cache'), decode_responses=True)
+        self.query_timeout = get_config('generic', 'query_timeout')
 
         self.source = source
-        self.first_date = first
-        self.last_date = last
-
-        self.trees: Dict[str, Dict[str, Dict]] = {'v4': {source: {}}, 'v6': {source: {}}}
-        self.loaded_dates: Dict[str, List] = {'v4': [], 'v6': []}
-
-        # For the initial load, we don't care about the locks and want to load everything as fast as possible.
-        self.load_all(ignore_lock=True)
-
-    def locked(self, address_family: str):
-        # Avoid to see scripts providing data for the same time frame to be locked at the same time
-        for locked_interval in self.cache.smembers(f'lock|{self.source}|{address_family}'):
-            locked_first, locked_last = locked_interval.split('_')
-            if (locked_first <= self.first_date <= locked_last) or (locked_first <= self.last_date <= locked_last):
-                self.logger.debug(f'Locked: {self.first_date} {self.last_date} because of {locked_first} {locked_last}')
-                return True
-        return False
-
-    def load_all(self, ignore_lock: bool=False):
-        for address_family in ['v4', 'v6']:
-            if not ignore_lock and self.locked(address_family):
-                continue
-            available_dates = self.storagedb.smembers(f'{self.source}|{address_family}|dates')
-            to_load = [available_date for available_date in available_dates if available_date >= self.first_date and available_date <= self.last_date]
-            if not set(to_load).difference(set(self.trees[address_family][self.source].keys())):
-                # Everything available has already been loaded
+        # The dates to load are assigned to the worker by the lookup manager.
+        self.worker = worker
+
+        # One queue per loaded date, shared with the other processes having the same date loaded (consumer group).
+        self.consumer = f'{source}|{worker}|{os.getpid()}'
+        self.queues: Dict[str, str] = {}
+        # The queues are joined by the loading thread and read by the main one.
+        self.queues_lock = threading.Lock()
+        self.last_claim = time.monotonic()
+        self.last_report = time.monotonic()
+
+        self.indexes: Dict[str, DatedIndex] = {'v4': new_index('v4'), 'v6': new_index('v6')}
+        # The dates are unloaded by the loading thread, the lookups run in the main and the RPC threads.
+        self.indexes_lock = threading.Lock()
+        # Size of the loaded dates, in bytes
+        self.sizes: Dict[Tuple[str, str], int] = {}
+
+        # Historical dates loaded on demand: (address family, date) -> last use. The least recently used
+        # ones are unloaded when they don't fit in the memory anymore, the assigned ones are never unloaded.
+        self.ondemand_budget = get_config('generic', 'ondemand_memory_mb') * 1024 * 1024
+        self.last_used: Dict[Tuple[str, str], float] = {}
+        # Touched by the main and the RPC threads, loaded and unloaded by the loading thread.
+        self.last_used_lock = threading.Lock()
+        if self.ondemand_budget:
+            self._join_group(ondemand_stream_key(source), '$')
+
+        # Batches of lookups sent directly by the queries, without going through the cache.
+        self.rpc_path = rpc_socket_path(source, worker) if get_config('generic', 'lookup_rpc') else None
+        if self.rpc_path:
+            if os.path.exists(self.rpc_path):
+                os.remove(self.rpc_path)
+            self.rpc_server = socketserver.ThreadingUnixStreamServer(self.rpc_path, RPCHandler)
+            self.rpc_server.daemon_threads = True
+            self.rpc_server.lookup = self  # type: ignore[attr-defined]
+            threading.Thread(target=self.rpc_server.serve_forever, name='rpc', daemon=True).start()
+
+        # Memory used without any date loaded
+        self.baseline_rss = get_rss()
+        self.cache.delete(f'loaded|{source}|{worker}')
+        self._report()
+
+        # The dates are loaded in the background, the ones already loaded are served meanwhile.
+        self.loader = threading.Thread(target=self._load_forever, name='loader', daemon=True)
+        self.loader.start()
+
+    def _report(self):
+        # Also the heartbeat checked by the lookup manager
+        self.last_report = time.monotonic()
+        self.cache.hset(f'workers|{self.source}', self.worker,
+                        json.dumps({'pid': os.getpid(), 'baseline': self.baseline_rss, 'rss': get_rss(), 'heartbeat': time.time(),
+                                    'rpc': self.rpc_path}))
+
+    def _assigned(self) -> Dict[str, Set[str]]:
+        assigned: Dict[str, Set[str]] = {'v4': set(), 'v6': set()}
+        for entry in self.cache.smembers(f'assignment|{self.source}|{self.worker}'):
+            address_family, announces_date = entry.split('|', 1)
+            assigned[address_family].add(announces_date)
+        return assigned
+
+    def sync(self):
+        '''Load the dates assigned to this process (when they are in the storage), unload the other ones.'''
+        for address_family, assigned in self._assigned().items():
+            loaded = set(self.indexes[address_family].dates())
+            with self.last_used_lock:
+                for announces_date in loaded - assigned:
+                    if (address_family, announces_date) not in self.last_used:
+                        self.unload_tree(announces_date, address_family)
+                for announces_date in assigned:
+                    # Pinned now
+                    self.last_used.pop((address_family, announces_date), None)
+            if not assigned - loaded:
                 continue
-            if not ignore_lock:
-                self.cache.sadd(f'lock|{self.source}|{address_family}', f'{self.first_date}_{self.last_date}')
-            for d in to_load:
-                if self.trees[address_family][self.source].get(d) is None:
-                    if address_family == 'v4':
-                        self.trees[address_family][self.source][d] = pytricia.PyTricia()
-                    else:
-                        self.trees[address_family][self.source][d] = pytricia.PyTricia(128)
-                if not self.trees[address_family][self.source][d]:
-                    self.load_tree(d, address_family)
-                    self.loaded_dates[address_family].append(d)
-            if not ignore_lock:
-                self.cache.srem(f'lock|{self.source}|{address_family}', f'{self.first_date}_{self.last_date}')
+            available = self.storagedb.smembers(f'{self.source}|{address_family}|dates')
+            for announces_date in sorted((assigned - loaded) & available, reverse=True):
+                self.load_tree(announces_date, address_family)
+        self._report()
 
-    def load_tree(self, announces_date: str, address_family: str):
-        self.logger.debug(f'Loading {self.source} {address_family} {announces_date}')
-        asns = self.storagedb.smembers(f'{self.source}|{address_family}|{announces_date}|asns')
+    def _make_room(self, size: int):
+        '''Unload the least recently used historical dates until there is room for size bytes.'''
+        with self.last_used_lock:
+            while self.last_used and sum(self.sizes.get(key, 0) for key in self.last_used) + size > self.ondemand_budget:
+                address_family, announces_date = min(self.last_used, key=lambda key: self.last_used[key])
+                self.last_used.pop((address_family, announces_date))
+                self.unload_tree(announces_date, address_family)
+
+    def _touch(self, address_family: str, announces_date: str):
+        '''Mark a historical date as used, the assigned (pinned) ones aren't tracked.'''
+        with self.last_used_lock:
+            if (address_family, announces_date) in self.last_used:
+                self.last_used[(address_family, announces_date)] = time.monotonic()
+
+    def _load_ondemand(self):
+        '''Load the historical dates the queries are waiting for. Blocks at most 1s.'''
+        stream = ondemand_stream_key(self.source)
+        for _, entries in self.cache.xreadgroup('lookup', self.consumer, {stream: '>'}, count=10, block=1000):
+            try:
+                for _, request in entries:
+                    try:
+                        self._load_requested(request['address_family'], request['date'])
+                    except Exception:
+                        self.logger.exception(f'Unable to load {self.source} {request}.')
+            finally:
+                # Acknowledged even if the loading failed, the next queries on that date ask again.
+                ids = [entry_id for entry_id, _ in entries]
+                self.cache.xack(stream, 'lookup', *ids)
+                self.cache.xdel(stream, *ids)
 
-        p = self.storagedb.pipeline()
-        [p.smembers(f'{self.source}|{address_family}|{announces_date}|{asn}') for asn in asns]
-        to_load = p.execute()
+    def _load_requested(self, address_family: str, announces_date: str):
+        if announces_date in self.indexes[address_family]:
+            self._touch(address_family, announces_date)
+            return
+        if (self.cache.sismember(f'{self.source}|{address_family}|cached_dates', announces_date)
+                or not self.storagedb.sismember(f'{self.source}|{address_family}|dates', announces_date)):
+            # Already loaded by an other process, or unknown.
+            return
+        sizes = self.cache.hmget(f'tree_sizes|{self.source}|{address_family}', announces_date)
+        size = int(sizes[0]) if sizes[0] else max(self.sizes.values(), default=0)
+        if size > self.ondemand_budget:
+            # It would unload all the other ones, and still not fit.
+            self.logger.warning(f'{self.source} {address_family} {announces_date} ({size} bytes) is bigger than ondemand_memory_mb, not loaded.')
+            return
+        self._make_room(size)
+        self.load_tree(announces_date, address_family)
+        with self.last_used_lock:
+            self.last_used[(address_family, announces_date)] = time.monotonic()
 
-        for asn, ip_prefixes in zip(asns, to_load):
-            for ip_prefix in ip_prefixes:
-                self.trees[address_family][self.source][announces_date][ip_prefix] = asn
-        self.cache.sadd(f'{self.source}|{address_family}|cached_dates', announces_date)
+    def _load_forever(self):
+        '''Follow the assignment, load the assigned dates as soon as the loaders announce them,
+        and the historical dates when they are queried.'''
+        stream = dates_stream_key(self.source)
+        last_event = self.cache.xrevrange(stream, count=1)
+        last_id = last_event[0][0] if last_event else '0'
+        last_sync = 0.0
+        while not self.shutdown_requested():
+            try:
+                # The events only wake us up, the assignment is checked at least every 10s.
+                if time.monotonic() - last_sync > 10:
+                    self.sync()
+                    last_sync = time.monotonic()
+                if self.ondemand_budget:
+                    self._load_ondemand()
+                    events = self.cache.xread({stream: last_id})
+                else:
+                    events = self.cache.xread({stream: last_id}, block=10000)
+                for _, entries in events:
+                    last_id = entries[-1][0]
+                    last_sync = 0.0
+            except Exception:
+                self.logger.exception('Unable to load the dates.')
+                time.sleep(10)
+
+    def load_tree(self, announces_date: str, address_family: str):
+        self.logger.debug(f'Loading {self.source} {address_family} {announces_date}')
+        self.indexes[address_family].load(self.storagedb, self.source, announces_date)
+        size = self.indexes[address_family].nbytes(announces_date)
+        self.sizes[(address_family, announces_date)] = size
+        p = self.cache.pipeline()
+        # Used by the lookup manager to plan the memory
+        p.hset(f'tree_sizes|{self.source}|{address_family}', announces_date, size)
+        p.sadd(f'loaded|{self.source}|{self.worker}', f'{address_family}|{announces_date}')
+        p.sadd(f'{self.source}|{address_family}|cached_dates', announces_date)
+        p.incr(f'{self.source}|{address_family}|cached_dates_version')
+        p.execute()
+        self._join_queue(queue_key(self.source, address_family, announces_date))
         self.logger.debug(f'Done with Loading {self.source} {address_family}')
 
-    def _to_run_forever(self):
-        while True:
-            self.load_all()
-            queries: List[str] = self.cache.srandmember('query', 20)  # type: ignore
-            if not queries:
-                break
+    def unload_tree(self, announces_date: str, address_family: str):
+        self.logger.debug(f'Unloading {self.source} {address_family} {announces_date}')
+        with self.queues_lock:
+            self.queues.pop(queue_key(self.source, address_family, announces_date), None)
+        with self.indexes_lock:
+            self.indexes[address_family].unload(announces_date)
+        self.sizes.pop((address_family, announces_date), None)
+        self.cache.srem(f'loaded|{self.source}|{self.worker}', f'{address_family}|{announces_date}')
+        p = self.cache.pipeline()
+        [p.sismember(f'loaded|{self.source}|{worker}', f'{address_family}|{announces_date}')
+         for worker in self.cache.hkeys(f'workers|{self.source}')]
+        if not any(p.execute()):
+            # No other process has it
             p = self.cache.pipeline()
-            for q in queries:
-                if self.cache.exists(q):
-                    # The query is already cached, cleanup.
-                    self.cache.srem('query', q)
-                    continue
-                self.logger.debug(f'Searching {q}')
-                prefix, address_family, date, ip = q.split('|', 3)
-                if prefix != self.source:
-                    # query for an other data source, ignore
-                    continue
-                if date not in self.loaded_dates[address_family]:
-                    # Date not loaded in this process, ignore
-                    continue
-                try:
-                    asn = self.trees[address_family][prefix][date].get(ip)
-                    ip_prefix = self.trees[address_family][prefix][date].get_key(ip)
-                    if asn is None or ip_prefix is None:
-                        self.logger.warning(f'Unable to find ASN ({asn}) and/or IP Prefix ({ip_prefix}): "{address_family}" "{prefix}" "{date}" "{ip}"')
-                        asn = 0
-                        if address_family == 'v4':
-                            ip_prefix = '0.0.0.0/0'
-                        else:
-                            ip_prefix = '::/0'
-                    elif ip_prefix in ['0.0.0.0/0', '::/0']:
-                        # Make sure not to return an ASN if we have no prefix.
-                        self.logger.warning(f'Invalid response ({ip_prefix} - {asn}) for this request: "{address_family}" "{prefix}" "{date}" "{ip}"')
-                        asn = 0
-                    p.hmset(q, {'asn': asn, 'prefix': ip_prefix})
-                except ValueError:
-                    p.hmset(q, {'error': f'Query invalid: "{address_family}" "{prefix}" "{date}" "{ip}"'})
-                    self.logger.warning(f'Query invalid: "{address_family}" "{prefix}" "{date}" "{ip}"')
-                finally:
-                    p.expire(q, 43200)  # 12h
-                    p.srem('query', q)
+            p.srem(f'{self.source}|{address_family}|cached_dates', announces_date)
+            p.incr(f'{self.source}|{address_family}|cached_dates_version')
             p.execute()
 
+    def _join_group(self, stream: str, start: str):
+        try:
+            self.cache.xgroup_create(stream, 'lookup', id=start, mkstream=True)
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def _join_queue(self, queue: str):
+        # Start from the beginning: the keys queued before the date was loaded are waiting for us.
+        self._join_group(queue, '0')
+        with self.queues_lock:
+            self.queues[queue] = '>'
+
+    def _notify(self, answered: List[str]):
+        """Push the answered keys to the reply lists of the queries waiting on them."""
+        p = self.cache.pipeline()
+        [p.smembers(f'waiting|{q}') for q in answered]
+        waiting = p.execute()
+        p = self.cache.pipeline()
+        for q, reply_lists in zip(answered, waiting):
+            if not reply_lists:
+                continue
+            for reply_list in reply_lists:
+                p.rpush(reply_list, q)
+                p.expire(reply_list, self.query_timeout)
+            p.delete(f'waiting|{q}')
+        p.execute()
+
+    def _claim_stale(self, queues: Dict[str, str]) -> List:
+        """Take over the keys read by a process that didn't acknowledge them in time (most probably dead)."""
+        entries = []
+        for queue in queues:
+            claimed = self.cache.xautoclaim(queue, 'lookup', self.consumer, min_idle_time=self.query_timeout * 1000, count=1000)
+            if claimed[1]:
+                entries.append((queue, claimed[1]))
+        return entries
+
+    def _read_queues(self) -> List:
+        with self.queues_lock:
+            queues = dict(self.queues)
+        if time.monotonic() - self.last_claim > self.query_timeout:
+            self.last_claim = time.monotonic()
+            if entries := self._claim_stale(queues):
+                return entries
+        try:
+            return self.cache.xreadgroup('lookup', self.consumer, queues, count=1000, block=1000)
+        except ResponseError as e:
+            if 'NOGROUP' not in str(e):
+                raise
+            # A queue was deleted (the date isn't cached anymore), re-create the groups.
+            for queue in queues:
+                self._join_queue(queue)
+            return []
+
+    def _lookup(self, queue: str, entries: List[Tuple[str, Dict]]) -> List[str]:
+        _, source, address_family, date = queue.split('|', 3)
+        self._touch(address_family, date)
+        # Deleted entries can still be pending, they don't have fields.
+        keys = list(dict.fromkeys(k for _, fields in entries if fields for k in json.loads(fields['keys'])))
+        with self.indexes_lock:
+            if date not in self.indexes[address_family]:
+                # Just unloaded, left pending for the other processes.
+                return []
+            p = self._lookup_responses(source, address_family, date, keys)
+        ids = [entry_id for entry_id, _ in entries]
+        p.xack(queue, 'lookup', *ids)
+        p.xdel(queue, *ids)
+        p.execute()
+        return keys
+
+    def _lookup_responses(self, source: str, address_family: str, date: str, keys: List[str]):
+        '''The pipeline caching the responses of the keys, the date must stay loaded meanwhile (indexes_lock).'''
+        index = self.indexes[address_family]
+        p = self.cache.pipeline()
+        responses = index.lookup_many(date, [k.split('|', 3)[3] for k in keys])
+        for q, response in zip(keys, responses):
+            self.logger.debug(f'Searching {q}')
+            ip = q.split('|', 3)[3]
+            if response is None:
+                p.hmset(q, {'error': f'Query invalid: "{address_family}" "{source}" "{date}" "{ip}"'})
+                p.expire(q, 43200)  # 12h
+                self.logger.warning(f'Query invalid: "{address_family}" "{source}" "{date}" "{ip}"')
+            elif response['asn'] == '0':
+                self.logger.warning(f'Unable to find a valid ASN and IP Prefix: "{address_family}" "{source}" "{date}" "{ip}"')
+                p.hmset(q, response)
+                p.expire(q, 43200)  # 12h
+            else:
+                # Cache the answer for all the IPs getting the same one, not only the one queried.
+                first, last = index.uniform_range(date, ip, response['prefix'])
+                ranges_key = ranges_cache_key(source, address_family, date)
+                p.zadd(ranges_key, {range_member(first, last, address_family, response): 0})
+                p.expire(ranges_key, 43200)  # 12h
+        return p
+
+    def rpc_lookup(self, address_family: str, date: str, ips: List[str]) -> Dict:
+        '''Lookup a batch of IPs, the responses are arrays in the order of the IPs.'''
+        with self.indexes_lock:
+            if date not in self.indexes[address_family]:
+                # The date isn't loaded (anymore), the query goes through the cache instead.
+                return {'error': f'{address_family} {date} not loaded.'}
+            responses = self.indexes[address_family].lookup_many(date, ips)
+        self._touch(address_family, date)
+        return {'asn': [r['asn'] if r else None for r in responses],
+                'prefix': [r['prefix'] if r else None for r in responses]}
+
+    def _to_run_forever(self):
+        while not self.shutdown_requested():
+            if time.monotonic() - self.last_report > 5:
+                self._report()
+            if not self.queues:
+                time.sleep(1)
+                continue
+            answered: List[str] = []
+            for queue, entries in self._read_queues():
+                answered += self._lookup(queue, entries)
+            if answered:
+                self._notify(answered)
+
 
 def main():
-    parser = argparse.ArgumentParser(description='Cache prefix announcements on a specific timeframe.')
-    parser.add_argument('source', help='Dataset source name (must be caida for now).')
-    parser.add_argument('first_date', help='First date in the interval.')
-    parser.add_argument('last_date', help='Last date in the interval.')
+    parser = argparse.ArgumentParser(description='Cache prefix announcements of the dates assigned by the lookup manager.')
+    parser.add_argument('source', help='Dataset source name.')
+    parser.add_argument('worker', help='Name of the worker, the lookup manager assigns the dates to it.')
     args = parser.parse_args()
-    lookup = Lookup(args.source, args.first_date, args.last_date)
+    lookup = Lookup(args.source, args.worker)
     lookup.run(sleep_in_sec=1)
 
 
@@ -1,110 +1,232 @@
 #!/usr/bin/env python3
 
 import argparse
+import json
 import logging
+import time
 
 from collections import defaultdict
 from datetime import timedelta, date
 from subprocess import Popen
+from typing import Dict, List, Set, Tuple
 
 from redis import Redis
 
 from ipasnhistory.default import AbstractManager, get_socket_path, get_config
+from ipasnhistory.helpers import get_snapshot_dir, queue_key
+from ipasnhistory.prefix_index import INDEX_BACKENDS
 
 logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s:%(message)s',
                     level=logging.INFO)
 
 
-'''
-Each lookup module has 30 consecurive days, starting every 15 days so we have dedundancy
+# Used until the lookup processes loaded the trees and reported their size, in bytes.
+DEFAULT_TREE_SIZE = {'v4': 512 * 1024 * 1024, 'v6': 128 * 1024 * 1024}
 
-Process 1: 2018-08-01 -> 2018-08-30
-Process 2: 2018-08-15 -> 2018-09-14
-Process 3: 2018-08-30 -> 2018-09-29
 
-The last 30 days are covered by 2 lookup processses to avoid downtime
-
-Metadata
-* currently loaded days
-* sources
-'''
+class LookupManager(AbstractManager):
+    '''Runs lookup_workers lookup processes per source, and assigns them the dates to load.
 
+    The most recent dates get `replicas` copies each, on different processes, as long as they fit in the
+    memory budget (using the size of the trees reported by the lookup processes). The memory left is used
+    for more copies of the most queried dates. Run again regularly: the new dates are added, the oldest
+    ones dropped when there is no room for them anymore.
 
-class LookupManager(AbstractManager):
+    The processes report a heartbeat, the dead or stuck ones are restarted with the same assignment. A process
+    losing a date keeps it until the processes getting it have loaded it, and until it has loaded its own new
+    dates: the dates stay available during the rollovers (at the cost of some memory above the budget meanwhile).'''
 
     def __init__(self, loglevel: int=logging.WARNING):
         super().__init__(loglevel)
         self.script_name = "lookup_manager"
-        self.floating_window_days = get_config('generic', 'floating_window_days')
         self.days_in_memory = get_config('generic', 'days_in_memory')
         self.sources = get_config('generic', 'sources')
+        self.lookup_workers = get_config('generic', 'lookup_workers')
+        self.replicas = get_config('generic', 'replicas')
+        self.heartbeat_timeout = get_config('generic', 'lookup_heartbeat_timeout')
+        # Shared by all the lookup processes
+        # Each process keeps some memory for the historical dates it loads on demand.
+        self.worker_budget = (get_config('generic', 'memory_budget_mb') * 1024 * 1024 // (len(self.sources) * self.lookup_workers)
+                              - get_config('generic', 'ondemand_memory_mb') * 1024 * 1024)
+        # With a backend using snapshots, all the processes map the same file for a date (one copy in the page cache):
+        # only the first replica of a date uses memory.
+        backend = INDEX_BACKENDS.get(get_config('generic', 'index_backend'))
+        self.shared_snapshots = backend is not None and backend.snapshots
 
         self.cache = Redis(unix_socket_path=get_socket_path('cache'), decode_responses=True)
-        # Cleanup pytricia cache information as it has to be reloaded
+        self.storagedb = Redis(get_config('generic', 'storage_db_hostname'), get_config('generic', 'storage_db_port'), decode_responses=True)
+        # The cached dates stay available: the new processes get the same assignment and load them again,
+        # the queries on them wait meanwhile.
         for source in self.sources:
-            self.cache.delete(f'{source}|v4|cached_dates')
-            self.cache.delete(f'{source}|v6|cached_dates')
-
-        init_date = date.today()
-        self.running_processes = defaultdict(list)
-        # Start process today -> today + self.floating_window_days
-        last = init_date + timedelta(days=self.floating_window_days)
+            for worker in self.cache.hkeys(f'workers|{source}'):
+                self.cache.delete(f'loaded|{source}|{worker}')
+            self.cache.delete(f'workers|{source}')
+            for key in self.cache.scan_iter(f'assignment|{source}|*'):
+                if key.split('|', 2)[2] not in {str(i) for i in range(self.lookup_workers)}:
+                    self.cache.delete(key)
+
+        self.running_processes: Dict[str, Dict[str, Popen]] = defaultdict(dict)
+        self.started: Dict[Tuple[str, str], float] = {}
         for source in self.sources:
-            p = Popen(['lookup', source, init_date.isoformat(), last.isoformat()])
-            self.running_processes[source].append((p, init_date, last))
-            # Start process today - self.floating_window_days/2 -> today + self.floating_window_days/2
-            first = init_date - timedelta(days=self.floating_window_days / 2)
-            last = init_date + timedelta(days=self.floating_window_days / 2)
-            p = Popen(['lookup', source, first.isoformat(), last.isoformat()])
-            self.running_processes[source].append((p, first, last))
-
-            current = init_date - timedelta(days=1)
-            # Start all processes with complete datasets
-            while current > (init_date - timedelta(days=self.days_in_memory)):
-                begin_interval = current - timedelta(self.floating_window_days)
-                p = Popen(['lookup', source, begin_interval.isoformat(), current.isoformat()])
-                self.running_processes[source].append((p, begin_interval, current))
-                current = current - timedelta(self.floating_window_days / 2)
+            for i in range(self.lookup_workers):
+                self._spawn(source, str(i))
 
         self.cache.sadd('META:sources', *self.sources)
-        self.cache.hmset('META:expected_interval', {'first': (init_date - timedelta(days=self.days_in_memory)).isoformat(),
-                                                    'last': init_date.isoformat()})
+        self._update_expected_interval()
+
+    def _spawn(self, source: str, worker: str):
+        self.running_processes[source][worker] = Popen(['lookup', source, worker])
+        self.started[(source, worker)] = time.time()
+
+    def _reports(self, source: str) -> Dict[str, Dict]:
+        return {worker: json.loads(report) for worker, report in self.cache.hgetall(f'workers|{source}').items()}
+
+    def supervise(self, source: str):
+        '''Restart the lookup processes that died or stopped reporting.'''
+        reports = self._reports(source)
+        for worker, process in list(self.running_processes[source].items()):
+            if process.poll() is not None:
+                self.logger.warning(f'Lookup process died: {source} {worker}, restarting it.')
+            elif time.time() - max(self.started[(source, worker)], reports.get(worker, {}).get('heartbeat', 0)) > self.heartbeat_timeout:
+                self.logger.warning(f'Lookup process not responding: {source} {worker}, restarting it.')
+                process.kill()
+                process.wait()
+            else:
+                continue
+            # Same assignment: the new process loads the same dates, the other replicas answer meanwhile.
+            self.cache.delete(f'loaded|{source}|{worker}')
+            self.cache.hdel(f'workers|{source}', worker)
+            self._spawn(source, worker)
+
+    def _update_expected_interval(self):
+        self.cache.hmset('META:expected_interval', {'first': (date.today() - timedelta(days=self.days_in_memory)).isoformat(),
+                                                    'last': date.today().isoformat()})
+
+    def _tree_size(self, sizes: Dict[str, int], address_family: str, announces_date: str) -> int:
+        if announces_date in sizes:
+            return sizes[announces_date]
+        if sizes:
+            # Consecutive dates have about the same size.
+            return max(sizes.values())
+        return DEFAULT_TREE_SIZE[address_family]
+
+    def schedule(self, source: str):
+        '''Assign the dates to the running lookup processes of a source.'''
+        workers = [worker for worker, p in self.running_processes[source].items() if p.poll() is None]
+        if not workers:
+            return
+        reports = self._reports(source)
+        free = {worker: self.worker_budget - reports.get(worker, {}).get('baseline', 0) for worker in workers}
+        current = {worker: self.cache.smembers(f'assignment|{source}|{worker}') for worker in workers}
+        assignment: Dict[str, Set[str]] = {worker: set() for worker in workers}
+
+        sizes: Dict[str, Dict[str, int]] = {}
+        hits: List[Tuple[float, str, str]] = []
+        dates: List[Tuple[str, str]] = []
+        for address_family in ['v4', 'v6']:
+            sizes[address_family] = {d: int(size) for d, size in self.cache.hgetall(f'tree_sizes|{source}|{address_family}').items()}
+            dates += [(d, address_family) for d in self.storagedb.smembers(f'{source}|{address_family}|dates')]
+            hits += [(score, d, address_family) for d, score in self.cache.zrange(f'hits|{source}|{address_family}', 0, -1, withscores=True)]
+
+        # With shared snapshots, the memory of a date is charged once, to the host.
+        shared_free = sum(free.values())
+
+        def place(entry: str, size: int, count: int, at_least: int) -> int:
+            nonlocal shared_free
+            shared_size = 0
+            if self.shared_snapshots:
+                # The first copy uses memory on the host, the other ones map the same pages.
+                placed = any(entry in assigned for assigned in assignment.values())
+                shared_size, size = (0 if placed else size), 0
+                if shared_size > shared_free:
+                    return 0
+            # The processes already having the date first, to avoid reloading it somewhere else.
+            candidates = sorted((worker for worker in workers if entry not in assignment[worker] and free[worker] >= size),
+                                key=lambda worker: (entry not in current[worker], -free[worker]))[:count]
+            if len(candidates) < at_least:
+                return 0
+            for worker in candidates:
+                assignment[worker].add(entry)
+                free[worker] -= size
+            shared_free -= shared_size
+            return len(candidates)
+
+        # The most recent dates, with all their replicas
+        replicas = min(self.replicas, len(workers))
+        for announces_date, address_family in sorted(dates, reverse=True):
+            if not place(f'{address_family}|{announces_date}', self._tree_size(sizes[address_family], address_family, announces_date),
+                         replicas, replicas):
+                self.logger.info(f'{source}: no room for {announces_date} ({address_family}) and the older dates.')
+                break
+        # The memory left goes to the most queried dates
+        for _, announces_date, address_family in sorted(hits, reverse=True):
+            entry = f'{address_family}|{announces_date}'
+            if any(entry in assigned for assigned in assignment.values()):
+                place(entry, self._tree_size(sizes[address_family], address_family, announces_date), len(workers), 1)
+
+        # Warm handover: a process keeps the dates it loses until their new holders and itself are ready.
+        loaded = {worker: self.cache.smembers(f'loaded|{source}|{worker}') for worker in workers}
+        stored = {f'{address_family}|{announces_date}' for announces_date, address_family in dates}
+        ready = {worker: not (assignment[worker] & stored) - loaded[worker] for worker in workers}
+        for worker in workers:
+            for entry in (current[worker] - assignment[worker]) & loaded[worker]:
+                if not ready[worker] or any(entry in assignment[w] and entry not in loaded[w] for w in workers):
+                    assignment[worker].add(entry)
+
+        p = self.cache.pipeline()
+        for worker, assigned in assignment.items():
+            if assigned == current[worker]:
+                continue
+            p.delete(f'assignment|{source}|{worker}')
+            if assigned:
+                p.sadd(f'assignment|{source}|{worker}', *assigned)
+        for address_family in ['v4', 'v6']:
+            # The older queries count less and less
+            p.zunionstore(f'hits|{source}|{address_family}', {f'hits|{source}|{address_family}': 0.9})
+            p.zremrangebyscore(f'hits|{source}|{address_family}', 0, 1)
+        p.execute()
 
     def _cleanup_cached_dates(self):
-        """Remove from '{source}|v4|cached_dates' and {source}|v6|cached_dates the dates that aren't cached anymore"""
-        oldest_date = (date.today() - timedelta(days=self.days_in_memory)).isoformat()
+        """Remove from '{source}|v4|cached_dates' and {source}|v6|cached_dates the dates no running lookup process has loaded or is loading"""
         for source in self.sources:
+            loaded = set()
+            for worker, p in self.running_processes[source].items():
+                if p.poll() is None:
+                    loaded |= self.cache.smembers(f'loaded|{source}|{worker}')
+                    loaded |= self.cache.smembers(f'assignment|{source}|{worker}')
             for address_family in ['v4', 'v6']:
                 key = f'{source}|{address_family}|cached_dates'
                 cached_dates = self.cache.smembers(key)
-                to_remove = [date for date in cached_dates if date < oldest_date]
+                to_remove = [d for d in cached_dates if f'{address_family}|{d}' not in loaded]
                 if to_remove:
                     self.cache.srem(key, *to_remove)
+                    self.cache.incr(f'{key}_version')
+                    self.cache.delete(*[queue_key(source, address_family, d) for d in to_remove])
+
+    def _cleanup_snapshots(self):
+        """Remove the snapshots of the dates that aren't in the storage anymore"""
+        for source in self.sources:
+            for address_family in ['v4', 'v6']:
+                snapshots_dir = get_snapshot_dir() / source / address_family
+                if not snapshots_dir.exists():
+                    continue
+                stored_dates = self.storagedb.smembers(f'{source}|{address_family}|dates')
+                for snapshot in snapshots_dir.iterdir():
+                    if snapshot.name.startswith('.'):
+                        # Being written
+                        continue
+                    if snapshot.name not in stored_dates:
+                        # The processes still using it keep their mapping.
+                        snapshot.unlink()
 
     def _to_run_forever(self):
-        # Check the processes are running, respawn if needed
-        # Kill the processes with old data to clear memory
         for source in self.sources:
-            first_loop = True
-            for p, first, last in sorted(self.running_processes[source], key=lambda tup: tup[2], reverse=True):
-                if first_loop:
-                    first_loop = False
-                    if last < (date.today() + timedelta(self.floating_window_days / 2)):
-                        new_first = date.today()
-                        new_last = date.today() + timedelta(days=self.floating_window_days)
-                        new_p = Popen(['lookup', source, new_first.isoformat(), new_last.isoformat()])
-                        self.running_processes[source].append((new_p, new_first, new_last))
-                if last < (date.today() - timedelta(days=self.days_in_memory)):
-                    p.kill()
-                elif p.poll():
-                    logging.warning(f'Lookup process died: {first} {last}')
-                    # FIXME - maybe: respawn a dead process?
-            # Cleanup the process list
-            self.running_processes[source] = [process for process in self.running_processes[source] if process[0].poll() is None]
+            self.supervise(source)
+            self.schedule(source)
 
-        self.cache.hmset('META:expected_interval', {'first': (date.today() - timedelta(days=self.days_in_memory)).isoformat(),
-                                                    'last': date.today().isoformat()})
+        self._update_expected_interval()
         self._cleanup_cached_dates()
+        self._cleanup_snapshots()
 
 
 def main():
@@ -112,7 +234,7 @@ def main():
     parser.parse_args()
 
     lookup = LookupManager()
-    lookup.run(sleep_in_sec=3600)
+    lookup.run(sleep_in_sec=10)
 
 
 if __name__ == '__main__':
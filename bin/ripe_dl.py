@@ -5,10 +5,15 @@ import logging
 from dateutil.relativedelta import relativedelta
 import asyncio
 from datetime import date, timedelta
+from typing import List, Set
+
 import aiohttp
+from redis import Redis
 
 from ipasnhistory.default import AbstractManager, safe_create_dir, get_config
+from ipasnhistory.download import download_file
 from ipasnhistory.helpers import get_data_dir
+from ipasnhistory.manifest import Manifest
 
 logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s:%(message)s',
                     level=logging.INFO)
@@ -19,10 +24,15 @@ class RipeDownloader(AbstractManager):
     def __init__(self, loglevel: int=logging.INFO):
         super().__init__(loglevel)
         self.script_name = "ripe_downloader"
-        self.collector = 'rrc00'
-        self.hours = ['0000']
+        self.collectors = get_config('generic', 'ripe_collectors')
+        self.hours = get_config('generic', 'ripe_hours')
+        self.max_concurrent_downloads = get_config('generic', 'max_concurrent_downloads')
         self.url = 'http://data.ris.ripe.net/{}'
         self.storage_root = get_data_dir()
+        self.manifest = Manifest(Redis(get_config('generic', 'storage_db_hostname'), get_config('generic', 'storage_db_port'),
+                                       decode_responses=True), 'ripe')
+        # Failed downloads, tried again with the next ones
+        self.to_retry: Set[str] = set()
 
     async def _to_run_forever_async(self):
         try:
@@ -30,6 +40,16 @@ class RipeDownloader(AbstractManager):
         except aiohttp.client_exceptions.ClientConnectorError as e:
             self.logger.critical(f'Error while fetching a routeview file: {e}')
 
+    def _session(self) -> aiohttp.ClientSession:
+        # All the downloads share the connections of one session, the connector limits the concurrency.
+        # No total timeout (the dumps are big), but a stalled connection doesn't block forever.
+        return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_concurrent_downloads),
+                                     timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=300))
+
+    def _paths(self, day: date) -> List[str]:
+        return [f'{collector}/{day:%Y.%m}/bview.{day:%Y%m%d}.{hour}.gz'
+                for collector in self.collectors for hour in self.hours]
+
     async def download_routes(self, session: aiohttp.ClientSession, path: str) -> None:
         store_path = self.storage_root / 'ripe' / path
         if store_path.exists():
@@ -37,39 +57,47 @@ class RipeDownloader(AbstractManager):
             return
         self.logger.info(f'New file to download: {path}')
         safe_create_dir(store_path.parent)
-        async with session.get(self.url.format(path)) as r:
-            self.logger.debug(f'Starting {self.url.format(path)}')
-            if r.status != 200:
-                self.logger.info(f'Unreachable: {self.url.format(path)}')
-                return
-            content = await r.read()
-            if not content.startswith(b'\x1f\x8b'):
-                # Not a gzip file, skip.
-                print(content[:2])
-            with open(store_path, 'wb') as f:
-                f.write(content)
+        if await download_file(session, self.url.format(path), store_path, self.logger):
+            self.manifest.add(store_path)
             self.logger.info(f'File downloaded: {path}')
 
+    async def _download(self, session: aiohttp.ClientSession, path: str, sem: asyncio.Semaphore) -> None:
+        try:
+            await self.download_routes(session, path)
+            self.to_retry.discard(path)
+        except Exception as e:
+            self.logger.warning(f'Unable to download {path}: {e}')
+            self.to_retry.add(path)
+        finally:
+            sem.release()
+
+    async def _download_all(self, paths: List[str]) -> None:
+        # Only max_concurrent_downloads tasks at a time, not one per path.
+        sem = asyncio.Semaphore(self.max_concurrent_downloads)
+        tasks = []
+        async with self._session() as session:
+            for path in paths:
+                await sem.acquire()
+                tasks.append(asyncio.create_task(self._download(session, path, sem)))
+            await asyncio.gather(*tasks)
+
+    def _interrupted(self) -> List[str]:
+        '''Paths of the partial downloads.'''
+        root = self.storage_root / 'ripe'
+        return [str(part_path.relative_to(root))[:-len('.part')] for part_path in root.glob('*/*/*.part')]
+
     async def find_routes(self, first_date: date, last_date: date=date.today()) -> None:
+        paths = []
         cur_date = last_date
-        sem = asyncio.Semaphore(2)
-        async with aiohttp.ClientSession() as session:
-            while cur_date >= first_date:
-                for hour in self.hours:
-                    path = f'{self.collector}/{cur_date:%Y.%m}/bview.{cur_date:%Y%m%d}.{hour}.gz'
-                    async with sem:
-                        await self.download_routes(session, path)
-                cur_date -= timedelta(days=1)
+        while cur_date >= first_date:
+            paths += self._paths(cur_date)
+            cur_date -= timedelta(days=1)
+        await self._download_all(paths)
 
     async def download_latest(self) -> None:
         self.logger.debug('Search for new routes.')
-        cur_date = date.today()
-        async with aiohttp.ClientSession() as session:
-            for hour in self.hours:
-                path = f'{self.collector}/{cur_date:%Y.%m}/bview.{cur_date:%Y%m%d}.{hour}.gz'
-                await self.download_routes(session, path)
-            else:
-                self.logger.debug('No new routes.')
+        paths = self._paths(date.today()) + sorted(self.to_retry) + self._interrupted()
+        await self._download_all(list(dict.fromkeys(paths)))
 
 
 def main():
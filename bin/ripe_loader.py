@@ -3,58 +3,45 @@
 import logging
 import re
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from ipaddress import ip_network
 from pathlib import Path
-from typing import Dict, List, Any
+from typing import Callable, Dict, List, Tuple
 
 from redis import Redis
 
-from bgpdumpy import TableDumpV2, BGPDump  # type: ignore
-from socket import AF_INET
-
-
 from ipasnhistory.default import AbstractManager, get_socket_path, get_config
-from ipasnhistory.helpers import get_data_dir
+from ipasnhistory.mrt import routes
+from ipasnhistory.helpers import dates_stream_key
+from ipasnhistory.ingest import AnnouncesWriter, run_chains
+from ipasnhistory.manifest import LOADED, SKIPPED, Manifest
+from ipasnhistory.storage import storage_layout
 
 logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s:%(message)s',
                     level=logging.INFO)
 
 
-def routeview(bview_file: Path):
-
-    routes: Dict[str, List] = {'v4': [], 'v6': []}
-
-    with BGPDump(bview_file) as bgp:
-
-        for entry in bgp:
-
-            # entry.body can be either be TableDumpV1 or TableDumpV2
-
-            if not isinstance(entry.body, TableDumpV2):
-                continue  # I expect an MRT v2 table dump file
-
-            # get a string representation of this prefix
-            prefix = f'{entry.body.prefix}/{entry.body.prefixLength}'
-
-            # get a list of each unique originating ASN for this prefix
-            all_paths = [[asn for asn in route.attr.asPath.split()] for route in entry.body.routeEntries]
-
-            # Cleanup the AS Sets
-            for asn in reversed(all_paths[-1]):
-                if asn.isnumeric():
-                    best_as = asn
-                    break
-                elif asn[1:-1].isnumeric():
-                    best_as = asn[1:-1]
-                    break
-
-            if entry.body.afi == AF_INET:
-                routes['v4'].append((prefix, best_as))
-            else:
-                routes['v6'].append((prefix, best_as))
-
-        return routes
+def load_bview(path: Path, key_prefix: str, date: str, processes: int=1) -> bool:
+    '''Import a RIB dump in the storage. Returns False if the dump is unusable (broken or incomplete).'''
+    storagedb = Redis(get_config('generic', 'storage_db_hostname'), get_config('generic', 'storage_db_port'), decode_responses=True)
+    writers = {address_family: AnnouncesWriter(storagedb, key_prefix, address_family, date)
+               for address_family in ['v4', 'v6']}
+    try:
+        for address_family, network, length, asn in routes(path, processes):
+            writers[address_family].add(asn, network, length)
+        if not all(writers.values()):
+            # No routes for at least one address family
+            for writer in writers.values():
+                writer.discard()
+            return False
+        for writer in writers.values():
+            writer.finish()
+    except Exception:
+        # Don't leave a partial date in the storage
+        for writer in writers.values():
+            writer.discard()
+        raise
+    return True
 
 
 class RipeLoader(AbstractManager):
@@ -62,75 +49,103 @@ class RipeLoader(AbstractManager):
     def __init__(self, loglevel: int=logging.INFO):
         super().__init__(loglevel)
         self.script_name = "ripe_loader"
-        self.collector = 'rrc00'
-        self.key_prefix = f'ripe_{self.collector}'
-        self.storage_root = get_data_dir() / 'ripe' / self.collector
+        self.collectors = get_config('generic', 'ripe_collectors')
         self.storagedb = Redis(get_config('generic', 'storage_db_hostname'),
                                get_config('generic', 'storage_db_port'), decode_responses=True)
-        self.storagedb.sadd('prefixes', self.key_prefix)
+        self.storagedb.sadd('prefixes', *[self._key_prefix(collector) for collector in self.collectors])
         self.cache = Redis(unix_socket_path=get_socket_path('cache'), decode_responses=True)
+        self.loader_processes = get_config('generic', 'loader_processes')
+        self.manifest = Manifest(self.storagedb, 'ripe')
+        self.manifest.bootstrap()
 
     def _to_run_forever(self):
-        self.load_all()
+        # Returns as soon as the downloader notifies a new file.
+        self.load_all(self.manifest.wait(timeout=10))
 
-    def already_loaded(self, date: str) -> bool:
-        return (self.storagedb.sismember(f'{self.key_prefix}|v4|dates', date)
-                and self.storagedb.sismember(f'{self.key_prefix}|v6|dates', date))
+    def _key_prefix(self, collector: str) -> str:
+        return f'ripe_{collector}'
 
-    def update_last(self, address_family: str, date: str) -> None:
-        cur_last = self.storagedb.get(f'{self.key_prefix}|{address_family}|last')
-        if not cur_last or date > cur_last:
-            self.storagedb.set(f'{self.key_prefix}|{address_family}|last', date)
+    def already_loaded(self, key_prefix: str, date: str) -> bool:
+        return (self.storagedb.sismember(f'{key_prefix}|v4|dates', date)
+                and self.storagedb.sismember(f'{key_prefix}|v6|dates', date))
 
-    def load_all(self):
-        for path in sorted(self.storage_root.glob('**/*.gz'), reverse=True):
+    def update_last(self, key_prefix: str, address_family: str, date: str) -> None:
+        cur_last = self.storagedb.get(f'{key_prefix}|{address_family}|last')
+        if not cur_last or date > cur_last:
+            self.storagedb.set(f'{key_prefix}|{address_family}|last', date)
+        # Tell the lookup processes
+        self.cache.xadd(dates_stream_key(key_prefix), {'address_family': address_family, 'date': date},
+                        maxlen=1000, approximate=True)
+
+    def _to_load(self, paths: List[Path]) -> List[Tuple[Path, str, str]]:
+        to_load = []
+        oldest_to_load = self.cache.hget('META:expected_interval', 'first')
+        for path in sorted(paths, reverse=True):
+            collector = path.relative_to(self.manifest.root).parts[0]
+            if collector not in self.collectors:
+                self.manifest.set_state(path, SKIPPED)
+                continue
+            key_prefix = self._key_prefix(collector)
             date_str = re.findall('.*/bview.(.*).gz', str(path))[0]
             date = datetime.strptime(date_str, '%Y%m%d.%H%M').isoformat()
 
-            oldest_to_load = self.cache.hget('META:expected_interval', 'first')
             if oldest_to_load and oldest_to_load > date:
                 # The RIPE dump we're trying to load is older than the oldest date we want to cache, skipping.
+                self.manifest.set_state(path, SKIPPED)
                 continue
 
-            if self.already_loaded(date):
+            if self.already_loaded(key_prefix, date):
                 self.logger.debug(f'Already loaded {path}')
+                self.manifest.set_state(path, LOADED)
                 continue
+            to_load.append((path, key_prefix, date))
+        return to_load
+
+    def load_all(self, paths: List[Path]):
+        to_load = self._to_load(paths)
+        if len(to_load) == 1:
+            # Only one dump: its chunks are parsed in parallel instead.
+            path, key_prefix, date = to_load[0]
             self.logger.info(f'Loading {path}')
-            try:
-                routes = routeview(path)
-            except Exception:
-                self.logger.exception(f'Unable to load routes for {path}.')
-                path.unlink()
-            self.logger.info('Content loaded')
-            for address_family, entries in routes.items():
-                if not entries:
-                    # the file is broken
-                    break
-                to_import: Dict[str, Any] = defaultdict(lambda: {address_family: set(), 'ipcount': 0})
-                for prefix, asn in entries:
-                    network = ip_network(prefix)
-                    to_import[asn][address_family].add(str(network))
-                    to_import[asn]['ipcount'] += network.num_addresses
-                p = self.storagedb.pipeline()
-                self.storagedb.sadd(f'{self.key_prefix}|{address_family}|dates', date)
-                self.storagedb.sadd(f'{self.key_prefix}|{address_family}|{date}|asns', *to_import.keys())  # Store all ASNs
-                for asn, data in to_import.items():
-                    p = self.storagedb.pipeline()
-                    p.sadd(f'{self.key_prefix}|{address_family}|{date}|{asn}', *data[address_family])  # Store all prefixes
-                    p.set(f'{self.key_prefix}|{address_family}|{date}|{asn}|ipcount', data['ipcount'])  # Total IPs for the AS
-                    p.execute()
+            self._loaded(path, key_prefix, date, lambda: load_bview(path, key_prefix, date, self.loader_processes))
+        elif to_load:
+            # The dumps are loaded in parallel, one per process.
+            if storage_layout() == 'delta':
+                # Each date is the diff with the previous one: oldest first, one at a time per collector.
+                chains: Dict[str, List[Tuple[Path, str, str]]] = defaultdict(list)
+                for path, key_prefix, date in sorted(to_load, key=lambda entry: entry[2]):
+                    chains[key_prefix].append((path, key_prefix, date))
+                ordered = list(chains.values())
             else:
-                self.logger.debug('All keys ready')
-                self.update_last(address_family, date)
-                self.logger.info(f'Done with {path}')
-                continue
-            # the file has invalid entries, delete it and expect to have it re-downloaded later
+                ordered = [[entry] for entry in to_load]
+            for path, key_prefix, date in to_load:
+                self.logger.info(f'Loading {path}')
+            with ProcessPoolExecutor(self.loader_processes) as executor:
+                for (path, key_prefix, date), future in run_chains(executor, load_bview, ordered):
+                    self._loaded(path, key_prefix, date, future.result)
+
+    def _loaded(self, path: Path, key_prefix: str, date: str, result: Callable[[], bool]) -> None:
+        try:
+            imported = result()
+        except Exception:
+            self.logger.exception(f'Unable to load routes for {path}.')
+            imported = False
+        if not imported:
+            # the file is broken, delete it and expect to have it re-downloaded later
+            self.logger.warning(f'Unusable dump, removing {path}.')
             path.unlink()
+            self.manifest.remove(path)
+            return
+        for address_family in ['v4', 'v6']:
+            self.update_last(key_prefix, address_family, date)
+        self.manifest.set_state(path, LOADED)
+        self.logger.info(f'Done with {path}')
 
 
 def main():
     m = RipeLoader()
-    m.run(sleep_in_sec=30)
+    # No need to sleep, the loader waits for the notifications of the downloader.
+    m.run(sleep_in_sec=0)
 
 
 if __name__ == '__main__':
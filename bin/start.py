@@ -21,6 +21,8 @@ def main():
     Popen(['ripe_downloader'])
     Popen(['ripe_loader'])
 
+    Popen(['storage_compactor'])
+
     print('Start website...')
     Popen(['start_website'])
     print('done.')
@@ -2,6 +2,7 @@
 
 import logging
 from subprocess import Popen
+from typing import List
 
 from ipasnhistory.default import AbstractManager
 from ipasnhistory.default import get_config, get_homedir
@@ -10,6 +11,16 @@ logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s:%(message)s',
                     level=logging.INFO)
 
 
+def gunicorn_command(app: str, bind: str, timeout: int=300) -> List[str]:
+    # gthread: the worker keeps sending its heartbeat while a request is streamed (/bulk_query can run for
+    # longer than the timeout). One thread, the workers still run one request at a time.
+    return ['gunicorn', '-w', '10', '-k', 'gthread', '--threads', '1',
+            '--graceful-timeout', '2', '--timeout', str(timeout),
+            '-b', bind,
+            '--log-level', 'info',
+            app]
+
+
 class Website(AbstractManager):
 
     def __init__(self, loglevel: int=logging.INFO):
@@ -22,12 +33,15 @@ class Website(AbstractManager):
         website_dir = get_homedir() / 'website'
         ip = get_config('generic', 'website_listen_ip')
         port = get_config('generic', 'website_listen_port')
-        return Popen(['gunicorn', '-w', '10',
-                      '--graceful-timeout', '2', '--timeout', '300',
-                      '-b', f'{ip}:{port}',
-                      '--log-level', 'info',
-                      'web:app'],
-                     cwd=website_dir)
+        if get_config('generic', 'website_asgi'):
+            # A single process, the queries wait for the lookups without blocking it.
+            return Popen(['uvicorn',
+                          '--timeout-graceful-shutdown', '2',
+                          '--host', ip, '--port', str(port),
+                          '--log-level', 'info',
+                          'asgi:app'],
+                         cwd=website_dir)
+        return Popen(gunicorn_command('web:app', f'{ip}:{port}'), cwd=website_dir)
 
 
 def main():
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import logging
+
+from datetime import date, timedelta
+from typing import Dict, Optional, Set
+
+from redis import Redis
+
+from ipasnhistory.default import AbstractManager, get_config
+from ipasnhistory.storage import (Announce, base_date, delete_date, delete_full, depth, read_table,
+                                  storage_layout, write_checkpoint, write_delta)
+
+logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s:%(message)s',
+                    level=logging.INFO)
+
+
+class StorageCompactor(AbstractManager):
+    '''Removes the dates older than the retention from the storage, and with the delta layout,
+    stores the full dates (imported before it was enabled, or without a previous date) as diffs, and
+    the diffs too far from their checkpoint as checkpoints.'''
+
+    def __init__(self, loglevel: int=logging.INFO):
+        super().__init__(loglevel)
+        self.script_name = "storage_compactor"
+        self.storagedb = Redis(get_config('generic', 'storage_db_hostname'), get_config('generic', 'storage_db_port'), decode_responses=True)
+        self.retention_days = get_config('generic', 'storage_retention_days')
+        self.checkpoint_interval = get_config('generic', 'delta_checkpoint_interval')
+
+    def _to_run_forever(self):
+        for source in self.storagedb.smembers('prefixes'):
+            for address_family in ['v4', 'v6']:
+                self.expire(source, address_family)
+                if storage_layout() == 'delta':
+                    self.compact(source, address_family)
+
+    def _chain(self, source: str, address_family: str, announces_date: str) -> Set[str]:
+        '''All the dates a date depends on.'''
+        chain = set()
+        base = base_date(self.storagedb, source, address_family, announces_date)
+        while base:
+            chain.add(base)
+            base = base_date(self.storagedb, source, address_family, base)
+        return chain
+
+    def expire(self, source: str, address_family: str) -> None:
+        if not self.retention_days:
+            return
+        oldest = (date.today() - timedelta(days=self.retention_days)).isoformat()
+        dates = sorted(self.storagedb.smembers(f'{source}|{address_family}|dates'))
+        expired = {d for d in dates if d < oldest}
+        if not expired:
+            return
+        for announces_date in dates:
+            if announces_date in expired:
+                continue
+            if self._chain(source, address_family, announces_date) & expired:
+                # Fold the diffs into a new checkpoint before removing what they are based on.
+                self.logger.info(f'Checkpoint {source} {address_family} {announces_date}')
+                write_checkpoint(self.storagedb, source, address_family, announces_date,
+                                 read_table(self.storagedb, source, address_family, announces_date))
+        for announces_date in sorted(expired):
+            self.logger.info(f'Remove {source} {address_family} {announces_date}')
+            delete_date(self.storagedb, source, address_family, announces_date)
+
+    def compact(self, source: str, address_family: str) -> None:
+        previous: Optional[str] = None
+        # Only keep the table of the previous date, the dates are processed in order.
+        tables: Dict[str, Set[Announce]] = {}
+        for announces_date in sorted(self.storagedb.smembers(f'{source}|{address_family}|dates')):
+            diffs = depth(self.storagedb, source, address_family, announces_date)
+            if diffs >= self.checkpoint_interval:
+                self.logger.info(f'Checkpoint {source} {address_family} {announces_date}')
+                tables = {announces_date: read_table(self.storagedb, source, address_family, announces_date)}
+                write_checkpoint(self.storagedb, source, address_family, announces_date, tables[announces_date])
+            elif (not diffs and previous is not None
+                    and depth(self.storagedb, source, address_family, previous) + 1 < self.checkpoint_interval):
+                if previous not in tables:
+                    tables = {previous: read_table(self.storagedb, source, address_family, previous)}
+                table = read_table(self.storagedb, source, address_family, announces_date)
+                self.logger.info(f'Store {source} {address_family} {announces_date} as a diff with {previous}')
+                write_delta(self.storagedb, source, address_family, announces_date, table, previous, tables[previous])
+                delete_full(self.storagedb, source, address_family, announces_date)
+                tables = {announces_date: table}
+            previous = announces_date
+
+
+def main():
+    m = StorageCompactor()
+    m.run(sleep_in_sec=3600)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+import csv
+import io
+import json
+
+from typing import AsyncIterator, Dict, Iterable, Iterator, List, Optional
+
+# Fields of the queries, and of each response in the CSV output
+QUERY_FIELDS = ['ip', 'source', 'address_family', 'date', 'first', 'last', 'precision_delta']
+RESPONSE_FIELDS = ['announce_date', 'asn', 'prefix', 'error']
+
+
+def is_csv(content_type: Optional[str]) -> bool:
+    '''The bulk requests are NDJSON, unless sent as CSV (text/csv).'''
+    return content_type is not None and content_type.split(';')[0].strip() == 'text/csv'
+
+
+class BulkReader():
+    '''The queries of a bulk request, one per line: NDJSON (same fields as in mass_query), or CSV with
+    a header (the columns are the fields of the queries, ip is mandatory).
+
+    The reading stops at the first invalid line, the error is kept in error.'''
+
+    def __init__(self, csv_format: bool):
+        self.csv_format = csv_format
+        self.header: Optional[List[str]] = None
+        self.error: Optional[str] = None
+        self.line_number = 0
+
+    def parse(self, line: str) -> Optional[Dict]:
+        '''The query of the line, None for the empty lines and the header.'''
+        self.line_number += 1
+        line = line.strip()
+        if not line:
+            return None
+        if not self.csv_format:
+            query = json.loads(line)
+            if not isinstance(query, dict):
+                raise ValueError('Not a JSON object.')
+        else:
+            row = next(csv.reader([line]))
+            if self.header is None:
+                self.header = row
+                if 'ip' not in self.header:
+                    raise ValueError('The header must contain an ip column.')
+                return None
+            query = {field: value for field, value in zip(self.header, row) if value}
+        if isinstance(query.get('precision_delta'), str):
+            query['precision_delta'] = json.loads(query['precision_delta'])
+        return query
+
+    def queries(self, lines: Iterable[str]) -> Iterator[Dict]:
+        try:
+            for line in lines:
+                if (query := self.parse(line)) is not None:
+                    yield query
+        except ValueError as e:
+            self.error = f'Line {self.line_number}: {e}'
+
+    async def aqueries(self, lines: AsyncIterator[str]) -> AsyncIterator[Dict]:
+        try:
+            async for line in lines:
+                if (query := self.parse(line)) is not None:
+                    yield query
+        except ValueError as e:
+            self.error = f'Line {self.line_number}: {e}'
+
+
+class BulkWriter():
+    '''The responses of a bulk request, as they come: NDJSON (same as the responses in mass_query),
+    or CSV with one line per date in the response (the fields of the query, then the response).'''
+
+    def __init__(self, csv_format: bool):
+        self.csv_format = csv_format
+        self.mimetype = 'text/csv' if csv_format else 'application/x-ndjson'
+
+    def _csv_line(self, row: List) -> str:
+        line = io.StringIO()
+        csv.writer(line).writerow(row)
+        return line.getvalue()
+
+    def header(self) -> str:
+        return self._csv_line(QUERY_FIELDS + RESPONSE_FIELDS) if self.csv_format else ''
+
+    def format(self, response: Dict) -> str:
+        if not self.csv_format:
+            return json.dumps(response) + '\n'
+        query = [json.dumps(value) if isinstance(value, dict) else value
+                 for value in (response['meta'].get(field, '') for field in QUERY_FIELDS)]
+        if 'error' in response or not response['response']:
+            return self._csv_line(query + ['', '', '', response.get('error', '')])
+        return ''.join(self._csv_line(query + [announce_date, data.get('asn', ''), data.get('prefix', ''), data.get('error', '')])
+                       for announce_date, data in response['response'].items())
+
+    def error(self, error: str) -> str:
+        '''Last line, if the request couldn't be read entirely.'''
+        if not self.csv_format:
+            return json.dumps({'error': error}) + '\n'
+        return self._csv_line([''] * (len(QUERY_FIELDS) + len(RESPONSE_FIELDS) - 1) + [error])
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import calendar
+
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Union
+
+from dateutil.parser import parse
+
+
+@lru_cache(1024)
+def _parse_timestamp(date: str) -> int:
+    # The same dates are queried over and over, and parsing is by far the most expensive part.
+    return calendar.timegm(parse(date).utctimetuple())
+
+
+def to_timestamp(date: Union[str, datetime]) -> int:
+    '''Seconds since epoch. Naive datetimes are considered as UTC, TZ aware ones are converted to UTC.'''
+    if isinstance(date, str):
+        return _parse_timestamp(date)
+    return calendar.timegm(date.utctimetuple())
+
+
+class DateIndex():
+    '''Sorted dates available for a source / address family, the lookups are binary searches.
+    The dates are returned exactly as they are stored (they are part of the cache keys).'''
+
+    def __init__(self, source: str, address_family: str):
+        self.source = source
+        self.address_family = address_family
+        self.timestamps: List[int] = []
+        self.dates: List[str] = []
+        # Opaque value set by the owner of the index to know when it has to be updated.
+        self.version: Optional[str] = None
+        self.last_check: Optional[datetime] = None
+
+    def __len__(self) -> int:
+        return len(self.dates)
+
+    def update(self, dates: Iterable[str]) -> None:
+        '''Set the dates in the index, only the ones added since the last update are parsed.'''
+        new_dates = set(dates)
+        current_dates = set(self.dates)
+        for d in current_dates - new_dates:
+            i = self.dates.index(d)
+            del self.dates[i]
+            del self.timestamps[i]
+        for d in new_dates - current_dates:
+            ts = to_timestamp(d)
+            i = bisect_right(self.timestamps, ts)
+            self.timestamps.insert(i, ts)
+            self.dates.insert(i, d)
+
+    def nearest(self, date: Union[str, datetime], precision_delta: Optional[Dict[str, int]]=None) -> str:
+        if not self.dates:
+            raise Exception(f'No route views have been loaded for {self.source} / {self.address_family} yet.')
+        target = to_timestamp(date)
+        i = bisect_left(self.timestamps, target)
+        if i == 0:
+            nearest = 0
+        elif i == len(self.timestamps):
+            nearest = i - 1
+        elif target - self.timestamps[i - 1] <= self.timestamps[i] - target:
+            nearest = i - 1
+        else:
+            nearest = i
+        if precision_delta:
+            delta = timedelta(**precision_delta).total_seconds()
+            if abs(self.timestamps[nearest] - target) > delta:
+                min_date = datetime.fromtimestamp(target - delta, timezone.utc).replace(tzinfo=None)
+                max_date = datetime.fromtimestamp(target + delta, timezone.utc).replace(tzinfo=None)
+                raise Exception(f'Unable to find a date in the expected interval: {min_date.isoformat()} -> {max_date.isoformat()} for {self.source}.')
+        return self.dates[nearest]
+
+    def interval(self, first: str, last: Optional[str]=None) -> List[str]:
+        if not last:
+            last = datetime.now().isoformat()
+        first_ts = to_timestamp(first)
+        last_ts = to_timestamp(last)
+        if first_ts > last_ts:
+            raise Exception(f'The first date of the interval ({first}) has to be before the last one ({last})...')
+        dates = self.dates[bisect_left(self.timestamps, first_ts):bisect_right(self.timestamps, last_ts)]
+        if not dates:
+            raise Exception(f'No data available in the given interval: {first} -> {last}. Nearest data to first: {self.nearest(first)}, nearest data to last: {self.nearest(last)} ')
+        return dates
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+'''Download of the raw files, shared by the downloaders.'''
+
+import logging
+import os
+
+from pathlib import Path
+from typing import Optional
+
+import aiohttp
+
+
+def _validator(r: aiohttp.ClientResponse) -> Optional[str]:
+    '''Identifies the version of the remote file in If-Range: a strong ETag, or the Last-Modified date.'''
+    etag = r.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return r.headers.get('Last-Modified')
+
+
+async def download_file(session: aiohttp.ClientSession, url: str, store_path: Path, logger: logging.Logger) -> bool:
+    '''Download url in store_path, returns True if it is done (and it is a gzip file).
+
+    The file is downloaded in store_path.part, renamed when complete: the loaders never see a partial file.
+    An interrupted download is resumed only if the remote file is still the same (If-Range with the
+    validator of the first response), otherwise the server sends the whole file again.'''
+    part_path = store_path.with_name(f'{store_path.name}.part')
+    validator_path = store_path.with_name(f'{store_path.name}.part.validator')
+    headers = {}
+    size = part_path.stat().st_size if part_path.exists() else 0
+    validator = validator_path.read_text() if size and validator_path.exists() else None
+    if validator:
+        headers['Range'] = f'bytes={size}-'
+        headers['If-Range'] = validator
+    async with session.get(url, headers=headers) as r:
+        if r.status == 416 and r.headers.get('Content-Range') == f'bytes */{size}':
+            # The partial file was already complete.
+            pass
+        elif r.status == 416 or (r.status == 206 and (not r.headers.get('Content-Range', '').startswith(f'bytes {size}-')
+                                                      or _validator(r) not in [None, validator])):
+            # The partial file is not a prefix of the remote one (anymore), start over.
+            # Also checked here, some servers ignore If-Range.
+            part_path.unlink(missing_ok=True)
+            validator_path.unlink(missing_ok=True)
+            return await download_file(session, url, store_path, logger)
+        elif r.status not in [200, 206]:
+            logger.info(f'Unreachable ({r.status}): {url}')
+            return False
+        else:
+            if r.status == 200:
+                # The whole file: there was no range, or the remote file changed since the partial download.
+                validator = _validator(r)
+                if validator:
+                    validator_path.write_text(validator)
+                else:
+                    validator_path.unlink(missing_ok=True)
+            with part_path.open('ab' if r.status == 206 else 'wb') as f:
+                async for chunk in r.content.iter_chunked(1024 * 1024):
+                    f.write(chunk)
+    validator_path.unlink(missing_ok=True)
+    with part_path.open('rb') as f:
+        if f.read(2) != b'\x1f\x8b':
+            logger.warning(f'Not a gzip file: {url}')
+            part_path.unlink()
+            return False
+    os.replace(part_path, store_path)
+    return True
@@ -1,6 +1,11 @@
 #!/usr/bin/env python3
+import os
+
 from functools import lru_cache
+from ipaddress import IPv4Address, IPv6Address
 from pathlib import Path
+from socket import AF_INET, AF_INET6, inet_ntop, inet_pton
+from typing import Dict, Optional, Tuple
 
 from .default import get_homedir, safe_create_dir
 
@@ -10,3 +15,94 @@ def get_data_dir() -> Path:
     capture_dir = get_homedir() / 'rawdata'
     safe_create_dir(capture_dir)
     return capture_dir
+
+
+def get_rss() -> int:
+    '''Resident memory of the current process, in bytes (Linux only).'''
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+@lru_cache(64)
+def get_snapshot_dir() -> Path:
+    snapshot_dir = get_homedir() / 'cache' / 'snapshots'
+    safe_create_dir(snapshot_dir)
+    return snapshot_dir
+
+
+def snapshot_path(source: str, address_family: str, date: str) -> Path:
+    '''File containing the index of a date, mapped in memory by all the processes using it.'''
+    return get_snapshot_dir() / source / address_family / date
+
+
+def ip_to_hex(ip: str, address_family: str) -> str:
+    '''Fixed width hexadecimal representation of an IP, the lexical order is the numerical order.'''
+    if address_family == 'v4':
+        return f'{int(IPv4Address(ip)):08x}'
+    return f'{int(IPv6Address(ip)):032x}'
+
+
+def ranges_cache_key(source: str, address_family: str, date: str) -> str:
+    '''Sorted set of the IP ranges already answered by the lookup processes for a date.'''
+    return f'{source}|{address_family}|{date}|ranges'
+
+
+def queue_key(source: str, address_family: str, date: str) -> str:
+    '''Stream of the keys to lookup for a date, consumed by the lookup processes having that date loaded.'''
+    return f'queue|{source}|{address_family}|{date}'
+
+
+def dates_stream_key(source: str) -> str:
+    '''Stream of the dates imported in the storage for a source, read by the lookup processes.'''
+    return f'dates|{source}'
+
+
+def ondemand_stream_key(source: str) -> str:
+    '''Stream of the historical dates queried, loaded on demand by one of the lookup processes.'''
+    return f'ondemand|{source}'
+
+
+def range_member(first: int, last: int, address_family: str, response: Dict[str, str]) -> str:
+    width = 8 if address_family == 'v4' else 32
+    return f'{first:0{width}x}|{last:0{width}x}|{response["asn"]}|{response["prefix"]}'
+
+
+def range_lookup_bounds(ip_hex: str) -> Tuple[str, str]:
+    '''Bounds for ZREVRANGEBYLEX, the first member returned is the range starting the closest to the IP.'''
+    return f'[{ip_hex}|~', '-'
+
+
+def parse_range_member(member: str, ip_hex: str) -> Optional[Dict[str, str]]:
+    '''Returns the response stored in the member if the IP is in its range.'''
+    _first, last, asn, prefix = member.split('|', 3)
+    if last < ip_hex:
+        return None
+    return {'asn': asn, 'prefix': prefix}
+
+
+def parse_prefix(prefix: str, address_family: str) -> Tuple[int, int]:
+    '''Network address (as integer) and length of a prefix, the host bits are cleared.'''
+    address, length = prefix.split('/')
+    prefix_length = int(length)
+    try:
+        if address_family == 'v4':
+            network, max_length = int.from_bytes(inet_pton(AF_INET, address), 'big'), 32
+        else:
+            network, max_length = int.from_bytes(inet_pton(AF_INET6, address), 'big'), 128
+    except OSError:
+        raise ValueError(f'Invalid prefix: {prefix}')
+    if not 0 <= prefix_length <= max_length:
+        raise ValueError(f'Invalid prefix length: {prefix}')
+    host_bits = max_length - prefix_length
+    return network >> host_bits << host_bits, prefix_length
+
+
+def format_prefix(network: int, length: int, address_family: str) -> str:
+    '''Same format as ipaddress (the one used in the storage), a lot faster.'''
+    if address_family == 'v4':
+        return f'{inet_ntop(AF_INET, network.to_bytes(4, "big"))}/{length}'
+    address = inet_ntop(AF_INET6, network.to_bytes(16, "big"))
+    if '.' in address:
+        # inet_ntop uses the dotted notation for the IPv4 mapped/compatible addresses, ipaddress doesn't.
+        address = str(IPv6Address(network))
+    return f'{address}/{length}'
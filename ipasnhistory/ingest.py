@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+from collections import defaultdict, deque
+from concurrent.futures import Executor, Future, FIRST_COMPLETED, wait
+from typing import Callable, Deque, Dict, Iterator, List, Sequence, Set, Tuple
+
+from redis import Redis
+
+from .default import get_config
+from .helpers import format_prefix, parse_prefix, snapshot_path
+from .prefix_index import RangeIndex
+from .storage import delete_date, depth, read_table, storage_layout, write_blob, write_delta
+
+
+class AnnouncesWriter():
+    '''Writes the announces of a source / address family / date in the storage, in bounded pipelines.
+
+    The whole table is kept in memory until the end: prefix -> ASN (for the snapshot and the blob),
+    and the other ASNs announcing the same prefixes. That is about 120 bytes per prefix
+    (~120MB for a full IPv4 table), three times that while the snapshot and the blob are built in finish(),
+    for each of the loader_processes.
+    With the sets layout, the prefixes are also pushed to the storage as they come. If the import fails,
+    discard() removes them. With the blob and delta layouts, everything is written at the end.
+    The date is added to the available dates at the very end, when everything is in the storage.'''
+
+    def __init__(self, storagedb: Redis, source: str, address_family: str, announces_date: str, chunk_size: int=50000):
+        self.storagedb = storagedb
+        self.source = source
+        self.address_family = address_family
+        self.announces_date = announces_date
+        self.chunk_size = chunk_size
+        self.max_length = 32 if address_family == 'v4' else 128
+        self.key_prefix = f'{source}|{address_family}|{announces_date}'
+        self.layout = storage_layout()
+
+        self.to_store: Dict[str, List[str]] = defaultdict(list)
+        self.to_store_count = 0
+        self.ipcounts: Dict[str, int] = defaultdict(int)
+        # Used to build the snapshot
+        self.asn_ids: Dict[str, int] = {}
+        self.prefixes: Dict[Tuple[int, int], int] = {}
+        # The prefixes announced by more than one ASN: (asn id, network, length) of the previous ones
+        self.moas: Set[Tuple[int, int, int]] = set()
+        # ASNs with prefixes already pushed to the storage (sets layout)
+        self.flushed: Set[str] = set()
+        self.finishing = False
+
+    def __len__(self) -> int:
+        return len(self.prefixes)
+
+    def add_prefix(self, asn: str, prefix: str) -> None:
+        '''Add a prefix, in any valid notation. Raises a ValueError if the prefix is invalid.'''
+        self.add(asn, *parse_prefix(prefix, self.address_family))
+
+    def add(self, asn: str, network: int, length: int) -> None:
+        asn_id = self.asn_ids.setdefault(asn, len(self.asn_ids))
+        previous = self.prefixes.get((network, length))
+        if previous is not None and previous != asn_id:
+            self.moas.add((previous, network, length))
+            self.moas.discard((asn_id, network, length))
+        self.prefixes[(network, length)] = asn_id
+        self.ipcounts[asn] += 1 << (self.max_length - length)
+        if self.layout != 'sets':
+            return
+        self.to_store[asn].append(format_prefix(network, length, self.address_family))
+        self.to_store_count += 1
+        if self.to_store_count >= self.chunk_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.to_store:
+            return
+        p = self.storagedb.pipeline(transaction=False)
+        for asn, prefixes in self.to_store.items():
+            p.sadd(f'{self.key_prefix}|{asn}', *prefixes)  # Store all prefixes
+        self.flushed.update(self.to_store)
+        p.execute()
+        self.to_store.clear()
+        self.to_store_count = 0
+
+    def discard(self) -> None:
+        '''Delete what was already pushed to the storage, when the import fails.'''
+        self.to_store.clear()
+        self.to_store_count = 0
+        if self.finishing:
+            # Any key of the date can be there, and it may already be marked as available.
+            delete_date(self.storagedb, self.source, self.address_family, self.announces_date)
+        else:
+            flushed = list(self.flushed)
+            for i in range(0, len(flushed), self.chunk_size):
+                self.storagedb.delete(*(f'{self.key_prefix}|{asn}' for asn in flushed[i:i + self.chunk_size]))
+        self.flushed.clear()
+
+    def announces(self) -> Dict[str, List[Tuple[int, int]]]:
+        '''The sorted prefixes of each ASN.'''
+        asns = list(self.asn_ids.keys())
+        announces: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        for (network, length), asn_id in self.prefixes.items():
+            announces[asns[asn_id]].append((network, length))
+        for asn_id, network, length in self.moas:
+            announces[asns[asn_id]].append((network, length))
+        for prefixes in announces.values():
+            prefixes.sort()
+        return announces
+
+    def finish(self) -> int:
+        '''Store the ASNs and IP counts, mark the date as available, and save the snapshot.
+        Returns the number of prefixes, nothing is marked as available if it is 0.'''
+        self.finishing = True
+        self.flush()
+        if not self.prefixes:
+            return 0
+        if self.layout == 'blob':
+            write_blob(self.storagedb, self.key_prefix, self.address_family, self.announces(), self.ipcounts)
+        elif self.layout == 'delta':
+            self._finish_delta()
+        else:
+            self._finish_sets()
+        self.storagedb.sadd(f'{self.source}|{self.address_family}|dates', self.announces_date)
+        index = RangeIndex(self.address_family)
+        index.build_from_table(list(self.asn_ids.keys()), self.prefixes)
+        index.save(snapshot_path(self.source, self.address_family, self.announces_date))
+        return len(self.prefixes)
+
+    def _finish_delta(self) -> None:
+        '''Store the diff with the previous date in the storage, or a checkpoint if there is none
+        or if the previous one is too far from its checkpoint.'''
+        stored_dates = self.storagedb.smembers(f'{self.source}|{self.address_family}|dates')
+        previous = max((d for d in stored_dates if d < self.announces_date), default=None)
+        if previous:
+            if depth(self.storagedb, self.source, self.address_family, previous) + 1 < get_config('generic', 'delta_checkpoint_interval'):
+                asns = list(self.asn_ids.keys())
+                table = {(asns[asn_id], network, length) for (network, length), asn_id in self.prefixes.items()}
+                table.update((asns[asn_id], network, length) for asn_id, network, length in self.moas)
+                write_delta(self.storagedb, self.source, self.address_family, self.announces_date, table,
+                            previous, read_table(self.storagedb, self.source, self.address_family, previous))
+                return
+        write_blob(self.storagedb, self.key_prefix, self.address_family, self.announces(), self.ipcounts)
+
+    def _finish_sets(self) -> None:
+        asns = list(self.ipcounts.keys())
+        for i in range(0, len(asns), self.chunk_size):
+            p = self.storagedb.pipeline(transaction=False)
+            chunk = asns[i:i + self.chunk_size]
+            p.sadd(f'{self.key_prefix}|asns', *chunk)  # Store all ASNs
+            for asn in chunk:
+                p.set(f'{self.key_prefix}|{asn}|ipcount', self.ipcounts[asn])  # Total IPs for the AS
+            p.execute()
+
+
+def run_chains(executor: Executor, fn: Callable, chains: Sequence[Sequence[Tuple]]) -> Iterator[Tuple[Tuple, Future]]:
+    '''Run fn(*args) in the executor for all the args of the chains: the chains in parallel, the args of
+    a chain one after the other, in order. Yields the args and their future as they complete.
+
+    With the delta layout, a date is stored as the diff with the previous one only if that one is already
+    in the storage: the dates of a source / address family are loaded in a chain, oldest first.'''
+    pending: Dict[Future, Tuple[Tuple, Deque[Tuple]]] = {}
+
+    def submit(chain: Deque[Tuple]) -> None:
+        args = chain.popleft()
+        pending[executor.submit(fn, *args)] = (args, chain)
+
+    for chain in chains:
+        if chain:
+            submit(deque(chain))
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            args, chain = pending.pop(future)
+            yield args, future
+            if chain:
+                submit(chain)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+from pathlib import Path
+from typing import List
+
+from redis import Redis
+
+from .helpers import get_data_dir
+
+# States of the files
+DOWNLOADED = 'downloaded'
+LOADED = 'loaded'
+SKIPPED = 'skipped'
+
+
+class Manifest():
+    '''Raw files of a source (caida, ripe) and their state, kept in the storage.
+
+    The downloaders add the new files and notify the loader, so it never has to scan the whole
+    data directory: it waits for the notifications and only gets the new files.'''
+
+    def __init__(self, storagedb: Redis, name: str):
+        self.storagedb = storagedb
+        self.root = get_data_dir() / name
+        self.key = f'manifest|{name}'
+        self.queue = f'manifest|{name}|new'
+
+    def _name(self, path: Path) -> str:
+        return str(path.relative_to(self.root))
+
+    def add(self, path: Path) -> None:
+        '''The file is complete and can be loaded.'''
+        p = self.storagedb.pipeline()
+        p.hset(self.key, self._name(path), DOWNLOADED)
+        p.rpush(self.queue, self._name(path))
+        p.execute()
+
+    def set_state(self, path: Path, state: str) -> None:
+        self.storagedb.hset(self.key, self._name(path), state)
+
+    def remove(self, path: Path) -> None:
+        self.storagedb.hdel(self.key, self._name(path))
+
+    def bootstrap(self) -> None:
+        '''Add the files that aren't in the manifest (downloaded before it existed, or copied manually),
+        and notify again the ones that were never loaded (the loader stopped while loading them).'''
+        known = self.storagedb.hgetall(self.key)
+        to_load = [name for name, state in known.items() if state == DOWNLOADED and (self.root / name).exists()]
+        missing = [self._name(path) for path in self.root.glob('**/*.gz') if self._name(path) not in known]
+        p = self.storagedb.pipeline()
+        if missing:
+            p.hset(self.key, mapping={name: DOWNLOADED for name in missing})
+        p.delete(self.queue)
+        if to_load or missing:
+            p.rpush(self.queue, *sorted(to_load + missing, reverse=True))
+        p.execute()
+
+    def wait(self, timeout: int) -> List[Path]:
+        '''The files to load. Blocks until there is at least one, at most timeout seconds.'''
+        first = self.storagedb.blpop([self.queue], timeout)
+        if not first:
+            return []
+        p = self.storagedb.pipeline()
+        p.lrange(self.queue, 0, -1)
+        p.delete(self.queue)
+        names, _ = p.execute()
+        # A file downloaded again is notified again, it may already be loaded.
+        names = list(dict.fromkeys([first[1], *names]))
+        p = self.storagedb.pipeline()
+        [p.hget(self.key, name) for name in names]
+        return [self.root / name for name, state in zip(names, p.execute()) if state == DOWNLOADED]
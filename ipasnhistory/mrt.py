@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+'''Minimal MRT reader (RFC 6396), only extracts the prefixes and their origin AS from the TABLE_DUMP_V2 RIBs.'''
+
+import gzip
+
+from concurrent.futures import Future, ProcessPoolExecutor
+from collections import deque
+from pathlib import Path
+from struct import Struct
+from typing import Deque, Iterator, List, Optional, Tuple
+
+TABLE_DUMP_V2 = 13
+
+# RIB subtypes: address family, with ADD-PATH (RFC 8050)
+RIB_SUBTYPES = {
+    2: ('v4', False),  # RIB_IPV4_UNICAST
+    4: ('v6', False),  # RIB_IPV6_UNICAST
+    8: ('v4', True),  # RIB_IPV4_UNICAST_ADDPATH
+    10: ('v6', True),  # RIB_IPV6_UNICAST_ADDPATH
+}
+
+ATTR_EXTENDED_LENGTH = 0x10
+ATTR_AS_PATH = 2
+AS_SET = 1
+AS_SEQUENCE = 2
+
+_header = Struct('>IHHI')
+_uint16 = Struct('>H')
+
+Route = Tuple[str, int, int, str]
+
+
+def origin_as(as_path: memoryview) -> Optional[str]:
+    '''Origin AS of an AS_PATH attribute (the ASNs are always 4 bytes in TABLE_DUMP_V2).
+
+    Same as the AS path cleanup done before: the last AS of the last AS_SEQUENCE, or the AS of
+    a single member AS_SET, multi members AS_SETs are skipped. None if there is no usable AS.'''
+    candidates: List[str] = []
+    offset = 0
+    while offset + 2 <= len(as_path):
+        segment_type, count = as_path[offset], as_path[offset + 1]
+        offset += 2
+        if segment_type == AS_SEQUENCE and count:
+            candidates.append(str(int.from_bytes(as_path[offset + (count - 1) * 4:offset + count * 4], 'big')))
+        elif segment_type == AS_SET and count == 1:
+            candidates.append(str(int.from_bytes(as_path[offset:offset + 4], 'big')))
+        offset += count * 4
+    return candidates[-1] if candidates else None
+
+
+def parse_rib(subtype: int, body: memoryview) -> Optional[Route]:
+    '''Returns the address family, network, length and origin AS of a RIB record, using its last entry.
+    None if the record isn't a unicast RIB, or has no usable origin.'''
+    if subtype not in RIB_SUBTYPES:
+        return None
+    address_family, addpath = RIB_SUBTYPES[subtype]
+    max_length = 32 if address_family == 'v4' else 128
+    # sequence number (4)
+    length = body[4]
+    if length > max_length:
+        return None
+    prefix_bytes = (length + 7) // 8
+    network = int.from_bytes(body[5:5 + prefix_bytes], 'big') << (max_length - prefix_bytes * 8)
+    host_bits = max_length - length
+    network = network >> host_bits << host_bits
+    offset = 5 + prefix_bytes
+    entry_count = _uint16.unpack_from(body, offset)[0]
+    offset += 2
+    attributes: Optional[memoryview] = None
+    for _ in range(entry_count):
+        # peer index (2), originated time (4), path identifier (4, only with ADD-PATH)
+        offset += 10 if addpath else 6
+        attributes_length = _uint16.unpack_from(body, offset)[0]
+        offset += 2
+        attributes = body[offset:offset + attributes_length]
+        offset += attributes_length
+    if attributes is None:
+        return None
+    offset = 0
+    while offset + 3 <= len(attributes):
+        flags, attribute_type = attributes[offset], attributes[offset + 1]
+        if flags & ATTR_EXTENDED_LENGTH:
+            attribute_length = _uint16.unpack_from(attributes, offset + 2)[0]
+            offset += 4
+        else:
+            attribute_length = attributes[offset + 2]
+            offset += 3
+        if attribute_type == ATTR_AS_PATH:
+            asn = origin_as(attributes[offset:offset + attribute_length])
+            if asn is None:
+                return None
+            return address_family, network, length, asn
+        offset += attribute_length
+    return None
+
+
+def parse_records(data: bytes) -> List[Route]:
+    '''Parse a buffer of complete MRT records, without copying them.'''
+    routes: List[Route] = []
+    view = memoryview(data)
+    offset = 0
+    while offset + _header.size <= len(view):
+        _, record_type, subtype, length = _header.unpack_from(view, offset)
+        offset += _header.size
+        if record_type == TABLE_DUMP_V2:
+            route = parse_rib(subtype, view[offset:offset + length])
+            if route:
+                routes.append(route)
+        offset += length
+    return routes
+
+
+def read_chunks(path: Path, chunk_size: int=16 * 1024 * 1024) -> Iterator[bytes]:
+    '''Yield buffers of about chunk_size bytes of the decompressed dump, always made of complete records.'''
+    with gzip.open(path, 'rb') as f:
+        pending = b''
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            buf = pending + data
+            view = memoryview(buf)
+            # Find the end of the last complete record
+            offset = 0
+            while offset + _header.size <= len(view):
+                length = _header.unpack_from(view, offset)[3]
+                if offset + _header.size + length > len(view):
+                    break
+                offset += _header.size + length
+            if offset:
+                yield buf[:offset]
+            pending = buf[offset:]
+        if pending:
+            raise ValueError(f'{path} is truncated.')
+
+
+def routes(path: Path, processes: int=1) -> Iterator[Route]:
+    '''Yield the address family, network (as integer), length and origin AS of all the prefixes in a dump.
+    The chunks of the dump are parsed in parallel if processes > 1, only a few of them are in memory at once
+    (the routes kept by the caller are not bounded).'''
+    if processes <= 1:
+        for chunk in read_chunks(path):
+            yield from parse_records(chunk)
+        return
+    with ProcessPoolExecutor(processes) as executor:
+        pending: Deque[Future] = deque()
+        for chunk in read_chunks(path):
+            pending.append(executor.submit(parse_records, chunk))
+            if len(pending) >= processes * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
@@ -0,0 +1,672 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+
+from abc import ABC, abstractmethod
+from datetime import date, datetime, timedelta
+from ipaddress import ip_address, ip_network
+from pathlib import Path
+from socket import AF_INET, AF_INET6, inet_pton
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple, Type
+
+import numpy as np
+import pytricia  # type: ignore
+from redis import Redis
+
+from .default import get_config, ConfigError, safe_create_dir
+from .helpers import format_prefix, parse_prefix, snapshot_path
+from .storage import read_announces
+
+# Memory used per prefix, in bytes, measured by TestMemory in tests/test_prefix_index.py (RSS of a fresh process).
+# A node of a pytricia tree, with its prefix: the prefixes of both address families have the same size in pytricia,
+# the values are references to shared strings.
+PYTRICIA_NODE_BYTES = {'v4': 160, 'v6': 160}
+# The validity of a new prefix in the versioned tree: a tuple with one (ASN, mask) tuple, the ASNs are interned.
+VALIDITY_BYTES = 112
+# A known prefix announced on one more date: its validity is replaced by a tuple of the same size, only the mask grows
+# (4 bytes every 30 dates).
+MASK_BYTES = 1
+
+
+def load_announces(storagedb: Redis, source: str, address_family: str, announces_date: str) -> Iterator[Tuple[str, Iterable[str]]]:
+    '''Yield all the ASNs announcing something on a specific date, with the prefixes they announce.
+    They are read from the snapshot of that date if there is one, from the storage otherwise.'''
+    try:
+        snapshot = RangeIndex.open_snapshot(snapshot_path(source, address_family, announces_date))
+    except (OSError, ValueError):
+        pass
+    else:
+        yield from snapshot.announces()
+        return
+    yield from read_announces(storagedb, source, address_family, announces_date)
+
+
+class PrefixIndex(ABC):
+    '''Longest prefix match on the announces of one source, for one address family and one date.'''
+
+    # Set by the backends able to save an index in a file all the processes can map in memory.
+    snapshots = False
+
+    def __init__(self, address_family: str):
+        self.address_family = address_family
+        self.default_prefix = '0.0.0.0/0' if address_family == 'v4' else '::/0'
+
+    @abstractmethod
+    def __len__(self) -> int:
+        ...
+
+    @property
+    @abstractmethod
+    def nbytes(self) -> int:
+        '''Memory used by the index, in bytes.'''
+        ...
+
+    def save(self, path: Path) -> None:
+        raise NotImplementedError(f'{self.__class__.__name__} does not support snapshots.')
+
+    @classmethod
+    def open_snapshot(cls, path: Path) -> 'PrefixIndex':
+        raise NotImplementedError(f'{cls.__name__} does not support snapshots.')
+
+    def load(self, storagedb: Redis, source: str, announces_date: str) -> None:
+        self.build(load_announces(storagedb, source, self.address_family, announces_date))
+
+    @abstractmethod
+    def build(self, announces: Iterable[Tuple[str, Iterable[str]]]) -> None:
+        '''Build the index from (ASN, prefixes announced by that ASN).'''
+        ...
+
+    @abstractmethod
+    def lookup(self, ip: str) -> Dict:
+        '''Returns the ASN and the most specific prefix announcing the IP, in the format stored in the cache.
+        If nothing announces that IP, the ASN is 0 and the prefix the default route.
+        Raises a ValueError if the IP is invalid.'''
+        ...
+
+    def lookup_many(self, ips: List[str]) -> List[Optional[Dict]]:
+        '''Same as lookup, for a batch of IPs. The response is None for an invalid IP.'''
+        responses: List[Optional[Dict]] = []
+        for ip in ips:
+            try:
+                responses.append(self.lookup(ip))
+            except ValueError:
+                responses.append(None)
+        return responses
+
+    @abstractmethod
+    def uniform_range(self, ip: str, prefix: str) -> Tuple[int, int]:
+        '''First and last IPs around the given one getting the same answer: the prefix minus its more specifics.'''
+        ...
+
+
+class PytriciaIndex(PrefixIndex):
+
+    def __init__(self, address_family: str):
+        super().__init__(address_family)
+        if address_family == 'v4':
+            self.tree = pytricia.PyTricia()
+        else:
+            self.tree = pytricia.PyTricia(128)
+
+    def __len__(self) -> int:
+        return len(self.tree)
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.tree) * PYTRICIA_NODE_BYTES[self.address_family]
+
+    def build(self, announces: Iterable[Tuple[str, Iterable[str]]]) -> None:
+        for asn, ip_prefixes in announces:
+            for ip_prefix in ip_prefixes:
+                self.tree[ip_prefix] = asn
+
+    def lookup(self, ip: str) -> Dict:
+        asn = self.tree.get(ip)
+        ip_prefix = self.tree.get_key(ip)
+        if asn is None or ip_prefix is None or ip_prefix == self.default_prefix:
+            # Make sure not to return an ASN if we have no prefix.
+            return {'asn': '0', 'prefix': self.default_prefix}
+        return {'asn': asn, 'prefix': ip_prefix}
+
+    def uniform_range(self, ip: str, prefix: str) -> Tuple[int, int]:
+        network = ip_network(prefix)
+        ip_int = int(ip_address(ip))
+        first, last = int(network.network_address), int(network.broadcast_address)
+        for child in self.tree.children(prefix):
+            child_network = ip_network(child)
+            if int(child_network.broadcast_address) < ip_int:
+                first = max(first, int(child_network.broadcast_address) + 1)
+            elif int(child_network.network_address) > ip_int:
+                last = min(last, int(child_network.network_address) - 1)
+        return first, last
+
+
+class RangeIndex(PrefixIndex):
+    '''The prefixes are flattened in sorted, non overlapping ranges of IPs, each of them pointing to the
+    most specific prefix covering it. A lookup is a binary search on the first IP of the ranges.
+
+    All the data is in numpy arrays: the IPv4 addresses are stored as uint32, the IPv6 ones as 16 bytes
+    big endian strings (their lexical order is the numerical order). The ASNs are stored once in a table.
+
+    The arrays can be saved in a snapshot file, mapped read only by all the processes using that date:
+    the pages are shared between them, and opening a snapshot doesn't require to read the storage.'''
+
+    snapshots = True
+    snapshot_magic = b'IPASNIDX'
+    snapshot_arrays = ['asns', 'prefix_networks', 'prefix_lengths', 'prefix_asns', 'starts', 'ends', 'range_prefixes']
+
+    def __init__(self, address_family: str):
+        super().__init__(address_family)
+        if address_family == 'v4':
+            self.ip_dtype = np.dtype(np.uint32)
+            self.ip_length = 32
+        else:
+            self.ip_dtype = np.dtype('S16')
+            self.ip_length = 128
+        # Prefixes table
+        self.asns: np.ndarray = np.array([], dtype=bytes)
+        self.prefix_networks: np.ndarray = np.array([], dtype=self.ip_dtype)
+        self.prefix_lengths: np.ndarray = np.array([], dtype=np.uint8)
+        self.prefix_asns: np.ndarray = np.array([], dtype=np.uint32)
+        # Ranges table
+        self.starts: np.ndarray = np.array([], dtype=self.ip_dtype)
+        self.ends: np.ndarray = np.array([], dtype=self.ip_dtype)
+        self.range_prefixes: np.ndarray = np.array([], dtype=np.uint32)
+        # Formatted responses, per prefix id: the same prefixes are queried over and over.
+        self._responses: Dict[int, Dict] = {}
+        self._mapped: Optional[mmap.mmap] = None
+
+    def __len__(self) -> int:
+        return len(self.prefix_networks)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(a.nbytes for a in [self.asns, self.prefix_networks, self.prefix_lengths, self.prefix_asns,
+                                      self.starts, self.ends, self.range_prefixes])
+
+    def save(self, path: Path) -> None:
+        '''Write the snapshot, the file is replaced atomically: the processes using the old one keep their mapping.'''
+        header: Dict = {'address_family': self.address_family, 'arrays': {}}
+        offset = 0
+        for name in self.snapshot_arrays:
+            array = getattr(self, name)
+            header['arrays'][name] = {'dtype': array.dtype.str, 'count': len(array), 'offset': offset}
+            offset += -(-array.nbytes // 64) * 64
+        encoded_header = json.dumps(header).encode()
+        data_start = -(-(len(self.snapshot_magic) + 4 + len(encoded_header)) // 64) * 64
+        safe_create_dir(path.parent)
+        tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+        with tmp_path.open('wb') as f:
+            f.write(self.snapshot_magic + struct.pack('<I', len(encoded_header)) + encoded_header)
+            for name in self.snapshot_arrays:
+                f.seek(data_start + header['arrays'][name]['offset'])
+                f.write(np.ascontiguousarray(getattr(self, name)).tobytes())
+            f.truncate(data_start + offset)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def open_snapshot(cls, path: Path) -> 'RangeIndex':
+        '''Map a snapshot in memory, nothing is copied.'''
+        with path.open('rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if mapped[:len(cls.snapshot_magic)] != cls.snapshot_magic:
+            raise ValueError(f'{path} is not a valid snapshot.')
+        header_start = len(cls.snapshot_magic) + 4
+        header_length = struct.unpack('<I', mapped[len(cls.snapshot_magic):header_start])[0]
+        header = json.loads(mapped[header_start:header_start + header_length])
+        data_start = -(-(header_start + header_length) // 64) * 64
+        index = cls(header['address_family'])
+        for name in cls.snapshot_arrays:
+            array = header['arrays'][name]
+            setattr(index, name, np.frombuffer(mapped, dtype=np.dtype(array['dtype']), count=array['count'],
+                                               offset=data_start + array['offset']))
+        # Keep the mapping open as long as the index is used
+        index._mapped = mapped
+        return index
+
+    def announces(self) -> Iterator[Tuple[str, List[str]]]:
+        '''Yield the ASNs with the prefixes they announce, as they were passed to build.'''
+        order = np.argsort(self.prefix_asns, kind='stable')
+        asn_ids = self.prefix_asns[order]
+        boundaries = np.flatnonzero(np.diff(asn_ids)) + 1
+        for group in np.split(order, boundaries) if len(order) else []:
+            yield (self.asns[self.prefix_asns[group[0]]].decode(),
+                   [format_prefix(self._to_int(self.prefix_networks[i]), int(self.prefix_lengths[i]), self.address_family)
+                    for i in group])
+
+    def _to_array(self, values: List[int]) -> np.ndarray:
+        if self.address_family == 'v4':
+            return np.array(values, dtype=self.ip_dtype)
+        return np.array([v.to_bytes(16, 'big') for v in values], dtype=self.ip_dtype)
+
+    def _to_int(self, value) -> int:
+        if self.address_family == 'v4':
+            return int(value)
+        # numpy strips the trailing null bytes
+        return int.from_bytes(bytes(value).ljust(16, b'\x00'), 'big')
+
+    def _ip_key(self, ip: str):
+        try:
+            if self.address_family == 'v4':
+                return int.from_bytes(inet_pton(AF_INET, ip), 'big')
+            return inet_pton(AF_INET6, ip)
+        except OSError:
+            raise ValueError(f'Invalid IP: {ip}')
+
+    def build(self, announces: Iterable[Tuple[str, Iterable[str]]]) -> None:
+        asn_ids: Dict[str, int] = {}
+        prefixes: Dict[Tuple[int, int], int] = {}
+        for asn, ip_prefixes in announces:
+            asn_id = asn_ids.setdefault(asn, len(asn_ids))
+            for ip_prefix in ip_prefixes:
+                prefixes[parse_prefix(ip_prefix, self.address_family)] = asn_id
+        self.build_from_table(list(asn_ids.keys()), prefixes)
+
+    def build_from_table(self, asns: List[str], prefixes: Dict[Tuple[int, int], int]) -> None:
+        '''Build the index from the ASNs table and (network, length) -> index of the ASN in the table.'''
+        sorted_prefixes = sorted(prefixes.items())
+        starts: List[int] = []
+        ends: List[int] = []
+        range_prefixes: List[int] = []
+        # Sorted by network then length: a prefix always comes after all the prefixes covering it.
+        # The stack contains the prefixes covering the current position, the most specific on top.
+        stack: List[Tuple[int, int]] = []
+        cursor = 0
+        for prefix_id, ((network, length), _) in enumerate(sorted_prefixes):
+            while stack and stack[-1][0] < network:
+                last, covering_id = stack.pop()
+                if cursor <= last:
+                    starts.append(cursor)
+                    ends.append(last)
+                    range_prefixes.append(covering_id)
+                    cursor = last + 1
+            if stack and cursor < network:
+                starts.append(cursor)
+                ends.append(network - 1)
+                range_prefixes.append(stack[-1][1])
+            cursor = network
+            stack.append((network | ((1 << (self.ip_length - length)) - 1), prefix_id))
+        while stack:
+            last, covering_id = stack.pop()
+            if cursor <= last:
+                starts.append(cursor)
+                ends.append(last)
+                range_prefixes.append(covering_id)
+                cursor = last + 1
+
+        self.asns = np.array([asn.encode() for asn in asns], dtype=bytes)
+        self.prefix_networks = self._to_array([network for (network, _), _ in sorted_prefixes])
+        self.prefix_lengths = np.array([length for (_, length), _ in sorted_prefixes], dtype=np.uint8)
+        self.prefix_asns = np.array([asn_id for _, asn_id in sorted_prefixes], dtype=np.uint32)
+        self.starts = self._to_array(starts)
+        self.ends = self._to_array(ends)
+        self.range_prefixes = np.array(range_prefixes, dtype=np.uint32)
+        self._responses = {}
+
+    def _search(self, keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        '''Returns the index of the range of each key, and if the key is actually in that range.'''
+        if not len(self.starts):
+            return np.zeros(len(keys), dtype=np.intp), np.zeros(len(keys), dtype=bool)
+        indexes = np.searchsorted(self.starts, keys, side='right') - 1
+        found = indexes >= 0
+        indexes[~found] = 0
+        found &= self.ends[indexes] >= keys
+        return indexes, found
+
+    def _response(self, prefix_id: int) -> Dict:
+        if prefix_id not in self._responses:
+            length = int(self.prefix_lengths[prefix_id])
+            if length == 0:
+                # Make sure not to return an ASN if we have no prefix.
+                self._responses[prefix_id] = {'asn': '0', 'prefix': self.default_prefix}
+            else:
+                self._responses[prefix_id] = {
+                    'asn': self.asns[self.prefix_asns[prefix_id]].decode(),
+                    'prefix': format_prefix(self._to_int(self.prefix_networks[prefix_id]), length, self.address_family)}
+        # The callers are free to update the response
+        return dict(self._responses[prefix_id])
+
+    def lookup(self, ip: str) -> Dict:
+        response = self.lookup_many([ip])[0]
+        if response is None:
+            raise ValueError(f'Invalid IP: {ip}')
+        return response
+
+    def lookup_many(self, ips: List[str]) -> List[Optional[Dict]]:
+        family, size = (AF_INET, 4) if self.address_family == 'v4' else (AF_INET6, 16)
+        other_family = AF_INET6 if self.address_family == 'v4' else AF_INET
+        packed: List[bytes] = []
+        invalid: Set[int] = set()
+        not_announced: Set[int] = set()
+        for i, ip in enumerate(ips):
+            try:
+                packed.append(inet_pton(family, ip))
+            except (OSError, TypeError):
+                packed.append(bytes(size))
+                try:
+                    inet_pton(other_family, ip)
+                except (OSError, TypeError):
+                    invalid.add(i)
+                else:
+                    # Same as the radix trees: an IP of the other address family isn't announced.
+                    not_announced.add(i)
+        keys = np.frombuffer(b''.join(packed), dtype='>u4' if size == 4 else 'S16').astype(self.ip_dtype)
+        indexes, found = self._search(keys)
+        prefix_ids = self.range_prefixes[indexes] if len(self.range_prefixes) else indexes
+        responses: List[Optional[Dict]] = []
+        for i, (is_found, prefix_id) in enumerate(zip(found.tolist(), prefix_ids.tolist())):
+            if i in invalid:
+                responses.append(None)
+            elif not is_found or i in not_announced:
+                responses.append({'asn': '0', 'prefix': self.default_prefix})
+            else:
+                responses.append(self._response(prefix_id))
+        return responses
+
+    def uniform_range(self, ip: str, prefix: str) -> Tuple[int, int]:
+        indexes, found = self._search(np.array([self._ip_key(ip)], dtype=self.ip_dtype))
+        if not found[0]:
+            raise ValueError(f'{ip} is not announced.')
+        return self._to_int(self.starts[indexes[0]]), self._to_int(self.ends[indexes[0]])
+
+
+INDEX_BACKENDS: Dict[str, Type[PrefixIndex]] = {'pytricia': PytriciaIndex, 'ranges': RangeIndex}
+
+
+class DatedIndex(ABC):
+    '''All the dates loaded for one source and one address family.'''
+
+    def __init__(self, address_family: str):
+        self.address_family = address_family
+        self.default_prefix = '0.0.0.0/0' if address_family == 'v4' else '::/0'
+
+    @abstractmethod
+    def dates(self) -> List[str]:
+        ...
+
+    def __contains__(self, announces_date: str) -> bool:
+        return announces_date in self.dates()
+
+    @abstractmethod
+    def load(self, storagedb: Redis, source: str, announces_date: str) -> None:
+        ...
+
+    @abstractmethod
+    def unload(self, announces_date: str) -> None:
+        ...
+
+    @abstractmethod
+    def nbytes(self, announces_date: str) -> int:
+        '''Memory used by a date, in bytes. Computed from the index, not measured: the memory of the process
+        doesn't tell it (other threads allocating at the same time, memory reused, snapshots not read yet).'''
+        ...
+
+    @abstractmethod
+    def lookup_many(self, announces_date: str, ips: List[str]) -> List[Optional[Dict]]:
+        '''Same as PrefixIndex.lookup_many, on a specific date.'''
+        ...
+
+    @abstractmethod
+    def uniform_range(self, announces_date: str, ip: str, prefix: str) -> Tuple[int, int]:
+        '''Same as PrefixIndex.uniform_range, on a specific date.'''
+        ...
+
+
+class DailyIndexes(DatedIndex):
+    '''One independent PrefixIndex per date. If the backend supports it, the index of a date is built once,
+    saved in a snapshot, and all the processes loading that date map the same file.'''
+
+    def __init__(self, address_family: str, backend: Type[PrefixIndex]):
+        super().__init__(address_family)
+        self.backend = backend
+        self.indexes: Dict[str, PrefixIndex] = {}
+
+    def dates(self) -> List[str]:
+        return list(self.indexes.keys())
+
+    def __contains__(self, announces_date: str) -> bool:
+        return announces_date in self.indexes
+
+    def load(self, storagedb: Redis, source: str, announces_date: str) -> None:
+        if not self.backend.snapshots:
+            index = self.backend(self.address_family)
+            index.load(storagedb, source, announces_date)
+            self.indexes[announces_date] = index
+            return
+        path = snapshot_path(source, self.address_family, announces_date)
+        try:
+            self.indexes[announces_date] = self.backend.open_snapshot(path)
+        except (OSError, ValueError):
+            # Missing (or broken) snapshot, build it.
+            index = self.backend(self.address_family)
+            index.load(storagedb, source, announces_date)
+            index.save(path)
+            self.indexes[announces_date] = self.backend.open_snapshot(path)
+
+    def unload(self, announces_date: str) -> None:
+        self.indexes.pop(announces_date, None)
+
+    def nbytes(self, announces_date: str) -> int:
+        return self.indexes[announces_date].nbytes
+
+    def lookup_many(self, announces_date: str, ips: List[str]) -> List[Optional[Dict]]:
+        return self.indexes[announces_date].lookup_many(ips)
+
+    def uniform_range(self, announces_date: str, ip: str, prefix: str) -> Tuple[int, int]:
+        return self.indexes[announces_date].uniform_range(ip, prefix)
+
+
+class VersionedIndex(DatedIndex):
+    '''A single radix tree for all the dates: consecutive days are nearly identical, so the prefixes are only stored once.
+
+    Each date gets a slot (a bit), and each prefix points to the ASNs announcing it, with the set of
+    dates each of them is valid on (as a bitmask of slots). The memory depends on the churn between the
+    days instead of the number of days.'''
+
+    def __init__(self, address_family: str):
+        super().__init__(address_family)
+        if address_family == 'v4':
+            self.tree = pytricia.PyTricia()
+        else:
+            self.tree = pytricia.PyTricia(128)
+        self.slots: Dict[str, int] = {}
+        # Memory added by each date when it was loaded: the prefixes it shares with the dates already loaded are (almost) free.
+        self.sizes: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.tree)
+
+    def dates(self) -> List[str]:
+        return list(self.slots.keys())
+
+    def __contains__(self, announces_date: str) -> bool:
+        return announces_date in self.slots
+
+    def _free_slot(self) -> int:
+        used = set(self.slots.values())
+        slot = 0
+        while slot in used:
+            slot += 1
+        return slot
+
+    def load(self, storagedb: Redis, source: str, announces_date: str) -> None:
+        if announces_date in self.slots:
+            return
+        slot = self._free_slot()
+        bit = 1 << slot
+        size = 0
+        for asn, ip_prefixes in load_announces(storagedb, source, self.address_family, announces_date):
+            asn = sys.intern(asn)
+            for ip_prefix in ip_prefixes:
+                if not self.tree.has_key(ip_prefix):
+                    self.tree[ip_prefix] = ((asn, bit),)
+                    size += PYTRICIA_NODE_BYTES[self.address_family] + VALIDITY_BYTES
+                    continue
+                size += MASK_BYTES
+                # Only a few prefixes are announced by more than one ASN, a tuple is the most compact.
+                validity = self.tree[ip_prefix]
+                for i, (known_asn, mask) in enumerate(validity):
+                    if known_asn == asn:
+                        self.tree[ip_prefix] = validity[:i] + ((known_asn, mask | bit),) + validity[i + 1:]
+                        break
+                else:
+                    self.tree[ip_prefix] = validity + ((asn, bit),)
+        # Only visible once fully loaded
+        self.sizes[announces_date] = size
+        self.slots[announces_date] = slot
+
+    def unload(self, announces_date: str) -> None:
+        slot = self.slots.pop(announces_date, None)
+        self.sizes.pop(announces_date, None)
+        if slot is None:
+            return
+        bit = 1 << slot
+        for ip_prefix in list(self.tree.keys()):
+            validity = tuple((asn, mask & ~bit) for asn, mask in self.tree[ip_prefix] if mask & ~bit)
+            if validity:
+                self.tree[ip_prefix] = validity
+            else:
+                del self.tree[ip_prefix]
+
+    def nbytes(self, announces_date: str) -> int:
+        return self.sizes[announces_date]
+
+    def _asn(self, ip_prefix: str, bit: int) -> Optional[str]:
+        for asn, mask in self.tree[ip_prefix]:
+            if mask & bit:
+                return asn
+        return None
+
+    def _lookup(self, ip: str, bit: int) -> Dict:
+        ip_prefix = self.tree.get_key(ip)
+        while ip_prefix is not None and ip_prefix != self.default_prefix:
+            asn = self._asn(ip_prefix, bit)
+            if asn is not None:
+                return {'asn': asn, 'prefix': ip_prefix}
+            # Not announced on that date, try the less specific one.
+            ip_prefix = self.tree.parent(ip_prefix)
+        # Make sure not to return an ASN if we have no prefix.
+        return {'asn': '0', 'prefix': self.default_prefix}
+
+    def lookup_many(self, announces_date: str, ips: List[str]) -> List[Optional[Dict]]:
+        bit = 1 << self.slots[announces_date]
+        responses: List[Optional[Dict]] = []
+        for ip in ips:
+            try:
+                responses.append(self._lookup(ip, bit))
+            except ValueError:
+                responses.append(None)
+        return responses
+
+    def uniform_range(self, announces_date: str, ip: str, prefix: str) -> Tuple[int, int]:
+        bit = 1 << self.slots[announces_date]
+        network = ip_network(prefix)
+        ip_int = int(ip_address(ip))
+        first, last = int(network.network_address), int(network.broadcast_address)
+        for child in self.tree.children(prefix):
+            if self._asn(child, bit) is None:
+                # Not announced on that date
+                continue
+            child_network = ip_network(child)
+            if int(child_network.broadcast_address) < ip_int:
+                first = max(first, int(child_network.broadcast_address) + 1)
+            elif int(child_network.network_address) > ip_int:
+                last = min(last, int(child_network.network_address) - 1)
+        return first, last
+
+
+def new_index(address_family: str) -> DatedIndex:
+    '''Initialize an empty index for a source and an address family, with the backend set in the config.'''
+    backend = get_config('generic', 'index_backend')
+    if backend == 'versioned':
+        return VersionedIndex(address_family)
+    if backend not in INDEX_BACKENDS:
+        raise ConfigError(f'Unknown index backend: {backend}, must be one of versioned, {", ".join(INDEX_BACKENDS)}.')
+    return DailyIndexes(address_family, INDEX_BACKENDS[backend])
+
+
+class LocalLookup():
+    '''Keeps the most recent days in memory, so the lookups can be done in the current process.'''
+
+    def __init__(self, storagedb: Redis, sources: List[str], days: int):
+        self.logger = logging.getLogger(f'{self.__class__.__name__}')
+        self.logger.setLevel(get_config('generic', 'loglevel'))
+        self.storagedb = storagedb
+        self.sources = sources
+        self.days = days
+        self.indexes: Dict[str, Dict[str, DatedIndex]] = {
+            source: {'v4': new_index('v4'), 'v6': new_index('v6')} for source in sources}
+        self.last_refresh: Optional[datetime] = None
+        # Incremented every time a date is loaded or unloaded
+        self.version = 0
+        self._refreshing = threading.Lock()
+        # The initial load is blocking, the process is useless without it.
+        self._refresh()
+
+    def dates(self, source: str, address_family: str) -> List[str]:
+        self.refresh()
+        if source not in self.indexes:
+            return []
+        return self.indexes[source][address_family].dates()
+
+    def refresh(self) -> None:
+        '''Load the new dates in the background, at most every 10 minutes.'''
+        if self.last_refresh and self.last_refresh >= (datetime.now() - timedelta(minutes=10)):
+            return
+        if self._refreshing.locked():
+            return
+        self.last_refresh = datetime.now()
+        threading.Thread(target=self._refresh, daemon=True).start()
+
+    def _refresh(self) -> None:
+        if not self._refreshing.acquire(blocking=False):
+            return
+        try:
+            self.last_refresh = datetime.now()
+            oldest = (date.today() - timedelta(days=self.days)).isoformat()
+            for source in self.sources:
+                for address_family in ['v4', 'v6']:
+                    index = self.indexes[source][address_family]
+                    available = {d for d in self.storagedb.smembers(f'{source}|{address_family}|dates') if d >= oldest}
+                    for d in available - set(index.dates()):
+                        self.logger.debug(f'Loading {source} {address_family} {d}')
+                        index.load(self.storagedb, source, d)
+                        self.version += 1
+                    for d in set(index.dates()) - available:
+                        self.logger.debug(f'Unloading {source} {address_family} {d}')
+                        index.unload(d)
+                        self.version += 1
+        except Exception:
+            self.logger.exception('Unable to refresh the local indexes.')
+        finally:
+            self._refreshing.release()
+
+    def holds(self, key: str) -> bool:
+        '''Check if the query key (source|address_family|date|ip) can be answered locally.'''
+        source, address_family, announces_date, _ = key.split('|', 3)
+        return source in self.indexes and announces_date in self.indexes[source][address_family]
+
+    def lookup_many(self, keys: List[str]) -> Dict[str, Dict]:
+        '''Answer the query keys for the dates in memory, in batches per index. The other keys are skipped.'''
+        batches: Dict[Tuple[str, str, str], List[Tuple[str, str]]] = {}
+        for key in keys:
+            source, address_family, announces_date, ip = key.split('|', 3)
+            batches.setdefault((source, address_family, announces_date), []).append((key, ip))
+        responses: Dict[str, Dict] = {}
+        for (source, address_family, announces_date), batch in batches.items():
+            if source not in self.indexes or announces_date not in self.indexes[source][address_family]:
+                continue
+            index = self.indexes[source][address_family]
+            for (key, ip), response in zip(batch, index.lookup_many(announces_date, [ip for _, ip in batch])):
+                if response is None:
+                    response = {'error': f'Query invalid: "{address_family}" "{source}" "{announces_date}" "{ip}"'}
+                responses[key] = response
+        return responses
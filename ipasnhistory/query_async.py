@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+
+import asyncio
+import random
+import time
+
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Set, Tuple
+from uuid import uuid4
+
+from redis.asyncio import Redis
+
+from .default import get_socket_path, get_config
+from .query_base import BaseQuery
+from .rpc import AsyncRPCClient
+from .storage import read_asn_meta
+
+
+class AsyncQuery(BaseQuery):
+    '''Same API as Query, for asyncio: the lookups are awaited, one process holds many queries in flight.
+
+    The indexes of the dates are refreshed (asynchronously) before resolving the keys of the queries.
+    The queries waiting for the lookup processes share the reply list of the process: a single reader
+    (holding a single connection of the pool) dispatches the answered keys to the queries waiting on them.'''
+
+    def __init__(self):
+        super().__init__()
+        self.cache = Redis(unix_socket_path=get_socket_path('cache'), decode_responses=True)
+        self.astoragedb = Redis(host=get_config('generic', 'storage_db_hostname'), port=get_config('generic', 'storage_db_port'),
+                                decode_responses=True)
+        self.rpc: Optional[AsyncRPCClient] = AsyncRPCClient(self.query_timeout) if self.lookup_rpc else None
+        self.reply_list = f'reply|{uuid4()}'
+        # The queues of the queries waiting on each key, filled by the reader.
+        self.waiters: Dict[str, Set[asyncio.Queue]] = {}
+        self.reply_reader: Optional[asyncio.Task] = None
+
+    async def _refresh_date_index(self, source: str, address_family: str) -> None:
+        index_key = f'{source}|{address_family}'
+        if (index := self._index_to_check(source, address_family)) is None:
+            return
+        cached_version = await self.cache.get(f'{source}|{address_family}|cached_dates_version')
+        if self._storage_dates_outdated(index_key):
+            self.storage_dates[index_key] = (time.time(), await self.astoragedb.smembers(f'{source}|{address_family}|dates'))
+        storage_refresh, storage_dates = self.storage_dates[index_key]
+        version = self._index_version(cached_version, storage_refresh)
+        if cached_version is None or version != index.version:
+            self._update_index(index, version, await self.cache.smembers(f'{source}|{address_family}|cached_dates'), storage_dates)
+
+    async def _refresh_date_indexes(self, queries: Iterable[Dict]) -> None:
+        '''Refresh the indexes of all the sources, and of the ones in the queries.'''
+        sources = set(self.sources) | {query['source'] for query in queries if query.get('source')}
+        await asyncio.gather(*(self._refresh_date_index(source, address_family)
+                               for source in sources for address_family in ['v4', 'v6']))
+
+    async def meta(self):
+        '''Get meta information from the current instance'''
+        expected_interval = await self.cache.hgetall('META:expected_interval')
+        cached_dates = {source: {address_family: await self.cache.smembers(f'{source}|{address_family}|cached_dates')
+                                 for address_family in ['v4', 'v6']}
+                        for source in self.sources}
+        return self._meta(expected_interval, cached_dates)
+
+    async def _read_cache(self, keys: List[str]) -> List[Dict]:
+        p = self.cache.pipeline(transaction=False)
+        ips_hex = self._queue_cache_reads(p, keys)
+        return self._cache_reads_results(keys, ips_hex, await p.execute())
+
+    async def _rpc_holders(self, source: str) -> Dict[Tuple[str, str], List[str]]:
+        if self._rpc_holders_fresh(source):
+            return self.rpc_holders[source][1]
+        workers = self._rpc_workers(await self.cache.hgetall(f'workers|{source}'))
+        p = self.cache.pipeline()
+        [p.smembers(f'loaded|{source}|{worker}') for worker, _ in workers]
+        return self._set_rpc_holders(source, workers, await p.execute())
+
+    async def _lookup_rpc(self, keys: List[str]) -> Tuple[Dict[str, Dict], List[str]]:
+        if not self.rpc:
+            return {}, keys
+        responses: Dict[str, Dict] = {}
+        batches = []
+        for batch_key, batch in self._rpc_batches(keys).items():
+            source, address_family, date = batch_key
+            if paths := (await self._rpc_holders(source)).get((address_family, date)):
+                batches.append((batch_key, batch, self.rpc.lookup(random.choice(paths), address_family, date, [ip for _, ip in batch])))
+        # All the batches are sent at once.
+        results = await asyncio.gather(*(lookup for _, _, lookup in batches))
+        p = self.cache.pipeline(transaction=False)
+        for (batch_key, batch, _), batch_results in zip(batches, results):
+            if batch_results is not None:
+                self._rpc_responses(p, responses, batch_key, batch, batch_results)
+        await p.execute()
+        return responses, [k for k in keys if k not in responses]
+
+    async def _fetch_responses(self, keys: List[str], wait: bool=False) -> Dict[str, Dict]:
+        if self.local:
+            responses, keys = self._lookup_local(keys)
+        else:
+            responses = {}
+        if self.rpc:
+            rpc_responses, keys = await self._lookup_rpc(keys)
+            responses.update(rpc_responses)
+        to_wait: List[str] = []
+        for i in range(0, len(keys), self.pipeline_chunk_size):
+            chunk = keys[i:i + self.pipeline_chunk_size]
+            p_update = self.cache.pipeline(transaction=False)
+            missing = []
+            for k, data in zip(chunk, await self._read_cache(chunk)):
+                responses[k] = data
+                if not data:
+                    missing.append(k)
+            self._refresh_expire(p_update, {k: responses[k] for k in chunk if responses[k]})
+            if missing and wait:
+                to_wait += missing
+            elif missing:
+                self._enqueue(p_update, missing)
+            await p_update.execute()
+        if to_wait:
+            responses.update(await self._wait_responses(to_wait))
+        return responses
+
+    async def mass_query(self, list_to_query: list):
+        await self._refresh_date_indexes(list_to_query)
+        keys_by_query, unique_keys = self._resolve_mass_query(list_to_query)
+        return self._mass_query_response(list_to_query, keys_by_query, await self._fetch_responses(unique_keys))
+
+    async def _bulk_batch(self, batch: List[Dict]) -> List[Dict]:
+        await self._refresh_date_indexes(batch)
+        keys_by_query, unique_keys = self._resolve_mass_query(batch)
+        return self._mass_query_response(batch, keys_by_query, await self._fetch_responses(unique_keys, wait=True))['responses']
+
+    async def bulk_query(self, queries: AsyncIterator[Dict]) -> AsyncIterator[Dict]:
+        batch: List[Dict] = []
+        async for query in queries:
+            batch.append(query)
+            if len(batch) >= self.bulk_batch_size:
+                for response in await self._bulk_batch(batch):
+                    yield response
+                batch = []
+        if batch:
+            for response in await self._bulk_batch(batch):
+                yield response
+
+    async def mass_cache(self, list_to_cache: list):
+        await self._refresh_date_indexes(list_to_cache)
+        keys, invalid_queries = self._prepare_all_keys(list_to_cache)
+        # No need to cache what we have locally
+        to_cache = [k for k in keys if not (self.local and self.local.holds(k))]
+        if to_cache:
+            p = self.cache.pipeline()
+            self._enqueue(p, to_cache)
+            await p.execute()
+        return {'meta': {'number_queries': len(list_to_cache)}, 'not_cached': invalid_queries, 'cached': keys}
+
+    async def asn_meta(self, asn: Optional[int]=None, source: str='caida', address_family: str='v4',
+                       date: Optional[str]=None, first: Optional[str]=None, last: Optional[str]=None,
+                       precision_delta: Optional[Dict[str, int]]=None):
+        await self._refresh_date_index(source, address_family)
+        to_return: Dict = {'meta': {'source': source, 'address_family': address_family},
+                           'response': {}}
+        if asn is not None:
+            to_return['meta']['asn'] = asn
+        try:
+            dates = self._find_dates(source=source, address_family=address_family, date=date,
+                                     first=first, last=last, precision_delta=precision_delta)
+        except Exception as e:
+            to_return['error'] = str(e)
+            return to_return
+
+        for date in dates:
+            # Reading the storage is blocking, and only done for this endpoint.
+            to_return['response'][date] = await asyncio.to_thread(read_asn_meta, self.storagedb, source, address_family, date, asn)
+        return to_return
+
+    async def _read_replies(self) -> None:
+        '''Dispatch the keys pushed in the reply list of the process to the queries waiting on them,
+        stops when no query is waiting anymore.'''
+        while self.waiters:
+            try:
+                answer = await self.cache.blpop([self.reply_list], timeout=1)
+                if not answer:
+                    continue
+                answered = [answer[1]]
+                if more := await self.cache.lpop(self.reply_list, self.pipeline_chunk_size):
+                    answered += more
+            except Exception as e:
+                self.logger.warning(f'Unable to read the replies: {e}')
+                await asyncio.sleep(1)
+                continue
+            for k in answered:
+                for queue in self.waiters.get(k, set()):
+                    queue.put_nowait(k)
+
+    def _start_reply_reader(self) -> None:
+        if self.reply_reader is None or self.reply_reader.done():
+            self.reply_reader = asyncio.create_task(self._read_replies())
+
+    async def _wait_responses(self, keys: List[str]) -> Dict[str, Dict]:
+        # Same as Query._wait_responses: register the reply list, then check the keys again.
+        # The reply list is the one of the process, the reader passes us the keys we wait on.
+        answers: asyncio.Queue = asyncio.Queue()
+        for k in keys:
+            self.waiters.setdefault(k, set()).add(answers)
+        self._start_reply_reader()
+        try:
+            p = self.cache.pipeline()
+            queued = self._queue_waiting(p, self.reply_list, keys)
+            ips_hex = self._queue_cache_reads(p, keys)
+            results = (await p.execute())[queued:]
+            responses = {k: data for k, data in zip(keys, self._cache_reads_results(keys, ips_hex, results)) if data}
+
+            pending = set(keys) - responses.keys()
+            deadline = time.monotonic() + self.query_timeout
+            while pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    answered = {await asyncio.wait_for(answers.get(), timeout=remaining)}
+                except asyncio.TimeoutError:
+                    break
+                while not answers.empty():
+                    answered.add(answers.get_nowait())
+                to_fetch = list(answered & pending)
+                if not to_fetch:
+                    continue
+                for k, data in zip(to_fetch, await self._read_cache(to_fetch)):
+                    if data:
+                        responses[k] = data
+                        pending.discard(k)
+        finally:
+            for k in keys:
+                self.waiters[k].discard(answers)
+                if not self.waiters[k]:
+                    del self.waiters[k]
+        return responses
+
+    async def query(self, ip, source: Optional[str]=None, address_family: Optional[str]=None, date: Optional[str]=None,
+                    first: Optional[str]=None, last: Optional[str]=None, precision_delta: Optional[Dict[str, int]]=None):
+        '''Launch a query, same parameters as Query.query.'''
+        query = self._build_query(ip, source, address_family, date, first, last, precision_delta)
+        to_return: Dict = {'meta': query, 'response': {}}
+        await self._refresh_date_indexes([query])
+        try:
+            keys = self._keys_for_query(query)
+        except Exception as e:
+            to_return['error'] = str(e)
+            return to_return
+
+        responses: Dict = {}
+        if self.local:
+            local_responses, keys = self._lookup_local(keys)
+            for k, data in local_responses.items():
+                self._set_response(responses, k, data)
+
+        pending = set()
+        cached: Dict[str, Dict] = {}
+        for k, data in zip(keys, await self._read_cache(keys)):
+            if data:
+                cached[k] = data
+                self._set_response(responses, k, data)
+            else:
+                pending.add(k)
+
+        if pending:
+            answered = await self._wait_responses(list(pending))
+            cached.update(answered)
+            self._pop_answered(pending, responses, answered)
+            if pending:
+                to_return['info'] = f'Timeout: {len(pending)} lookup(s) still pending after {self.query_timeout}s, try again later.'
+
+        p_update_expire = self.cache.pipeline()
+        self._refresh_expire(p_update_expire, cached)
+        await p_update_expire.execute()
+        to_return['response'] = self._select_responses(responses, interval=bool(first))
+        return to_return
@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+
+'''The logic shared by Query and AsyncQuery: everything but the IO, the commands are only added to the pipelines.'''
+
+import ipaddress
+import json
+import logging
+import time
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, Any, Optional, List, Set, Tuple, Union
+
+from redis import Redis
+from redis.asyncio.client import Pipeline as AsyncPipeline
+from redis.client import Pipeline
+from dateutil.parser import parse
+
+from .date_index import DateIndex
+from .default import get_config
+from .helpers import ip_to_hex, ondemand_stream_key, queue_key, ranges_cache_key, range_lookup_bounds, parse_range_member
+from .prefix_index import LocalLookup
+
+# Query executes the pipelines synchronously, AsyncQuery asynchronously.
+AnyPipeline = Union[Pipeline, AsyncPipeline]
+
+
+class BaseQuery():
+
+    def __init__(self):
+        self.logger = logging.getLogger(f'{self.__class__.__name__}')
+        self.logger.setLevel(get_config('generic', 'loglevel'))
+        self.storagedb = Redis(get_config('generic', 'storage_db_hostname'), get_config('generic', 'storage_db_port'), decode_responses=True)
+        self.date_indexes: Dict[str, DateIndex] = {}
+        # Dates loaded by the lookup processes, the other ones have to be loaded on demand.
+        self.cached_dates: Dict[str, Set[str]] = {}
+        # Dates in the storage: (last refresh, dates)
+        self.storage_dates: Dict[str, Tuple[float, Set[str]]] = {}
+        # If the lookup processes don't load the historical dates, the queries on them get the nearest cached date.
+        self.ondemand = get_config('generic', 'ondemand_memory_mb') > 0
+        self.sources = get_config('generic', 'sources')
+        self.query_timeout = get_config('generic', 'query_timeout')
+        self.pipeline_chunk_size = 1000
+        self.bulk_batch_size = get_config('generic', 'bulk_batch_size')
+        self.local: Optional[LocalLookup] = None
+        if local_lookup_days := get_config('generic', 'local_lookup_days'):
+            # Answer the queries on the most recent days directly, without going through the lookup processes.
+            self.local = LocalLookup(self.storagedb, self.sources, local_lookup_days)
+        # The batches of mass_query are sent directly to the lookup processes.
+        self.lookup_rpc = get_config('generic', 'lookup_rpc')
+        # Sockets of the lookup processes having each date loaded: (last refresh, {(address_family, date): [socket paths]})
+        self.rpc_holders: Dict[str, Tuple[float, Dict[Tuple[str, str], List[str]]]] = {}
+
+    def _date_index(self, source: str, address_family: str) -> DateIndex:
+        '''Get the index of the available dates, as last refreshed by the subclass.'''
+        index_key = f'{source}|{address_family}'
+        if index_key not in self.date_indexes:
+            self.date_indexes[index_key] = DateIndex(source, address_family)
+        return self.date_indexes[index_key]
+
+    def perdelta(self, start, end):
+        curr = start
+        while curr < end:
+            yield curr
+            curr += timedelta(days=1)
+
+    def _meta(self, expected_interval: Dict[str, str], cached_dates: Dict[str, Dict[str, Set[str]]]) -> Dict:
+        expected_dates = {date.isoformat() for date in self.perdelta(parse(expected_interval['first']).date(),
+                                                                     parse(expected_interval['last']).date())}
+        cached_dates_by_sources = {}
+        for source in self.sources:
+            cached_v4 = cached_dates[source]['v4']
+            temp_cached_as_date = {parse(c).date().isoformat() for c in cached_v4}
+            missing_v4 = sorted(list(expected_dates - temp_cached_as_date))
+            percent_v4 = float(len(expected_dates) - len(missing_v4)) * 100 / len(expected_dates)
+
+            cached_v6 = cached_dates[source]['v6']
+            temp_cached_as_date = {parse(c).date().isoformat() for c in cached_v6}
+            missing_v6 = sorted(list(expected_dates - temp_cached_as_date))
+            percent_v6 = float(len(expected_dates) - len(missing_v6)) * 100 / len(expected_dates)
+
+            cached_dates_by_sources[source] = {'v4': {'cached': sorted(list(cached_v4)), 'missing': missing_v4, 'percent': percent_v4},
+                                               'v6': {'cached': sorted(list(cached_v6)), 'missing': missing_v6, 'percent': percent_v6}}
+
+        return {'sources': self.sources, 'expected_interval': expected_interval,
+                'cached_dates': cached_dates_by_sources}
+
+    def _storage_dates_outdated(self, index_key: str) -> bool:
+        '''The dates in the storage are refreshed every minute.'''
+        return index_key not in self.storage_dates or self.storage_dates[index_key][0] < time.time() - 60
+
+    def _index_to_check(self, source: str, address_family: str) -> Optional[DateIndex]:
+        '''The index of the dates, if it wasn't checked in the last second.'''
+        index_key = f'{source}|{address_family}'
+        if index_key not in self.date_indexes:
+            self.date_indexes[index_key] = DateIndex(source, address_family)
+        index = self.date_indexes[index_key]
+        if index.last_check and index.last_check >= (datetime.now() - timedelta(seconds=1)):
+            return None
+        index.last_check = datetime.now()
+        return index
+
+    def _index_version(self, cached_version: Optional[str], storage_refresh: float) -> str:
+        version = f'{cached_version}|{storage_refresh}'
+        if self.local:
+            version = f'{version}|{self.local.version}'
+        return version
+
+    def _update_index(self, index: DateIndex, version: str, cached_dates: Set[str], storage_dates: Set[str]) -> None:
+        '''The available dates are the cached ones, and (if enabled) the dates in the storage older than the most recent one:
+        they are loaded on demand by the lookup processes. The ones just imported aren't, they are about to be cached.'''
+        if self.local:
+            cached_dates |= set(self.local.dates(index.source, index.address_family))
+        self.cached_dates[f'{index.source}|{index.address_family}'] = cached_dates
+        if cached_dates and self.ondemand:
+            last_cached = max(cached_dates)
+            index.update(cached_dates | {d for d in storage_dates if d < last_cached})
+        else:
+            index.update(cached_dates)
+        index.version = version
+
+    def _find_dates(self, source: str, address_family: str, *, date: Optional[str]=None,
+                    first: Optional[str]=None, last: Optional[str]=None, precision_delta: Optional[Dict[str, int]]=None):
+        index = self._date_index(source, address_family)
+        if date:
+            dates = [index.nearest(date, precision_delta)]
+        elif first:
+            dates = index.interval(first, last)
+        else:
+            # Assuming we want the latest possible date.
+            dates = [index.nearest(datetime.now(), precision_delta)]
+        return dates
+
+    def _keys_for_query(self, query: Dict) -> List[str]:
+        if 'source' in query:
+            sources = [query['source']]
+        else:
+            sources = self.sources
+        to_return = []
+        for source in sources:
+            if 'address_family' not in query:
+                if ':' in query['ip']:
+                    address_family = 'v6'
+                else:
+                    address_family = 'v4'
+            else:
+                address_family = query['address_family']
+            dates = self._find_dates(source, address_family, date=query.get('date'),
+                                     first=query.get('first'), last=query.get('last'),
+                                     precision_delta=query.get('precision_delta'))
+            if len(dates) > 1:
+                to_return += [f'{source}|{address_family}|{d}|{query["ip"]}' for d in dates]
+            else:
+                to_return.append(f'{source}|{address_family}|{dates[0]}|{query["ip"]}')
+        return to_return
+
+    def _prepare_all_keys(self, queries: List[Dict]) -> Tuple[List[str], List[Tuple[Dict, str]]]:
+        keys: List[str] = []
+        invalid_queries: List[Tuple[Dict, str]] = []
+        for query in queries:
+            try:
+                keys += self._keys_for_query(query)
+            except Exception as e:
+                invalid_queries.append((query, str(e)))
+
+        return keys, invalid_queries
+
+    def _enqueue(self, p: AnyPipeline, keys: List[str]) -> int:
+        '''Push the keys to lookup in the queues of their dates, returns the number of commands added to the pipeline.'''
+        per_queue: Dict[Tuple[str, str, str], List[str]] = {}
+        for k in keys:
+            source, address_family, date, _ = k.split('|', 3)
+            per_queue.setdefault((source, address_family, date), []).append(k)
+        commands = 0
+        for (source, address_family, date), queue_keys in per_queue.items():
+            # The queues are trimmed in case no lookup process consumes them.
+            p.xadd(queue_key(source, address_family, date), {'keys': json.dumps(queue_keys)}, maxlen=10000, approximate=True)
+            # Used by the lookup manager to replicate the most queried dates.
+            p.zincrby(f'hits|{source}|{address_family}', len(queue_keys), date)
+            commands += 2
+            if self.ondemand and date not in self.cached_dates.get(f'{source}|{address_family}', set()):
+                # Historical date, a lookup process has to load it.
+                p.xadd(ondemand_stream_key(source), {'address_family': address_family, 'date': date},
+                       maxlen=1000, approximate=True)
+                commands += 1
+        return commands
+
+    def _queue_cache_reads(self, p: AnyPipeline, keys: List[str]) -> List[Optional[str]]:
+        '''Add the commands reading the cached responses of the keys to the pipeline:
+        the response for the exact IP, and the cached range the IP may be in.'''
+        ips_hex: List[Optional[str]] = []
+        for k in keys:
+            p.hgetall(k)
+            source, address_family, date, ip = k.split('|', 3)
+            try:
+                ip_hex = ip_to_hex(ip, address_family)
+            except ValueError:
+                # Invalid IP, the lookup process stores the error for that exact key.
+                ips_hex.append(None)
+                continue
+            p.zrevrangebylex(ranges_cache_key(source, address_family, date), *range_lookup_bounds(ip_hex), start=0, num=1)
+            ips_hex.append(ip_hex)
+        return ips_hex
+
+    def _cache_reads_results(self, keys: List[str], ips_hex: List[Optional[str]], results: List) -> List[Dict]:
+        responses = []
+        results_iter = iter(results)
+        for k, ip_hex in zip(keys, ips_hex):
+            data = next(results_iter)
+            if ip_hex is not None:
+                ranges = next(results_iter)
+                if not data and ranges:
+                    data = parse_range_member(ranges[0], ip_hex) or {}
+            responses.append(data)
+        return responses
+
+    def _refresh_expire(self, p: AnyPipeline, responses: Dict[str, Dict]) -> None:
+        '''The valid answers are only cached in the ranges of their date, the exact keys only exist
+        for the errors and the IPs without ASN.'''
+        ranges_keys = set()
+        for k, data in responses.items():
+            source, address_family, date, _ = k.split('|', 3)
+            if 'error' in data or data.get('asn') == '0':
+                p.expire(k, 43200)  # 12h
+            else:
+                ranges_keys.add(ranges_cache_key(source, address_family, date))
+        for ranges_key in ranges_keys:
+            p.expire(ranges_key, 43200)  # 12h
+
+    def _resolve_mass_query(self, list_to_query: list) -> Tuple[List[Tuple[Dict, List[str], Optional[str]]], List[str]]:
+        '''The keys of each query, and all the unique keys: the keys shared by many queries are only fetched once.'''
+        keys_by_query: List[Tuple[Dict, List[str], Optional[str]]] = []
+        unique_keys: Dict[str, None] = {}
+        for to_query in list_to_query:
+            try:
+                keys = self._keys_for_query(to_query)
+                unique_keys.update(dict.fromkeys(keys))
+                keys_by_query.append((to_query, keys, None))
+            except Exception as e:
+                self.logger.warning(f'Unable to run {to_query}. - {e}')
+                # If something fails, it *has* to be in the list
+                keys_by_query.append((to_query, [], str(e)))
+        return keys_by_query, list(unique_keys.keys())
+
+    def _mass_query_response(self, list_to_query: list, keys_by_query: List[Tuple[Dict, List[str], Optional[str]]],
+                             data_by_key: Dict[str, Dict]) -> Dict:
+        to_return: Dict[str, Any] = {'meta': {'number_queries': len(list_to_query)}, 'responses': []}
+        for to_query, keys, error in keys_by_query:
+            to_append: Dict[str, Any] = {'meta': to_query, 'response': {}}
+            if error:
+                to_append['error'] = error
+                to_return['responses'].append(to_append)
+                continue
+            responses: Dict = {}
+            for k in keys:
+                self._set_response(responses, k, data_by_key[k], with_source=False)
+            to_append['response'] = self._select_responses(responses, interval='first' in to_query)
+            to_return['responses'].append(to_append)
+        return to_return
+
+    def _build_query(self, ip, source: Optional[str]=None, address_family: Optional[str]=None, date: Optional[str]=None,
+                     first: Optional[str]=None, last: Optional[str]=None, precision_delta: Optional[Dict[str, int]]=None) -> Dict:
+        query = {'ip': ip}
+        if source:
+            query['source'] = source
+        if address_family:
+            query['address_family'] = address_family
+
+        if date:
+            query['date'] = date
+        elif first:
+            query['first'] = first
+            if last:
+                query['last'] = last
+
+        if precision_delta:
+            query['precision_delta'] = precision_delta
+        return query
+
+    def _select_responses(self, responses: Dict, interval: bool) -> Dict:
+        sorted_responses = OrderedDict(sorted(responses.items(), key=lambda t: t[0], reverse=True))
+        if interval:
+            # working on an interval, return everything
+            return sorted_responses
+        # specific date, return most recent valid answer (if any)
+        if (tmp := {date: entry for date, entry in sorted_responses.items() if entry and self._valid_response(entry)}):
+            return tmp
+        return sorted_responses
+
+    def _queue_waiting(self, p: AnyPipeline, reply_list: str, keys: List[str]) -> int:
+        '''Register the reply list of the query on the keys and queue them,
+        returns the number of commands added to the pipeline.'''
+        for k in keys:
+            p.sadd(f'waiting|{k}', reply_list)
+            p.expire(f'waiting|{k}', self.query_timeout)
+        return len(keys) * 2 + self._enqueue(p, keys)
+
+    def _rpc_holders_fresh(self, source: str) -> bool:
+        '''The lookup processes having each date loaded are refreshed every second.'''
+        return source in self.rpc_holders and self.rpc_holders[source][0] >= time.time() - 1
+
+    def _rpc_workers(self, reports: Dict[str, str]) -> List[Tuple[str, str]]:
+        '''The lookup processes listening on a socket: (worker, socket path).'''
+        workers = []
+        for worker, report in reports.items():
+            if path := json.loads(report).get('rpc'):
+                workers.append((worker, path))
+        return workers
+
+    def _set_rpc_holders(self, source: str, workers: List[Tuple[str, str]], loaded_by_worker: List[Set[str]]) -> Dict[Tuple[str, str], List[str]]:
+        holders: Dict[Tuple[str, str], List[str]] = {}
+        for (_, path), loaded in zip(workers, loaded_by_worker):
+            for entry in loaded:
+                address_family, date = entry.split('|', 1)
+                holders.setdefault((address_family, date), []).append(path)
+        self.rpc_holders[source] = (time.time(), holders)
+        return holders
+
+    def _rpc_batches(self, keys: List[str]) -> Dict[Tuple[str, str, str], List[Tuple[str, str]]]:
+        '''The keys and their IP, in one batch per date.'''
+        batches: Dict[Tuple[str, str, str], List[Tuple[str, str]]] = {}
+        for k in keys:
+            source, address_family, date, ip = k.split('|', 3)
+            batches.setdefault((source, address_family, date), []).append((k, ip))
+        return batches
+
+    def _rpc_responses(self, p: AnyPipeline, responses: Dict[str, Dict], batch_key: Tuple[str, str, str],
+                       batch: List[Tuple[str, str]], results: List[Optional[Dict]]) -> None:
+        source, address_family, date = batch_key
+        for (k, ip), response in zip(batch, results):
+            if response is None:
+                response = {'error': f'Query invalid: "{address_family}" "{source}" "{date}" "{ip}"'}
+            responses[k] = response
+        # Used by the lookup manager to replicate the most queried dates.
+        p.zincrby(f'hits|{source}|{address_family}', len(batch), date)
+
+    def _lookup_local(self, keys: List[str]) -> Tuple[Dict[str, Dict], List[str]]:
+        '''Run the lookups on the dates loaded in the current process, returns the responses and the keys to lookup in the cache.'''
+        if not self.local:
+            return {}, keys
+        responses = self.local.lookup_many(keys)
+        return responses, [k for k in keys if k not in responses]
+
+    def _pop_answered(self, pending: set, responses: Dict, answered: Dict[str, Dict]) -> None:
+        for k, data in answered.items():
+            pending.discard(k)
+            self._set_response(responses, k, data)
+
+    def _valid_response(self, data: Dict) -> bool:
+        return (data.get('asn') not in [None, 0, '0']
+                and data.get('prefix') not in [None, '0.0.0.0/0', '::/0'])
+
+    def _set_response(self, responses: Dict, key: str, data: Dict, with_source: bool=True) -> None:
+        _source, _address_family, _date, _ip = key.split('|', 3)
+        if with_source:
+            data['source'] = _source
+        if _date in responses and self._valid_response(responses[_date]):
+            # we have more than one query for the same date, keep the most specific prefix
+            if (self._valid_response(data)
+                    and ipaddress.ip_network(data['prefix']).num_addresses < ipaddress.ip_network(responses[_date]['prefix']).num_addresses):
+                responses[_date] = data
+        else:
+            responses[_date] = data
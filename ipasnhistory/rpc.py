@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+import asyncio
+import socket
+import struct
+
+from typing import Dict, List, Optional
+
+import msgpack  # type: ignore
+
+from .default import get_homedir
+
+# Length of the message that follows, big endian.
+HEADER = struct.Struct('>I')
+
+
+def rpc_socket_path(source: str, worker: str) -> str:
+    '''Socket of a lookup process answering the batches of lookups directly.'''
+    return str(get_homedir() / 'cache' / f'lookup_{source}_{worker}.sock')
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise ConnectionError('Connection closed.')
+        buf += chunk
+    return bytes(buf)
+
+
+def _frame(message: Dict) -> bytes:
+    payload = msgpack.packb(message)
+    return HEADER.pack(len(payload)) + payload
+
+
+def send_message(sock: socket.socket, message: Dict) -> None:
+    sock.sendall(_frame(message))
+
+
+def recv_message(sock: socket.socket) -> Dict:
+    size, = HEADER.unpack(_recv_exactly(sock, HEADER.size))
+    return msgpack.unpackb(_recv_exactly(sock, size))
+
+
+class RPCClient():
+    '''Keeps one connection per lookup process.
+
+    Request: {'address_family': 'v4', 'date': '...', 'ips': [...]}
+    Response: {'asn': [...], 'prefix': [...]} (None for the invalid IPs), or {'error': '...'}'''
+
+    def __init__(self, timeout: int):
+        self.timeout = timeout
+        self.connections: Dict[str, socket.socket] = {}
+
+    def _connection(self, path: str) -> socket.socket:
+        if path not in self.connections:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(path)
+            self.connections[path] = sock
+        return self.connections[path]
+
+    def lookup(self, path: str, address_family: str, date: str, ips: List[str]) -> Optional[List[Optional[Dict]]]:
+        '''The responses for the IPs, None if the process couldn't answer (date not loaded anymore, process gone).'''
+        try:
+            sock = self._connection(path)
+            send_message(sock, {'address_family': address_family, 'date': date, 'ips': ips})
+            response = recv_message(sock)
+        except OSError:
+            # Most probably restarted, connect again next time.
+            self.close(path)
+            return None
+        return _responses(response)
+
+    def close(self, path: str) -> None:
+        if sock := self.connections.pop(path, None):
+            sock.close()
+
+
+def _responses(response: Dict) -> Optional[List[Optional[Dict]]]:
+    if 'error' in response:
+        return None
+    return [{'asn': asn, 'prefix': prefix} if asn is not None else None
+            for asn, prefix in zip(response['asn'], response['prefix'])]
+
+
+class AsyncRPCClient():
+    '''Same as RPCClient, for asyncio. One connection per request: the concurrent requests don't share them.'''
+
+    def __init__(self, timeout: int):
+        self.timeout = timeout
+
+    async def _lookup(self, path: str, message: Dict) -> Dict:
+        reader, writer = await asyncio.open_unix_connection(path)
+        try:
+            writer.write(_frame(message))
+            await writer.drain()
+            size, = HEADER.unpack(await reader.readexactly(HEADER.size))
+            return msgpack.unpackb(await reader.readexactly(size))
+        finally:
+            writer.close()
+
+    async def lookup(self, path: str, address_family: str, date: str, ips: List[str]) -> Optional[List[Optional[Dict]]]:
+        try:
+            response = await asyncio.wait_for(self._lookup(path, {'address_family': address_family, 'date': date, 'ips': ips}),
+                                              self.timeout)
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            return None
+        return _responses(response)
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+
+'''Layouts of the announces in the storage.
+
+sets: one set of prefixes per ASN, a set of ASNs and one key with the IP count per ASN.
+blob: the prefixes of all the ASNs in a table of fixed size records, sorted by ASN and split in
+      chunks of a few MB, plus a hash ASN -> offset, count and IP count in the table.
+      A lot less keys, and the whole date is read in a few round trips.
+delta: some dates are full checkpoints (blob), the others only store the announces (ASN, prefix) added and
+       removed since a previous date (their base), as two blobs. The size depends on the routing churn
+       instead of the size of the table. A date is rebuilt from its checkpoint and the diffs after it.'''
+
+from collections import defaultdict
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+import numpy as np
+
+from redis import Redis
+
+from .default import get_config, ConfigError
+from .helpers import format_prefix, parse_prefix
+
+STORAGE_LAYOUTS = {'sets', 'blob', 'delta'}
+
+CHUNK_RECORDS = 65536
+
+# ASN, network, length
+Announce = Tuple[str, int, int]
+
+
+def storage_layout() -> str:
+    layout = get_config('generic', 'storage_layout')
+    if layout not in STORAGE_LAYOUTS:
+        raise ConfigError(f'Invalid storage layout: {layout}, must be in {", ".join(sorted(STORAGE_LAYOUTS))}.')
+    return layout
+
+
+def record_dtype(address_family: str) -> np.dtype:
+    '''Packed record of the blob: network (big endian) and length, 5 bytes for IPv4, 17 for IPv6.'''
+    return np.dtype([('network', '>u4' if address_family == 'v4' else 'S16'), ('length', 'u1')])
+
+
+def write_blob(storagedb: Redis, key_prefix: str, address_family: str,
+               announces: Dict[str, List[Tuple[int, int]]], ipcounts: Optional[Dict[str, int]]=None) -> None:
+    '''Store the announces of a source / address family / date with the blob layout.
+    The date isn't marked as available, it is up to the caller.'''
+    if ipcounts is None:
+        max_length = 32 if address_family == 'v4' else 128
+        ipcounts = {asn: sum(1 << (max_length - length) for _, length in prefixes) for asn, prefixes in announces.items()}
+    records = np.empty(sum(len(prefixes) for prefixes in announces.values()), dtype=record_dtype(address_family))
+    index: Dict = {}
+    offset = 0
+    for asn, prefixes in announces.items():
+        count = len(prefixes)
+        if address_family == 'v4':
+            records['network'][offset:offset + count] = [network for network, _ in prefixes]
+        else:
+            records['network'][offset:offset + count] = [network.to_bytes(16, 'big') for network, _ in prefixes]
+        records['length'][offset:offset + count] = [length for _, length in prefixes]
+        index[asn] = f'{offset},{count},{ipcounts[asn]}'
+        offset += count
+    data = records.tobytes()
+    chunk_size = CHUNK_RECORDS * records.itemsize
+    p = storagedb.pipeline(transaction=False)
+    for i, start in enumerate(range(0, len(data), chunk_size)):
+        p.set(f'{key_prefix}|blob|{i}', data[start:start + chunk_size])
+    if index:
+        p.hset(f'{key_prefix}|asn_index', mapping=index)
+    # Written last: the blob is complete when its meta exists.
+    p.hset(f'{key_prefix}|blob', mapping={'records': len(records), 'chunk_records': CHUNK_RECORDS})
+    p.execute()
+
+
+def _networks(records: np.ndarray, address_family: str) -> List[int]:
+    if address_family == 'v4':
+        return records['network'].tolist()
+    return [int.from_bytes(network.ljust(16, b'\x00'), 'big') for network in records['network']]
+
+
+def _prefixes(records: np.ndarray, address_family: str) -> List[str]:
+    return [format_prefix(network, length, address_family)
+            for network, length in zip(_networks(records, address_family), records['length'].tolist())]
+
+
+def _read_records(storagedb: Redis, key_prefix: str, address_family: str, chunk_records: int,
+                  offset: int, count: int) -> np.ndarray:
+    '''Records offset to offset + count of the blob, only the chunks overlapping them are fetched.'''
+    dtype = record_dtype(address_family)
+    first_chunk, last_chunk = offset // chunk_records, (offset + count - 1) // chunk_records
+    p = storagedb.pipeline(transaction=False)
+    for chunk in range(first_chunk, last_chunk + 1):
+        start = max(offset, chunk * chunk_records) - chunk * chunk_records
+        end = min(offset + count, (chunk + 1) * chunk_records) - chunk * chunk_records
+        p.execute_command('GETRANGE', f'{key_prefix}|blob|{chunk}', start * dtype.itemsize,
+                          end * dtype.itemsize - 1, NEVER_DECODE=True)
+    return np.frombuffer(b''.join(p.execute()), dtype=dtype)
+
+
+def _blob_meta(storagedb: Redis, key_prefix: str) -> Optional[Dict[str, int]]:
+    meta = storagedb.hgetall(f'{key_prefix}|blob')
+    if not meta:
+        return None
+    return {k: int(v) for k, v in meta.items()}
+
+
+def _read_blob(storagedb: Redis, key_prefix: str, address_family: str, meta: Dict[str, int]) -> Iterator[Tuple[str, np.ndarray]]:
+    '''Yield the ASNs and their records, the whole blob is fetched at once.'''
+    index = storagedb.hgetall(f'{key_prefix}|asn_index')
+    p = storagedb.pipeline(transaction=False)
+    for chunk in range(-(-meta['records'] // meta['chunk_records'])):
+        p.execute_command('GET', f'{key_prefix}|blob|{chunk}', NEVER_DECODE=True)
+    records = np.frombuffer(b''.join(p.execute()), dtype=record_dtype(address_family))
+    for asn, entry in index.items():
+        offset, count, _ = entry.split(',')
+        yield asn, records[int(offset):int(offset) + int(count)]
+
+
+def _blob_announces(storagedb: Redis, key_prefix: str, address_family: str,
+                    asn: Optional[str]=None) -> Set[Announce]:
+    meta = _blob_meta(storagedb, key_prefix)
+    if not meta:
+        return set()
+    if asn is None:
+        return {(_a, network, length)
+                for _a, records in _read_blob(storagedb, key_prefix, address_family, meta)
+                for network, length in zip(_networks(records, address_family), records['length'].tolist())}
+    entry = storagedb.hget(f'{key_prefix}|asn_index', asn)
+    if not entry:
+        return set()
+    offset, count, _ = entry.split(',')
+    records = _read_records(storagedb, key_prefix, address_family, meta['chunk_records'], int(offset), int(count))
+    return {(asn, network, length) for network, length in zip(_networks(records, address_family), records['length'].tolist())}
+
+
+def _sets_announces(storagedb: Redis, key_prefix: str, address_family: str,
+                    asn: Optional[str]=None) -> Set[Announce]:
+    asns = list(storagedb.smembers(f'{key_prefix}|asns')) if asn is None else [asn]
+    p = storagedb.pipeline()
+    [p.smembers(f'{key_prefix}|{_a}') for _a in asns]
+    return {(_a, *parse_prefix(prefix, address_family))
+            for _a, prefixes in zip(asns, p.execute()) for prefix in prefixes}
+
+
+def _layout(storagedb: Redis, key_prefix: str) -> str:
+    '''Layout of a date in the storage.'''
+    p = storagedb.pipeline(transaction=False)
+    p.exists(f'{key_prefix}|delta')
+    p.exists(f'{key_prefix}|blob')
+    is_delta, is_blob = p.execute()
+    if is_delta:
+        return 'delta'
+    if is_blob:
+        return 'blob'
+    return 'sets'
+
+
+def read_table(storagedb: Redis, source: str, address_family: str, announces_date: str,
+               asn: Optional[str]=None) -> Set[Announce]:
+    '''All the announces of a date (or only the ones of an ASN), from any layout.
+    The diffs are applied to the checkpoint they are based on.'''
+    diffs: List[str] = []
+    key_prefix = f'{source}|{address_family}|{announces_date}'
+    while True:
+        base = storagedb.hget(f'{key_prefix}|delta', 'base')
+        if not base:
+            break
+        diffs.append(key_prefix)
+        key_prefix = f'{source}|{address_family}|{base}'
+    if _layout(storagedb, key_prefix) == 'blob':
+        table = _blob_announces(storagedb, key_prefix, address_family, asn)
+    else:
+        table = _sets_announces(storagedb, key_prefix, address_family, asn)
+    for key_prefix in reversed(diffs):
+        table -= _blob_announces(storagedb, f'{key_prefix}|removed', address_family, asn)
+        table |= _blob_announces(storagedb, f'{key_prefix}|added', address_family, asn)
+    return table
+
+
+def _group(table: Iterable[Announce]) -> Dict[str, List[Tuple[int, int]]]:
+    announces: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+    for asn, network, length in sorted(table):
+        announces[asn].append((network, length))
+    return announces
+
+
+def write_delta(storagedb: Redis, source: str, address_family: str, announces_date: str,
+                table: Set[Announce], base_date: str, base_table: Set[Announce]) -> None:
+    '''Store a date as the diff with base_date.
+    The date isn't marked as available, it is up to the caller.'''
+    key_prefix = f'{source}|{address_family}|{announces_date}'
+    write_blob(storagedb, f'{key_prefix}|added', address_family, _group(table - base_table))
+    write_blob(storagedb, f'{key_prefix}|removed', address_family, _group(base_table - table))
+    storagedb.hset(f'{key_prefix}|delta', 'base', base_date)
+
+
+def write_checkpoint(storagedb: Redis, source: str, address_family: str, announces_date: str,
+                     table: Set[Announce]) -> None:
+    '''Store a date in full (blob layout). If it was a diff, it doesn't depend on its base anymore.'''
+    key_prefix = f'{source}|{address_family}|{announces_date}'
+    write_blob(storagedb, key_prefix, address_family, _group(table))
+    storagedb.delete(f'{key_prefix}|delta')
+    _delete_keys(storagedb, f'{key_prefix}|added|*')
+    _delete_keys(storagedb, f'{key_prefix}|removed|*')
+
+
+def base_date(storagedb: Redis, source: str, address_family: str, announces_date: str) -> Optional[str]:
+    return storagedb.hget(f'{source}|{address_family}|{announces_date}|delta', 'base')
+
+
+def depth(storagedb: Redis, source: str, address_family: str, announces_date: str) -> int:
+    '''Number of diffs between a date and its checkpoint, 0 for a checkpoint.'''
+    diffs = 0
+    base = base_date(storagedb, source, address_family, announces_date)
+    while base:
+        diffs += 1
+        base = base_date(storagedb, source, address_family, base)
+    return diffs
+
+
+def _delete_keys(storagedb: Redis, pattern: str) -> None:
+    p = storagedb.pipeline(transaction=False)
+    for i, key in enumerate(storagedb.scan_iter(pattern, count=10000), 1):
+        p.delete(key)
+        if not i % 10000:
+            p.execute()
+    p.execute()
+
+
+def delete_full(storagedb: Redis, source: str, address_family: str, announces_date: str) -> None:
+    '''Remove the full (sets or blob) version of a date that is now stored as a diff.'''
+    key_prefix = f'{source}|{address_family}|{announces_date}'
+    p = storagedb.pipeline(transaction=False)
+    for asn in storagedb.smembers(f'{key_prefix}|asns'):
+        p.delete(f'{key_prefix}|{asn}', f'{key_prefix}|{asn}|ipcount')
+    p.delete(f'{key_prefix}|asns', f'{key_prefix}|blob', f'{key_prefix}|asn_index')
+    p.execute()
+    _delete_keys(storagedb, f'{key_prefix}|blob|*')
+
+
+def delete_date(storagedb: Redis, source: str, address_family: str, announces_date: str) -> None:
+    '''Remove a date from the storage, whatever its layout. Nothing can be based on it anymore.'''
+    storagedb.srem(f'{source}|{address_family}|dates', announces_date)
+    _delete_keys(storagedb, f'{source}|{address_family}|{announces_date}|*')
+
+
+def read_announces(storagedb: Redis, source: str, address_family: str, announces_date: str) -> Iterator[Tuple[str, Set[str]]]:
+    '''Yield the ASNs and their prefixes, from any layout.'''
+    key_prefix = f'{source}|{address_family}|{announces_date}'
+    layout = _layout(storagedb, key_prefix)
+    if layout == 'sets':
+        asns = storagedb.smembers(f'{key_prefix}|asns')
+        p = storagedb.pipeline()
+        [p.smembers(f'{key_prefix}|{asn}') for asn in asns]
+        yield from zip(asns, p.execute())
+    elif layout == 'blob':
+        meta = _blob_meta(storagedb, key_prefix)
+        if meta:
+            for asn, records in _read_blob(storagedb, key_prefix, address_family, meta):
+                yield asn, set(_prefixes(records, address_family))
+    else:
+        for asn, prefixes in _group(read_table(storagedb, source, address_family, announces_date)).items():
+            yield asn, {format_prefix(network, length, address_family) for network, length in prefixes}
+
+
+def read_asn_meta(storagedb: Redis, source: str, address_family: str, announces_date: str,
+                  asn: Optional[Union[int, str]]=None) -> Dict:
+    '''Prefixes and IP count of one or all the ASNs, from any layout.
+    An unknown ASN has no prefixes and no IP count.'''
+    key_prefix = f'{source}|{address_family}|{announces_date}'
+    data: Dict = {}
+    layout = _layout(storagedb, key_prefix)
+    if layout == 'sets':
+        asns = storagedb.smembers(f'{key_prefix}|asns') if asn is None else {asn}
+        for _a in asns:
+            prefixes = storagedb.smembers(f'{key_prefix}|{_a}')
+            ipcount = storagedb.get(f'{key_prefix}|{_a}|ipcount')
+            data[_a] = {'prefixes': list(prefixes), 'ipcount': ipcount}
+        return data
+    if layout == 'blob':
+        meta = _blob_meta(storagedb, key_prefix)
+        if asn is None and meta:
+            for _a, prefixes in read_announces(storagedb, source, address_family, announces_date):
+                data[_a] = {'prefixes': list(prefixes)}
+            for _a, entry in storagedb.hgetall(f'{key_prefix}|asn_index').items():
+                data[_a]['ipcount'] = entry.rsplit(',', 1)[1]
+            return data
+        entry = storagedb.hget(f'{key_prefix}|asn_index', str(asn))
+        if not meta or not entry:
+            return {asn: {'prefixes': [], 'ipcount': None}}
+        offset, count, ipcount = entry.split(',')
+        records = _read_records(storagedb, key_prefix, address_family, meta['chunk_records'], int(offset), int(count))
+        return {asn: {'prefixes': _prefixes(records, address_family), 'ipcount': ipcount}}
+    max_length = 32 if address_family == 'v4' else 128
+    table = read_table(storagedb, source, address_family, announces_date, None if asn is None else str(asn))
+    for _a, announces in _group(table).items():
+        data[_a if asn is None else asn] = {'prefixes': [format_prefix(network, length, address_family) for network, length in announces],
+                                           'ipcount': str(sum(1 << (max_length - length) for _, length in announces))}
+    if asn is not None and asn not in data:
+        data[asn] = {'prefixes': [], 'ipcount': None}
+    return data
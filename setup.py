@@ -13,8 +13,7 @@ setup(
     packages=['ipasnhistory'],
     scripts=['bin/run_backend.py', 'bin/caida_dl.py', 'bin/start.py', 'bin/stop.py', 'bin/shutdown.py',
              'bin/caida_loader.py', 'bin/lookup.py', 'bin/lookup_manager.py', 'bin/start_website.py',
-             'bin/ripe_dl.py', 'bin/ripe_loader.py',
-             'bin/install_bgpdumpy.sh'],
+             'bin/ripe_dl.py', 'bin/ripe_loader.py', 'bin/storage_compactor.py'],
     classifiers=[
         'License :: OSI Approved :: GNU Affero General Public License v3 or later (AGPLv3+)',
         'Development Status :: 3 - Alpha',
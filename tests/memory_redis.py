@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+'''In memory replacement of the storage and cache databases (decode_responses=True), only the commands used in the tests.'''
+
+import asyncio
+import time
+
+from fnmatch import fnmatchcase
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple, Union
+
+
+def _encode(value: Any) -> Union[str, bytes]:
+    return value if isinstance(value, bytes) else str(value)
+
+
+def _decode(value: Optional[Union[str, bytes]]) -> Optional[str]:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class MemoryPipeline():
+
+    def __init__(self, db: 'MemoryRedis'):
+        self.db = db
+        self.commands: List = []
+
+    def __getattr__(self, name: str):
+        def queue(*args, **kwargs):
+            self.commands.append((getattr(self.db, name), args, kwargs))
+            return self
+        return queue
+
+    def execute(self) -> List:
+        results = [command(*args, **kwargs) for command, args, kwargs in self.commands]
+        self.commands = []
+        return results
+
+
+class MemoryRedis():
+
+    def __init__(self):
+        # str or bytes, set, dict (hash), or dict of floats (sorted set)
+        self.data: Dict[str, Any] = {}
+
+    def pipeline(self, transaction: bool=True) -> MemoryPipeline:
+        return MemoryPipeline(self)
+
+    def set(self, key: str, value: Any) -> bool:
+        self.data[key] = _encode(value)
+        return True
+
+    def get(self, key: str) -> Optional[str]:
+        return _decode(self.data.get(key))
+
+    def execute_command(self, command: str, key: str, *args, NEVER_DECODE: bool=False) -> Optional[bytes]:
+        value = self.data.get(key)
+        if value is None:
+            return b'' if command == 'GETRANGE' else None
+        value = value if isinstance(value, bytes) else value.encode()
+        if command == 'GETRANGE':
+            return value[args[0]:args[1] + 1]
+        return value
+
+    def exists(self, *keys: str) -> int:
+        return sum(key in self.data for key in keys)
+
+    def delete(self, *keys: str) -> int:
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    def scan_iter(self, match: str='*', count: Optional[int]=None) -> Iterator[str]:
+        yield from [key for key in self.data if fnmatchcase(key, match)]
+
+    def hset(self, key: str, field: Optional[str]=None, value: Any=None, mapping: Optional[Dict]=None) -> int:
+        h = self.data.setdefault(key, {})
+        new = dict(mapping or {})
+        if field is not None:
+            new[field] = value
+        added = len(new.keys() - h.keys())
+        h.update({k: _encode(v) for k, v in new.items()})
+        return added
+
+    def hget(self, key: str, field: str) -> Optional[str]:
+        return self.data.get(key, {}).get(field)
+
+    def hgetall(self, key: str) -> Dict[str, str]:
+        return dict(self.data.get(key, {}))
+
+    def sadd(self, key: str, *members: Any) -> int:
+        s = self.data.setdefault(key, set())
+        added = len({str(m) for m in members} - s)
+        s.update(str(m) for m in members)
+        return added
+
+    def srem(self, key: str, *members: Any) -> int:
+        s = self.data.get(key, set())
+        removed = len(s & {str(m) for m in members})
+        s.difference_update(str(m) for m in members)
+        if not s and key in self.data:
+            del self.data[key]
+        return removed
+
+    def smembers(self, key: str) -> Set[str]:
+        return set(self.data.get(key, set()))
+
+    def sismember(self, key: str, member: Any) -> bool:
+        return str(member) in self.data.get(key, set())
+
+    def zrange(self, key: str, start: int, end: int, withscores: bool=False) -> List:
+        members = sorted(self.data.get(key, {}).items(), key=lambda member: (member[1], member[0]))
+        members = members[start:None if end == -1 else end + 1]
+        return members if withscores else [member for member, _ in members]
+
+    def zunionstore(self, dest: str, keys: Dict[str, float]) -> int:
+        union: Dict[str, float] = {}
+        for key, weight in keys.items():
+            for member, score in self.data.get(key, {}).items():
+                union[member] = union.get(member, 0) + score * weight
+        self.data[dest] = union
+        return len(union)
+
+    def zremrangebyscore(self, key: str, minimum: float, maximum: float) -> int:
+        zset = self.data.get(key, {})
+        removed = [member for member, score in zset.items() if minimum <= score <= maximum]
+        for member in removed:
+            del zset[member]
+        return len(removed)
+
+    def expire(self, key: str, seconds: int) -> bool:
+        return key in self.data
+
+    def xadd(self, key: str, fields: Dict, maxlen: Optional[int]=None, approximate: bool=True) -> str:
+        stream = self.data.setdefault(key, [])
+        stream.append(fields)
+        return f'0-{len(stream)}'
+
+    def zincrby(self, key: str, amount: float, member: str) -> float:
+        zset = self.data.setdefault(key, {})
+        zset[member] = zset.get(member, 0) + amount
+        return zset[member]
+
+    def zrevrangebylex(self, key: str, maximum: str, minimum: str, start: Optional[int]=None, num: Optional[int]=None) -> List[str]:
+        # Only the bounds used by the queries: inclusive maximum, no minimum.
+        members = sorted((member for member in self.data.get(key, {}) if member <= maximum[1:]), reverse=True)
+        return members[:num]
+
+    def rpush(self, key: str, *values: Any) -> int:
+        values_list = self.data.setdefault(key, [])
+        values_list.extend(str(v) for v in values)
+        return len(values_list)
+
+    def lpop(self, key: str, count: Optional[int]=None) -> Union[None, str, List[str]]:
+        values_list = self.data.get(key)
+        if not values_list:
+            return None
+        popped = values_list[:count or 1]
+        del values_list[:count or 1]
+        if not values_list:
+            del self.data[key]
+        return popped if count else popped[0]
+
+
+class AsyncMemoryPipeline(MemoryPipeline):
+
+    async def execute(self) -> List:  # type: ignore[override]
+        return super().execute()
+
+
+class AsyncMemoryRedis():
+    '''Same as MemoryRedis, for redis.asyncio.'''
+
+    def __init__(self, db: Optional[MemoryRedis]=None):
+        self.db = db or MemoryRedis()
+
+    def pipeline(self, transaction: bool=True) -> AsyncMemoryPipeline:
+        return AsyncMemoryPipeline(self.db)
+
+    def __getattr__(self, name: str):
+        command = getattr(self.db, name)
+
+        async def run(*args, **kwargs):
+            return command(*args, **kwargs)
+        return run
+
+    async def blpop(self, keys: List[str], timeout: float=0) -> Optional[Tuple[str, str]]:
+        deadline = time.monotonic() + timeout
+        while True:
+            for key in keys:
+                if (value := self.db.lpop(key)) is not None:
+                    return key, str(value)
+            if timeout and time.monotonic() >= deadline:
+                return None
+            await asyncio.sleep(0.01)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+import gzip
+import importlib.util
+import logging
+import os
+import random
+import tempfile
+import unittest
+
+from pathlib import Path
+from typing import Dict, List
+
+from aiohttp import ClientSession, web
+from aiohttp.test_utils import TestServer
+
+root = Path(__file__).resolve().parent.parent
+os.environ.setdefault('IPASNHISTORY_HOME', str(root))
+
+from ipasnhistory.download import download_file  # noqa: E402
+
+# The scripts in bin aren't a package
+spec = importlib.util.spec_from_file_location('caida_dl', root / 'bin' / 'caida_dl.py')
+caida_dl = importlib.util.module_from_spec(spec)  # type: ignore[arg-type]
+spec.loader.exec_module(caida_dl)  # type: ignore[union-attr]
+
+logger = logging.getLogger('test_download')
+
+
+class TestDownloadFile(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.served = Path(directory.name) / 'served'
+        self.served.mkdir()
+        self.store_path = Path(directory.name) / 'bview.gz'
+        self.part_path = self.store_path.with_name('bview.gz.part')
+        self.validator_path = self.store_path.with_name('bview.gz.part.validator')
+        self.requests: List[Dict[str, str]] = []
+
+        async def handler(request: web.Request) -> web.StreamResponse:
+            if request.method == 'GET':
+                self.requests.append(dict(request.headers))
+            return web.FileResponse(self.served / request.match_info['name'])
+
+        app = web.Application()
+        app.router.add_get('/{name}', handler)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        self.session = ClientSession()
+        self.url = str(self.server.make_url('/bview.gz'))
+
+    async def asyncTearDown(self):
+        await self.session.close()
+        await self.server.close()
+
+    def publish(self, content: bytes) -> bytes:
+        data = gzip.compress(content)
+        (self.served / 'bview.gz').write_bytes(data)
+        return data
+
+    async def validator(self) -> str:
+        async with self.session.head(self.url) as r:
+            return r.headers['ETag']
+
+    async def test_download(self):
+        data = self.publish(random.Random(1).randbytes(10000))
+        self.assertTrue(await download_file(self.session, self.url, self.store_path, logger))
+        self.assertEqual(self.store_path.read_bytes(), data)
+        self.assertFalse(self.part_path.exists())
+        self.assertFalse(self.validator_path.exists())
+
+    async def test_resume(self):
+        data = self.publish(random.Random(1).randbytes(10000))
+        self.part_path.write_bytes(data[:100])
+        self.validator_path.write_text(await self.validator())
+        self.assertTrue(await download_file(self.session, self.url, self.store_path, logger))
+        self.assertEqual(self.store_path.read_bytes(), data)
+        self.assertEqual(self.requests[-1]['Range'], 'bytes=100-')
+        self.assertFalse(self.validator_path.exists())
+
+    async def test_changed_upstream(self):
+        old = self.publish(random.Random(1).randbytes(10000))
+        self.part_path.write_bytes(old[:100])
+        validator = await self.validator()
+        self.validator_path.write_text(validator)
+        # Different size, the ETag changes
+        new = self.publish(random.Random(2).randbytes(20000))
+        self.assertTrue(await download_file(self.session, self.url, self.store_path, logger))
+        self.assertEqual(self.store_path.read_bytes(), new)
+        self.assertEqual(self.requests[0]['If-Range'], validator)
+
+    async def test_already_complete(self):
+        data = self.publish(random.Random(1).randbytes(10000))
+        self.part_path.write_bytes(data)
+        self.validator_path.write_text(await self.validator())
+        self.assertTrue(await download_file(self.session, self.url, self.store_path, logger))
+        self.assertEqual(self.store_path.read_bytes(), data)
+        # Not downloaded again
+        self.assertEqual(len(self.requests), 1)
+
+    async def test_no_validator(self):
+        # Can't know if the partial file is from the same remote file: start over.
+        data = self.publish(random.Random(1).randbytes(10000))
+        self.part_path.write_bytes(b'garbage')
+        self.assertTrue(await download_file(self.session, self.url, self.store_path, logger))
+        self.assertEqual(self.store_path.read_bytes(), data)
+        self.assertNotIn('Range', self.requests[-1])
+
+    async def test_not_gzip(self):
+        (self.served / 'bview.gz').write_bytes(b'<html>Not found</html>')
+        self.assertFalse(await download_file(self.session, self.url, self.store_path, logger))
+        self.assertFalse(self.store_path.exists())
+        self.assertFalse(self.part_path.exists())
+
+    async def test_unreachable(self):
+        url = str(self.server.make_url('/missing.gz'))
+        self.assertFalse(await download_file(self.session, url, self.store_path, logger))
+        self.assertFalse(self.store_path.exists())
+
+
+class TestConditionalGet(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.responses: List[int] = []
+
+        async def handler(request: web.Request) -> web.StreamResponse:
+            if request.headers.get('If-None-Match') == '"v1"':
+                self.responses.append(304)
+                return web.Response(status=304)
+            self.responses.append(200)
+            return web.Response(text='creation log', headers={'ETag': '"v1"'})
+
+        app = web.Application()
+        app.router.add_get('/pfx2as-creation.log', handler)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        self.session = ClientSession()
+        self.downloader = caida_dl.CaidaDownloader.__new__(caida_dl.CaidaDownloader)
+        self.downloader.logger = logger
+        self.downloader.fetched = {}
+
+    async def asyncTearDown(self):
+        await self.session.close()
+        await self.server.close()
+
+    async def test_not_modified(self):
+        url = str(self.server.make_url('/pfx2as-creation.log'))
+        self.assertEqual(await self.downloader._get_text(self.session, url), 'creation log')
+        self.assertEqual(await self.downloader._get_text(self.session, url), 'creation log')
+        self.assertEqual(self.responses, [200, 304])
+
+
+if __name__ == '__main__':
+    unittest.main()
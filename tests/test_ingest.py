@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import threading
+import time
+import unittest
+
+from concurrent.futures import ThreadPoolExecutor
+
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+os.environ.setdefault('IPASNHISTORY_HOME', str(Path(__file__).resolve().parent.parent))
+
+from ipasnhistory.helpers import get_snapshot_dir, parse_prefix  # noqa: E402
+from ipasnhistory.ingest import AnnouncesWriter, run_chains  # noqa: E402
+from ipasnhistory.storage import read_table  # noqa: E402
+
+from tests.memory_redis import MemoryRedis  # noqa: E402
+
+SOURCE = 'test_ingest'
+
+ANNOUNCES = [('1', '192.0.2.0/24'), ('2', '192.0.2.0/24'), ('1', '192.0.2.0/24'),
+             ('3', '198.51.100.0/24'), ('3', '203.0.113.0/25'), ('4', '203.0.113.0/25')]
+
+
+class TestAnnouncesWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.storagedb = MemoryRedis()
+        self.addCleanup(shutil.rmtree, get_snapshot_dir() / SOURCE, ignore_errors=True)
+
+    def writer(self, layout: str, chunk_size: int=50000) -> AnnouncesWriter:
+        writer = AnnouncesWriter(self.storagedb, SOURCE, 'v4', '2024-01-01', chunk_size)  # type: ignore[arg-type]
+        writer.layout = layout
+        return writer
+
+    def test_all_origins(self):
+        '''The prefixes announced by several ASNs are stored for all of them, and only once.'''
+        expected = {(asn, *parse_prefix(prefix, 'v4')) for asn, prefix in ANNOUNCES}
+        for layout in ['sets', 'blob', 'delta']:
+            with self.subTest(layout=layout):
+                self.storagedb.data.clear()
+                writer = self.writer(layout)
+                for asn, prefix in ANNOUNCES:
+                    writer.add_prefix(asn, prefix)
+                self.assertEqual(writer.finish(), 3)
+                self.assertEqual(read_table(self.storagedb, SOURCE, 'v4', '2024-01-01'), expected)  # type: ignore[arg-type]
+                if layout != 'sets':
+                    self.assertEqual(sum(len(prefixes) for prefixes in writer.announces().values()), len(expected))
+
+    def test_discard(self):
+        for layout in ['sets', 'blob']:
+            with self.subTest(layout=layout):
+                writer = self.writer(layout, chunk_size=2)
+                for asn, prefix in ANNOUNCES:
+                    writer.add_prefix(asn, prefix)
+                writer.discard()
+                self.assertEqual(self.storagedb.data, {})
+
+    def test_discard_after_finish(self):
+        writer = self.writer('sets')
+        for asn, prefix in ANNOUNCES:
+            writer.add_prefix(asn, prefix)
+        writer.finish()
+        writer.discard()
+        self.assertEqual(self.storagedb.data, {})
+
+
+class TestRunChains(unittest.TestCase):
+
+    def test_order(self):
+        '''The args of a chain run one after the other, in order, the chains in parallel.'''
+        running: Dict[str, int] = {'v4': 0, 'v6': 0}
+        started: List[Tuple[str, str]] = []
+        lock = threading.Lock()
+
+        def load(address_family: str, date: str) -> str:
+            with lock:
+                running[address_family] += 1
+                self.assertEqual(running[address_family], 1)
+                started.append((address_family, date))
+            time.sleep(0.01)
+            with lock:
+                running[address_family] -= 1
+            return date
+
+        chains = [[('v4', f'2024-01-0{day}') for day in range(1, 6)], [('v6', f'2024-01-0{day}') for day in range(1, 4)], []]
+        with ThreadPoolExecutor(4) as executor:
+            completed = [(args, future.result()) for args, future in run_chains(executor, load, chains)]
+        self.assertEqual(len(completed), 8)
+        for args, date in completed:
+            self.assertEqual(args[1], date)
+        for chain in chains:
+            self.assertEqual([args for args in started if args in chain], chain)
+
+
+if __name__ == '__main__':
+    unittest.main()
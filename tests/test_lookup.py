@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+import importlib.util
+import os
+import sys
+import threading
+import unittest
+
+from pathlib import Path
+from typing import List, Tuple
+
+root = Path(__file__).resolve().parent.parent
+os.environ.setdefault('IPASNHISTORY_HOME', str(root))
+
+# The scripts in bin aren't a package
+spec = importlib.util.spec_from_file_location('lookup', root / 'bin' / 'lookup.py')
+lookup = importlib.util.module_from_spec(spec)  # type: ignore[arg-type]
+spec.loader.exec_module(lookup)  # type: ignore[union-attr]
+
+
+class TestLastUsed(unittest.TestCase):
+
+    def setUp(self):
+        self.lookup = lookup.Lookup.__new__(lookup.Lookup)
+        self.lookup.last_used = {}
+        self.lookup.last_used_lock = threading.Lock()
+        self.lookup.sizes = {}
+        self.lookup.ondemand_budget = 10
+        self.unloaded: List[Tuple[str, str]] = []
+        self.lookup.unload_tree = lambda announces_date, address_family: self.unloaded.append((address_family, announces_date))
+
+    def test_no_ghost_entries(self):
+        '''A date unloaded while it is being touched by the lookups isn't tracked anymore.'''
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        self.addCleanup(sys.setswitchinterval, switch_interval)
+        dates = [('v4', f'2024-01-{day:02}') for day in range(1, 29)]
+        for i, key in enumerate(dates):
+            self.lookup.last_used[key] = float(i)
+            self.lookup.sizes[key] = 1
+        done = threading.Event()
+
+        def touch():
+            while not done.is_set():
+                for address_family, announces_date in dates:
+                    self.lookup._touch(address_family, announces_date)
+
+        threads = [threading.Thread(target=touch) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        # Unload all of them
+        self.lookup._make_room(self.lookup.ondemand_budget + 1)
+        done.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.lookup.last_used, {})
+        self.assertCountEqual(self.unloaded, dates)
+
+
+if __name__ == '__main__':
+    unittest.main()
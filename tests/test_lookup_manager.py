@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+import importlib.util
+import logging
+import os
+import unittest
+
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Dict
+
+root = Path(__file__).resolve().parent.parent
+os.environ.setdefault('IPASNHISTORY_HOME', str(root))
+
+from tests.memory_redis import MemoryRedis  # noqa: E402
+
+# The scripts in bin aren't a package
+spec = importlib.util.spec_from_file_location('lookup_manager', root / 'bin' / 'lookup_manager.py')
+lookup_manager = importlib.util.module_from_spec(spec)  # type: ignore[arg-type]
+spec.loader.exec_module(lookup_manager)  # type: ignore[union-attr]
+
+DATES = [f'2024-01-0{day}' for day in range(1, 6)]
+
+
+class TestSchedule(unittest.TestCase):
+
+    def schedule(self, shared_snapshots: bool) -> Dict[str, int]:
+        '''Schedule 5 dates of 400 bytes with 2 replicas on 3 processes of 1000 bytes, returns the replicas of each date.'''
+        manager = lookup_manager.LookupManager.__new__(lookup_manager.LookupManager)
+        manager.logger = logging.getLogger('test_lookup_manager')
+        manager.logger.setLevel(logging.WARNING)
+        manager.cache = MemoryRedis()
+        manager.storagedb = MemoryRedis()
+        manager.running_processes = {'caida': {str(i): SimpleNamespace(poll=lambda: None) for i in range(3)}}
+        manager.replicas = 2
+        manager.worker_budget = 1000
+        manager.shared_snapshots = shared_snapshots
+        manager.storagedb.sadd('caida|v4|dates', *DATES)
+        manager.cache.hset('tree_sizes|caida|v4', mapping={d: 400 for d in DATES})
+        manager.schedule('caida')
+        replicas: Dict[str, int] = {}
+        for i in range(3):
+            for entry in manager.cache.smembers(f'assignment|caida|{i}'):
+                replicas[entry.split('|', 1)[1]] = replicas.get(entry.split('|', 1)[1], 0) + 1
+        return replicas
+
+    def test_private_trees(self):
+        # Each replica uses 400 bytes: 3 dates fit in 3000 bytes, the most recent ones.
+        self.assertEqual(self.schedule(shared_snapshots=False), {d: 2 for d in DATES[2:]})
+
+    def test_shared_snapshots(self):
+        # Each date uses 400 bytes on the host, whatever its replicas: they all fit.
+        replicas = self.schedule(shared_snapshots=True)
+        self.assertEqual(set(replicas), set(DATES))
+        self.assertTrue(all(count >= 2 for count in replicas.values()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+import gzip
+import struct
+import tempfile
+import unittest
+
+from ipaddress import ip_network
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from ipasnhistory.mrt import AS_SEQUENCE, AS_SET, TABLE_DUMP_V2, parse_records, read_chunks, routes
+
+Segment = Tuple[int, List[int]]
+
+
+def as_path(segments: List[Segment], extended: bool=False) -> bytes:
+    '''AS_PATH attribute, 4 bytes ASNs.'''
+    value = b''.join(struct.pack('>BB', segment_type, len(asns)) + b''.join(struct.pack('>I', asn) for asn in asns)
+                     for segment_type, asns in segments)
+    if extended:
+        return struct.pack('>BBH', 0x50, 2, len(value)) + value
+    return struct.pack('>BBB', 0x40, 2, len(value)) + value
+
+
+def origin() -> bytes:
+    '''ORIGIN attribute (IGP), before the AS_PATH in the real dumps.'''
+    return struct.pack('>BBBB', 0x40, 1, 1, 0)
+
+
+def rib(subtype: int, prefix: str, entries: List[bytes], addpath: bool=False) -> bytes:
+    '''A complete TABLE_DUMP_V2 RIB record, entries are the attributes of each RIB entry.'''
+    network = ip_network(prefix)
+    body = struct.pack('>IB', 0, network.prefixlen) + network.network_address.packed[:(network.prefixlen + 7) // 8]
+    body += struct.pack('>H', len(entries))
+    for i, attributes in enumerate(entries):
+        body += struct.pack('>HI', i, 1700000000)
+        if addpath:
+            body += struct.pack('>I', i + 1)
+        body += struct.pack('>H', len(attributes)) + attributes
+    return struct.pack('>IHHI', 1700000000, TABLE_DUMP_V2, subtype, len(body)) + body
+
+
+def peer_index_table() -> bytes:
+    body = struct.pack('>I', 0x0a000001) + struct.pack('>H', 0) + struct.pack('>H', 0)
+    return struct.pack('>IHHI', 1700000000, TABLE_DUMP_V2, 1, len(body)) + body
+
+
+def route(prefix: str, asn: str) -> Tuple[str, int, int, str]:
+    network = ip_network(prefix)
+    return f'v{network.version}', int(network.network_address), network.prefixlen, asn
+
+
+class TestParseRecords(unittest.TestCase):
+
+    def parse(self, record: bytes) -> Optional[Tuple[str, int, int, str]]:
+        parsed = parse_records(record)
+        self.assertLessEqual(len(parsed), 1)
+        return parsed[0] if parsed else None
+
+    def test_ipv4_unicast(self):
+        record = rib(2, '192.0.2.0/24', [origin() + as_path([(AS_SEQUENCE, [64496, 64497])])])
+        self.assertEqual(self.parse(record), route('192.0.2.0/24', '64497'))
+
+    def test_ipv6_unicast(self):
+        record = rib(4, '2001:db8:1200::/40', [origin() + as_path([(AS_SEQUENCE, [64496, 64511])], extended=True)])
+        self.assertEqual(self.parse(record), route('2001:db8:1200::/40', '64511'))
+
+    def test_unaligned_prefix(self):
+        # Only the bytes covering the prefix length are in the record
+        record = rib(2, '10.128.0.0/9', [as_path([(AS_SEQUENCE, [64496])])])
+        self.assertEqual(self.parse(record), route('10.128.0.0/9', '64496'))
+        record = rib(2, '0.0.0.0/0', [as_path([(AS_SEQUENCE, [64496])])])
+        self.assertEqual(self.parse(record), route('0.0.0.0/0', '64496'))
+
+    def test_addpath(self):
+        for subtype, prefix in [(8, '198.51.100.0/24'), (10, '2001:db8::/32')]:
+            with self.subTest(subtype=subtype):
+                record = rib(subtype, prefix, [as_path([(AS_SEQUENCE, [64496])]), as_path([(AS_SEQUENCE, [64500, 64501])])],
+                             addpath=True)
+                # The last entry is used
+                self.assertEqual(self.parse(record), route(prefix, '64501'))
+
+    def test_four_bytes_asn(self):
+        record = rib(2, '203.0.113.0/24', [as_path([(AS_SEQUENCE, [64496, 4200000000])])])
+        self.assertEqual(self.parse(record), route('203.0.113.0/24', '4200000000'))
+
+    def test_as_set(self):
+        # Single member AS_SET after the sequence: its AS is the origin
+        record = rib(2, '203.0.113.0/24', [as_path([(AS_SEQUENCE, [64496, 64497]), (AS_SET, [64510])])])
+        self.assertEqual(self.parse(record), route('203.0.113.0/24', '64510'))
+        # Multi members AS_SET: skipped, the last AS of the sequence is used
+        record = rib(2, '203.0.113.0/24', [as_path([(AS_SEQUENCE, [64496, 64497]), (AS_SET, [64510, 64511])])])
+        self.assertEqual(self.parse(record), route('203.0.113.0/24', '64497'))
+        # Nothing usable
+        record = rib(2, '203.0.113.0/24', [as_path([(AS_SET, [64510, 64511])])])
+        self.assertIsNone(self.parse(record))
+
+    def test_skipped_records(self):
+        self.assertIsNone(self.parse(peer_index_table()))
+        # No entries
+        self.assertIsNone(self.parse(rib(2, '192.0.2.0/24', [])))
+        # No AS_PATH
+        self.assertIsNone(self.parse(rib(2, '192.0.2.0/24', [origin()])))
+
+
+class TestRoutes(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.records = [peer_index_table()]
+        self.expected = []
+        for i in range(300):
+            prefix = f'10.{i // 256}.{i % 256}.0/24' if i % 3 else f'2001:db8:{i:x}::/48'
+            subtype = (2 if i % 3 else 4) + (6 if i % 5 == 0 else 0)
+            self.records.append(rib(subtype, prefix, [origin() + as_path([(AS_SEQUENCE, [64496, 64496 + i])])],
+                                    addpath=i % 5 == 0))
+            self.expected.append(route(prefix, str(64496 + i)))
+
+    def write(self, data: bytes) -> Path:
+        path = Path(self.directory.name) / 'bview.gz'
+        with gzip.open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_chunks(self):
+        path = self.write(b''.join(self.records))
+        chunks = list(read_chunks(path, chunk_size=1000))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual([r for chunk in chunks for r in parse_records(chunk)], self.expected)
+
+    def test_processes(self):
+        path = self.write(b''.join(self.records))
+        self.assertEqual(list(routes(path, processes=1)), self.expected)
+        self.assertEqual(list(routes(path, processes=2)), self.expected)
+
+    def test_truncated(self):
+        path = self.write(b''.join(self.records)[:-10])
+        with self.assertRaises(ValueError):
+            list(routes(path))
+        with self.assertRaises(ValueError):
+            list(read_chunks(path, chunk_size=1000))
+
+
+if __name__ == '__main__':
+    unittest.main()
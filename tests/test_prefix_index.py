@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import random
+import subprocess
+import sys
+import unittest
+
+from ipaddress import IPv4Address, IPv6Address
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+from unittest.mock import patch
+
+os.environ.setdefault('IPASNHISTORY_HOME', str(Path(__file__).resolve().parent.parent))
+
+from ipasnhistory import prefix_index  # noqa: E402
+from ipasnhistory.helpers import format_prefix  # noqa: E402
+from ipasnhistory.prefix_index import (MASK_BYTES, PYTRICIA_NODE_BYTES, PytriciaIndex, RangeIndex,  # noqa: E402
+                                       VALIDITY_BYTES, VersionedIndex)
+
+Table = List[Tuple[str, List[str]]]
+
+
+def random_table(rng: random.Random, address_family: str, size: int) -> Table:
+    '''Random announces, with a lot of more specifics (and some prefixes announced by several ASNs).'''
+    max_length, min_length = (32, 8) if address_family == 'v4' else (128, 16)
+    prefixes: Dict[str, str] = {}
+    bases: List[Tuple[int, int]] = []
+    while len(prefixes) < size:
+        if bases and rng.random() < 0.6:
+            # More specific of an existing prefix
+            network, length = rng.choice(bases)
+            sub_length = min(max_length, length + rng.randint(1, 8))
+            network |= rng.getrandbits(sub_length - length) << (max_length - sub_length) if sub_length > length else 0
+            length = sub_length
+        else:
+            length = rng.randint(min_length, min_length + 16)
+            network = rng.getrandbits(length) << (max_length - length)
+        bases.append((network, length))
+        prefixes[format_prefix(network, length, address_family)] = str(rng.randint(1, 60))
+    table: Dict[str, List[str]] = {}
+    for prefix, asn in prefixes.items():
+        table.setdefault(asn, []).append(prefix)
+    return list(table.items())
+
+
+def random_ips(rng: random.Random, address_family: str, table: Table, count: int) -> List[str]:
+    '''Random IPs, and IPs at the edges of the prefixes.'''
+    max_length = 32 if address_family == 'v4' else 128
+    to_ip = IPv4Address if address_family == 'v4' else IPv6Address
+    ips = [str(to_ip(rng.getrandbits(max_length))) for _ in range(count)]
+    for _, prefixes in table:
+        for prefix in prefixes[:count]:
+            network, length = prefix.split('/')
+            first = int(to_ip(network))
+            last = first + (1 << (max_length - int(length))) - 1
+            ips += [str(to_ip(first)), str(to_ip(last)), str(to_ip(max(first - 1, 0))), str(to_ip(min(last + 1, 2 ** max_length - 1)))]
+    return ips
+
+
+def announces(table: Table) -> Iterable[Tuple[str, Iterable[str]]]:
+    return iter(table)
+
+
+class TestRangeIndex(unittest.TestCase):
+
+    def test_same_as_pytricia(self):
+        rng = random.Random(42)
+        for address_family in ['v4', 'v6']:
+            for _ in range(5):
+                table = random_table(rng, address_family, 500)
+                reference = PytriciaIndex(address_family)
+                reference.build(table)
+                index = RangeIndex(address_family)
+                index.build(table)
+                ips = random_ips(rng, address_family, table, 200)
+                responses = index.lookup_many(ips)
+                for ip, response in zip(ips, responses):
+                    expected = reference.lookup(ip)
+                    self.assertEqual(response, expected, ip)
+                    if response and response['asn'] != '0':
+                        self.assertEqual(index.uniform_range(ip, response['prefix']),
+                                         reference.uniform_range(ip, response['prefix']), ip)
+
+    def test_snapshot(self):
+        rng = random.Random(1)
+        table = random_table(rng, 'v6', 300)
+        index = RangeIndex('v6')
+        index.build(table)
+        path = Path(os.environ['IPASNHISTORY_HOME']) / 'cache' / 'test_snapshot.idx'
+        try:
+            index.save(path)
+            mapped = RangeIndex.open_snapshot(path)
+            ips = random_ips(rng, 'v6', table, 100)
+            self.assertEqual(mapped.lookup_many(ips), index.lookup_many(ips))
+            self.assertEqual(sorted((asn, sorted(prefixes)) for asn, prefixes in mapped.announces()),
+                             sorted((asn, sorted(prefixes)) for asn, prefixes in table))
+        finally:
+            path.unlink(missing_ok=True)
+
+    def test_other_address_family(self):
+        for address_family, ip in [('v4', '2001:db8::1'), ('v6', '192.0.2.1')]:
+            index = RangeIndex(address_family)
+            index.build([('1', ['1.0.0.0/8' if address_family == 'v4' else '2001:db8::/32'])])
+            reference = PytriciaIndex(address_family)
+            reference.build([('1', ['1.0.0.0/8' if address_family == 'v4' else '2001:db8::/32'])])
+            self.assertEqual(index.lookup_many([ip, 'not an ip']), [reference.lookup(ip), None])
+
+
+class TestVersionedIndex(unittest.TestCase):
+
+    def test_same_as_pytricia(self):
+        rng = random.Random(7)
+        for address_family in ['v4', 'v6']:
+            base = random_table(rng, address_family, 400)
+            # Consecutive days: mostly the same announces
+            tables = {f'2026-10-{day:02}': [(asn, [p for p in prefixes if rng.random() > 0.1]) for asn, prefixes in base]
+                      + random_table(rng, address_family, 50) for day in range(1, 6)}
+            index = VersionedIndex(address_family)
+            with patch.object(prefix_index, 'load_announces', lambda storagedb, source, af, d: announces(tables[d])):
+                for day in ['2026-10-01', '2026-10-02', '2026-10-03']:
+                    index.load(None, 'caida', day)  # type: ignore[arg-type]
+                index.unload('2026-10-02')
+                # Gets the slot of the unloaded date
+                index.load(None, 'caida', '2026-10-04')  # type: ignore[arg-type]
+                self.assertEqual(index.slots['2026-10-04'], 1)
+                index.load(None, 'caida', '2026-10-05')  # type: ignore[arg-type]
+            self.assertCountEqual(index.dates(), ['2026-10-01', '2026-10-03', '2026-10-04', '2026-10-05'])
+            for day in index.dates():
+                reference = PytriciaIndex(address_family)
+                reference.build(tables[day])
+                ips = random_ips(rng, address_family, tables[day], 100)
+                for ip, response in zip(ips, index.lookup_many(day, ips)):
+                    expected = reference.lookup(ip)
+                    self.assertEqual(response, expected, (day, ip))
+                    if response and response['asn'] != '0':
+                        self.assertEqual(index.uniform_range(day, ip, response['prefix']),
+                                         reference.uniform_range(ip, response['prefix']), (day, ip))
+            with self.assertRaises(KeyError):
+                index.lookup_many('2026-10-02', ['1.1.1.1'])
+
+
+# Run in a fresh process: the memory freed by the other tests would be reused, and not show in the RSS.
+MEASURE = '''
+import gc, json, random, sys
+from unittest.mock import patch
+from ipasnhistory import prefix_index
+from ipasnhistory.helpers import format_prefix, get_rss
+address_family = sys.argv[1]
+max_length, length = (32, 24) if address_family == 'v4' else (128, 48)
+rng = random.Random(1)
+prefixes = list({format_prefix(rng.getrandbits(length) << (max_length - length), length, address_family) for _ in range(100000)})
+table = [(str(asn), prefixes[asn::1000]) for asn in range(1000)]
+gc.collect()
+before = get_rss()
+prefix_index.PytriciaIndex(address_family).build(table)
+node = (get_rss() - before) / len(prefixes)
+index = prefix_index.VersionedIndex(address_family)
+with patch.object(prefix_index, 'load_announces', lambda *args: iter(table)):
+    before = get_rss()
+    index.load(None, 'test', '2024-01-01')
+    first = get_rss()
+    for day in range(2, 6):
+        index.load(None, 'test', f'2024-01-{day:02}')
+    print(json.dumps({'node': node, 'validity': (first - before) / len(prefixes) - node,
+                      'mask': (get_rss() - first) / len(prefixes) / 4}))
+'''
+
+
+@unittest.skipUnless(os.path.exists('/proc/self/statm'), 'Measured with the RSS, Linux only')
+class TestMemory(unittest.TestCase):
+    '''The sizes used to plan the memory of the lookup processes match the memory actually used.'''
+
+    def test_sizes(self):
+        for address_family in ['v4', 'v6']:
+            with self.subTest(address_family=address_family):
+                output = subprocess.run([sys.executable, '-c', MEASURE, address_family], check=True, capture_output=True,
+                                        env={**os.environ, 'PYTHONPATH': str(Path(__file__).resolve().parent.parent)}).stdout
+                measured = json.loads(output)
+                self.assertAlmostEqual(measured['node'], PYTRICIA_NODE_BYTES[address_family], delta=PYTRICIA_NODE_BYTES[address_family] / 4)
+                self.assertAlmostEqual(measured['validity'], VALIDITY_BYTES, delta=VALIDITY_BYTES / 4)
+                self.assertLessEqual(measured['mask'], MASK_BYTES + 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
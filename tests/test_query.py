@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+import asyncio
+import os
+import unittest
+
+from datetime import datetime
+from pathlib import Path
+from typing import List, Tuple
+
+os.environ.setdefault('IPASNHISTORY_HOME', str(Path(__file__).resolve().parent.parent))
+
+from ipasnhistory.date_index import DateIndex  # noqa: E402
+from ipasnhistory.helpers import ondemand_stream_key, ranges_cache_key  # noqa: E402
+from ipasnhistory.query import Query  # noqa: E402
+from ipasnhistory.query_async import AsyncQuery  # noqa: E402
+
+from tests.memory_redis import AsyncMemoryRedis  # noqa: E402
+
+DATE = '2026-10-10T12:00:00'
+
+
+class RecordingPipeline():
+    '''Keeps the commands added to the pipeline, nothing is sent.'''
+
+    def __init__(self) -> None:
+        self.commands: List[Tuple] = []
+
+    def __getattr__(self, command: str):
+        return lambda *args, **kwargs: self.commands.append((command, args))
+
+
+class TestOnDemandDisabled(unittest.TestCase):
+
+    cached = {'2026-10-09T12:00:00', '2026-10-10T12:00:00'}
+    stored = cached | {'2026-08-01T12:00:00', '2026-09-01T12:00:00'}
+
+    def _query(self, ondemand: bool) -> Query:
+        query = Query()
+        query.ondemand = ondemand
+        index = DateIndex('caida', 'v4')
+        query._update_index(index, 'test', set(self.cached), set(self.stored))
+        # Up to date, no need to check the cache.
+        index.last_check = datetime.now()
+        query.date_indexes['caida|v4'] = index
+        return query
+
+    def test_nearest_cached_date(self):
+        query = self._query(ondemand=False)
+        self.assertEqual(query._find_dates('caida', 'v4', date='2026-09-01T12:00:00'), ['2026-10-09T12:00:00'])
+
+    def test_not_sent_to_ondemand_stream(self):
+        query = self._query(ondemand=False)
+        keys = query._keys_for_query({'ip': '8.8.8.8', 'source': 'caida', 'date': '2026-09-01T12:00:00'})
+        p = RecordingPipeline()
+        query._enqueue(p, keys)  # type: ignore[arg-type]
+        self.assertNotIn(ondemand_stream_key('caida'), [args[0] for command, args in p.commands if command == 'xadd'])
+
+    def test_historical_date_with_ondemand(self):
+        query = self._query(ondemand=True)
+        keys = query._keys_for_query({'ip': '8.8.8.8', 'source': 'caida', 'date': '2026-09-01T12:00:00'})
+        self.assertEqual(keys, ['caida|v4|2026-09-01T12:00:00|8.8.8.8'])
+        p = RecordingPipeline()
+        query._enqueue(p, keys)  # type: ignore[arg-type]
+        self.assertIn(ondemand_stream_key('caida'), [args[0] for command, args in p.commands if command == 'xadd'])
+
+
+class TestRefreshExpire(unittest.TestCase):
+
+    def test_only_existing_keys(self):
+        query = Query()
+        p = RecordingPipeline()
+        query._refresh_expire(p, {'caida|v4|2026-10-10T12:00:00|8.8.8.8': {'asn': '15169', 'prefix': '8.8.8.0/24'},  # type: ignore[arg-type]
+                                  'caida|v4|2026-10-10T12:00:00|0.0.0.1': {'asn': '0', 'prefix': '0.0.0.0/0'},
+                                  'caida|v4|2026-10-10T12:00:00|foo': {'error': 'Query invalid'}})
+        expired = [args[0] for command, args in p.commands if command == 'expire']
+        self.assertCountEqual(expired, ['caida|v4|2026-10-10T12:00:00|0.0.0.1', 'caida|v4|2026-10-10T12:00:00|foo',
+                                        ranges_cache_key('caida', 'v4', '2026-10-10T12:00:00')])
+
+
+class TestAsyncWait(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.query = AsyncQuery()
+        self.query.local = None
+        self.query.rpc = None
+        self.query.query_timeout = 2
+        self.cache = AsyncMemoryRedis()
+        self.query.cache = self.cache  # type: ignore[assignment]
+
+    async def answer(self, keys: List[str]) -> None:
+        '''Same as a lookup process: cache the responses and notify the queries waiting on them.'''
+        await asyncio.sleep(0.1)
+        for k in keys:
+            await self.cache.hset(k, mapping={'asn': '15169', 'prefix': '8.8.8.0/24'})
+            for reply_list in await self.cache.smembers(f'waiting|{k}'):
+                await self.cache.rpush(reply_list, k)
+            await self.cache.delete(f'waiting|{k}')
+
+    async def test_shared_reply_list(self):
+        keys = [f'caida|v4|{DATE}|8.8.8.{i}' for i in range(3)]
+        both, one, _ = await asyncio.gather(self.query._wait_responses(keys[:2]), self.query._wait_responses(keys[1:2]),
+                                            self.answer(keys[:2]))
+        self.assertEqual(set(both), set(keys[:2]))
+        self.assertEqual(set(one), {keys[1]})
+        # Nothing left for the reader to dispatch
+        self.assertEqual(self.query.waiters, {})
+        self.assertFalse(await self.cache.exists(self.query.reply_list))
+
+    async def test_timeout(self):
+        self.query.query_timeout = 0.2
+        k = f'caida|v4|{DATE}|8.8.8.8'
+        self.assertEqual(await self.query._wait_responses([k]), {})
+        self.assertEqual(self.query.waiters, {})
+        # Answered too late, nobody is waiting anymore
+        await self.answer([k])
+        self.assertEqual(await self.query._wait_responses([k]), {k: {'asn': '15169', 'prefix': '8.8.8.0/24'}})
+
+
+if __name__ == '__main__':
+    unittest.main()
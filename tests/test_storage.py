@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+import importlib.util
+import logging
+import os
+import random
+import shutil
+import unittest
+
+from datetime import date, timedelta
+from pathlib import Path
+from typing import Dict, List, Set, Tuple, cast
+from unittest.mock import patch
+
+from redis import Redis
+
+root = Path(__file__).resolve().parent.parent
+os.environ.setdefault('IPASNHISTORY_HOME', str(root))
+
+from ipasnhistory import ingest, storage  # noqa: E402
+from ipasnhistory.helpers import format_prefix, get_snapshot_dir  # noqa: E402
+from ipasnhistory.ingest import AnnouncesWriter  # noqa: E402
+from ipasnhistory.storage import Announce, depth, read_announces, read_asn_meta, read_table, write_blob  # noqa: E402
+
+from tests.memory_redis import MemoryRedis  # noqa: E402
+
+# The scripts in bin aren't a package
+spec = importlib.util.spec_from_file_location('storage_compactor', root / 'bin' / 'storage_compactor.py')
+storage_compactor = importlib.util.module_from_spec(spec)  # type: ignore[arg-type]
+spec.loader.exec_module(storage_compactor)  # type: ignore[union-attr]
+
+SOURCE = 'test_storage'
+
+
+def random_announces(rng: random.Random, address_family: str, count: int) -> Set[Announce]:
+    max_length = 32 if address_family == 'v4' else 128
+    table = set()
+    for _ in range(count):
+        length = rng.randint(8, 24) if address_family == 'v4' else rng.randint(16, 64)
+        network = rng.getrandbits(length) << (max_length - length)
+        table.add((str(rng.randint(1, 50)), network, length))
+    return table
+
+
+def grouped(table: Set[Announce]) -> Dict[str, List[Tuple[int, int]]]:
+    announces: Dict[str, List[Tuple[int, int]]] = {}
+    for asn, network, length in sorted(table):
+        announces.setdefault(asn, []).append((network, length))
+    return announces
+
+
+def write_sets(storagedb: MemoryRedis, key_prefix: str, address_family: str, table: Set[Announce]) -> None:
+    '''Same keys as the writer, with the sets layout.'''
+    max_length = 32 if address_family == 'v4' else 128
+    for asn, prefixes in grouped(table).items():
+        storagedb.sadd(f'{key_prefix}|asns', asn)
+        storagedb.sadd(f'{key_prefix}|{asn}', *(format_prefix(network, length, address_family) for network, length in prefixes))
+        storagedb.set(f'{key_prefix}|{asn}|ipcount', sum(1 << (max_length - length) for _, length in prefixes))
+
+
+class TestLayouts(unittest.TestCase):
+
+    def setUp(self):
+        self.storagedb = MemoryRedis()
+        self.db = cast(Redis, self.storagedb)
+        self.rng = random.Random(1)
+
+    def write(self, layout: str, address_family: str, table: Set[Announce]) -> None:
+        key_prefix = f'{SOURCE}|{address_family}|2024-01-01'
+        if layout == 'sets':
+            write_sets(self.storagedb, key_prefix, address_family, table)
+        else:
+            write_blob(self.db, key_prefix, address_family, grouped(table))
+
+    def test_round_trip(self):
+        for layout in ['sets', 'blob']:
+            for address_family in ['v4', 'v6']:
+                with self.subTest(layout=layout, address_family=address_family), patch.object(storage, 'CHUNK_RECORDS', 7):
+                    # Small chunks: the ASNs span several of them
+                    self.storagedb.data.clear()
+                    table = random_announces(self.rng, address_family, 200)
+                    self.write(layout, address_family, table)
+                    db = self.db
+                    self.assertEqual(read_table(db, SOURCE, address_family, '2024-01-01'), table)
+                    expected = {asn: {format_prefix(network, length, address_family) for network, length in prefixes}
+                                for asn, prefixes in grouped(table).items()}
+                    self.assertEqual(dict(read_announces(db, SOURCE, address_family, '2024-01-01')), expected)
+                    max_length = 32 if address_family == 'v4' else 128
+                    meta = read_asn_meta(db, SOURCE, address_family, '2024-01-01')
+                    self.assertEqual({asn: set(data['prefixes']) for asn, data in meta.items()}, expected)
+                    for asn, prefixes in grouped(table).items():
+                        ipcount = str(sum(1 << (max_length - length) for _, length in prefixes))
+                        self.assertEqual(meta[asn]['ipcount'], ipcount)
+                        one = read_asn_meta(db, SOURCE, address_family, '2024-01-01', asn)
+                        self.assertEqual(set(one[asn]['prefixes']), expected[asn])
+                        self.assertEqual(one[asn]['ipcount'], ipcount)
+                        self.assertEqual(read_table(db, SOURCE, address_family, '2024-01-01', asn),
+                                         {a for a in table if a[0] == asn})
+                    self.assertEqual(read_asn_meta(db, SOURCE, address_family, '2024-01-01', '64496'),
+                                     {'64496': {'prefixes': [], 'ipcount': None}})
+
+
+def churn(rng: random.Random, table: Set[Announce]) -> Set[Announce]:
+    '''The table of the next day: a few announces removed, a few new ones.'''
+    removed = set(rng.sample(sorted(table), 10))
+    return (table - removed) | random_announces(rng, 'v4', 10)
+
+
+class TestDelta(unittest.TestCase):
+
+    def setUp(self):
+        self.storagedb = MemoryRedis()
+        self.db = cast(Redis, self.storagedb)
+        self.rng = random.Random(1)
+        self.addCleanup(shutil.rmtree, get_snapshot_dir() / SOURCE, ignore_errors=True)
+
+    def import_dates(self, dates: List[str], layout: str, checkpoint_interval: int) -> Dict[str, Set[Announce]]:
+        '''Import the dates in order, with the writer of the loaders.'''
+        tables = {}
+        table = random_announces(self.rng, 'v4', 200)
+        with patch.object(ingest, 'get_config', return_value=checkpoint_interval):
+            for announces_date in dates:
+                writer = AnnouncesWriter(self.db, SOURCE, 'v4', announces_date)
+                writer.layout = layout
+                for asn, network, length in table:
+                    writer.add(asn, network, length)
+                writer.finish()
+                tables[announces_date] = table
+                table = churn(self.rng, table)
+        return tables
+
+    def compactor(self, retention_days: int, checkpoint_interval: int):
+        compactor = storage_compactor.StorageCompactor.__new__(storage_compactor.StorageCompactor)
+        compactor.logger = logging.getLogger('test_storage')
+        compactor.logger.setLevel(logging.WARNING)
+        compactor.storagedb = self.db
+        compactor.retention_days = retention_days
+        compactor.checkpoint_interval = checkpoint_interval
+        return compactor
+
+    def assertStored(self, tables: Dict[str, Set[Announce]], depths: List[int]) -> None:
+        self.assertEqual(self.storagedb.smembers(f'{SOURCE}|v4|dates'), set(tables))
+        self.assertEqual([depth(self.db, SOURCE, 'v4', d) for d in sorted(tables)], depths)
+        for announces_date, table in tables.items():
+            self.assertEqual(read_table(self.db, SOURCE, 'v4', announces_date), table)
+            asn = sorted(table)[0][0]
+            meta = read_asn_meta(self.db, SOURCE, 'v4', announces_date, asn)
+            self.assertEqual(set(meta[asn]['prefixes']),
+                             {format_prefix(network, length, 'v4') for _a, network, length in table if _a == asn})
+
+    def test_chain_across_checkpoints(self):
+        dates = [f'2024-01-0{day}' for day in range(1, 8)]
+        tables = self.import_dates(dates, 'delta', 3)
+        self.assertStored(tables, [0, 1, 2, 0, 1, 2, 0])
+
+    def test_expire(self):
+        '''The dates based on the expired ones become checkpoints before they are removed.'''
+        dates = [(date.today() - timedelta(days=days)).isoformat() for days in range(6, -1, -1)]
+        tables = self.import_dates(dates, 'delta', 10)
+        self.assertStored(tables, [0, 1, 2, 3, 4, 5, 6])
+        self.compactor(retention_days=3, checkpoint_interval=10).expire(SOURCE, 'v4')
+        for announces_date in dates[:3]:
+            tables.pop(announces_date)
+            self.assertEqual(list(self.storagedb.scan_iter(f'{SOURCE}|v4|{announces_date}|*')), [])
+        self.assertStored(tables, [0, 1, 2, 3])
+
+    def test_compact(self):
+        '''The full dates are stored as diffs.'''
+        dates = [f'2024-01-0{day}' for day in range(1, 6)]
+        tables = self.import_dates(dates, 'blob', 3)
+        self.assertStored(tables, [0, 0, 0, 0, 0])
+        self.compactor(retention_days=0, checkpoint_interval=3).compact(SOURCE, 'v4')
+        self.assertStored(tables, [0, 1, 2, 0, 1])
+        for announces_date in ['2024-01-02', '2024-01-03', '2024-01-05']:
+            self.assertFalse(self.storagedb.exists(f'{SOURCE}|v4|{announces_date}|blob'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+import importlib.util
+import shutil
+import socket
+import time
+import unittest
+
+from http.client import HTTPConnection
+from pathlib import Path
+from subprocess import Popen, DEVNULL
+from typing import Iterator
+
+root = Path(__file__).resolve().parent.parent
+
+# The scripts in bin aren't a package
+spec = importlib.util.spec_from_file_location('start_website', root / 'bin' / 'start_website.py')
+start_website = importlib.util.module_from_spec(spec)  # type: ignore[arg-type]
+spec.loader.exec_module(start_website)  # type: ignore[union-attr]
+
+
+def slow_app(environ, start_response) -> Iterator[bytes]:
+    '''Streams a line every half second, for longer than the timeout of the workers in the test.'''
+    start_response('200 OK', [('Content-Type', 'application/x-ndjson')])
+    for i in range(10):
+        time.sleep(0.5)
+        yield f'{i}\n'.encode()
+
+
+@unittest.skipUnless(shutil.which('gunicorn'), 'gunicorn is not installed')
+class TestGunicornStreaming(unittest.TestCase):
+
+    def setUp(self):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            self.port = s.getsockname()[1]
+        self.process = Popen(start_website.gunicorn_command('tests.test_website:slow_app', f'127.0.0.1:{self.port}', timeout=2),
+                             cwd=root, stdout=DEVNULL, stderr=DEVNULL)
+        for _ in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', self.port)).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+    def tearDown(self):
+        self.process.terminate()
+        self.process.wait()
+
+    def test_response_longer_than_timeout(self):
+        connection = HTTPConnection('127.0.0.1', self.port, timeout=30)
+        connection.request('POST', '/bulk_query')
+        start = time.monotonic()
+        body = connection.getresponse().read()
+        connection.close()
+        self.assertGreater(time.monotonic() - start, 2)
+        self.assertEqual(body.decode().split(), [str(i) for i in range(10)])
+
+
+if __name__ == '__main__':
+    unittest.main()
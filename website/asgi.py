@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+import codecs
+import json
+
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Tuple
+from urllib.parse import parse_qsl
+
+from ipasnhistory.bulk import BulkReader, BulkWriter, is_csv
+from ipasnhistory.query_async import AsyncQuery
+
+# Same API as web (Flask), on top of AsyncQuery: a single process holds many queries waiting for the lookup processes.
+
+query: AsyncQuery = AsyncQuery()
+
+
+def _unpack_query(query: Dict) -> Dict:
+    if 'precision_delta' in query:
+        query['precision_delta'] = json.loads(query['precision_delta'])
+    return query
+
+
+async def _read_body(receive) -> Any:
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return json.loads(body)
+
+
+async def _read_lines(receive) -> AsyncIterator[str]:
+    '''The lines of the body, as they are received.'''
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    while True:
+        message = await receive()
+        buffer += decoder.decode(message.get('body', b''), final=not message.get('more_body'))
+        *lines, buffer = buffer.split('\n')
+        for line in lines:
+            yield line
+        if not message.get('more_body'):
+            if buffer:
+                yield buffer
+            return
+
+
+async def _send_json(send, data: Any, status: int=200) -> None:
+    body = json.dumps(data).encode()
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def ip_get(scope, receive) -> Dict:
+    return await query.query(**_unpack_query(dict(parse_qsl(scope['query_string'].decode()))))
+
+
+async def ip_post(scope, receive) -> Dict:
+    return await query.query(**_unpack_query(await _read_body(receive)))
+
+
+async def mass_query(scope, receive) -> Dict:
+    return await query.mass_query([_unpack_query(q) for q in await _read_body(receive)])
+
+
+async def mass_cache(scope, receive) -> Dict:
+    return await query.mass_cache([_unpack_query(q) for q in await _read_body(receive)])
+
+
+async def asn_meta(scope, receive) -> Dict:
+    return await query.asn_meta(**_unpack_query(await _read_body(receive)))
+
+
+async def meta(scope, receive) -> Dict:
+    return await query.meta()
+
+
+async def bulk_query(scope, receive, send) -> None:
+    content_type = dict(scope['headers']).get(b'content-type')
+    csv_format = is_csv(content_type.decode() if content_type else None)
+    reader = BulkReader(csv_format)
+    writer = BulkWriter(csv_format)
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': [(b'content-type', writer.mimetype.encode())]})
+    await send({'type': 'http.response.body', 'body': writer.header().encode(), 'more_body': True})
+    error = None
+    try:
+        async for response in query.bulk_query(reader.aqueries(_read_lines(receive))):
+            await send({'type': 'http.response.body', 'body': writer.format(response).encode(), 'more_body': True})
+        error = reader.error
+    except Exception as e:
+        # Too late for an error response, the status is sent.
+        error = str(e)
+    await send({'type': 'http.response.body', 'body': writer.error(error).encode() if error else b''})
+
+
+routes: Dict[Tuple[str, str], Callable[[Dict, Any], Awaitable[Any]]] = {
+    ('GET', '/ip'): ip_get,
+    ('POST', '/ip'): ip_post,
+    ('POST', '/mass_query'): mass_query,
+    ('POST', '/mass_cache'): mass_cache,
+    ('POST', '/asn_meta'): asn_meta,
+    ('GET', '/meta'): meta,
+}
+
+# The responses are sent as they come
+streaming_routes: Dict[Tuple[str, str], Callable[[Dict, Any, Any], Awaitable[None]]] = {
+    ('POST', '/bulk_query'): bulk_query,
+}
+
+
+async def app(scope, receive, send) -> None:
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        return
+    path = scope['path'].rstrip('/')
+    if (scope['method'], path) in streaming_routes:
+        await streaming_routes[(scope['method'], path)](scope, receive, send)
+        return
+    if (scope['method'], path) not in routes:
+        if any(path == route for _, route in list(routes) + list(streaming_routes)):
+            await _send_json(send, {'message': 'The method is not allowed for the requested URL.'}, 405)
+        else:
+            await _send_json(send, {'message': 'The requested URL was not found on the server.'}, 404)
+        return
+    try:
+        response = await routes[(scope['method'], path)](scope, receive)
+    except Exception as e:
+        response = {'error': str(e)}
+    await _send_json(send, response)
@@ -1,13 +1,15 @@
 #!/usr/bin/env python3
 
+import io
 import json
 import pkg_resources
 
 from typing import Dict, List
 
-from flask import Flask, request
+from flask import Flask, Response, request, stream_with_context
 from flask_restx import Api, Resource, fields  # type: ignore
 
+from ipasnhistory.bulk import BulkReader, BulkWriter, is_csv
 from ipasnhistory.default import get_config
 from ipasnhistory.query import Query
 
@@ -95,6 +97,32 @@ class MassQuery(Resource):
             return {'error': str(e)}
 
 
+@api.route('/bulk_query')
+@api.doc(description="Search any number of IPs, one query per line: NDJSON (same fields as mass_query), or CSV with a header (Content-Type: text/csv). "
+                     "The responses are streamed in the same format, as the queries are run.")
+class BulkQuery(Resource):
+
+    def post(self):
+        csv_format = is_csv(request.content_type)
+        reader = BulkReader(csv_format)
+        writer = BulkWriter(csv_format)
+        lines = io.TextIOWrapper(request.stream, encoding='utf-8')
+
+        def stream():
+            yield writer.header()
+            try:
+                for response in query.bulk_query(reader.queries(lines)):
+                    yield writer.format(response)
+                error = reader.error
+            except Exception as e:
+                # Too late for an error response, the status is sent.
+                error = str(e)
+            if error:
+                yield writer.error(error)
+
+        return Response(stream_with_context(stream()), mimetype=writer.mimetype)
+
+
 @api.route('/mass_cache')
 @api.doc(description="Cache a list of IP")
 class MassCache(Resource):